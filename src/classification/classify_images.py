@@ -7,6 +7,7 @@ from keras.models import load_model
 import numpy as np
 
 from image_data import ImageSet
+from stage_timer import StageTimer
 from utils import decode_totality_prediction
 from utils import download_images
 from utils import get_vgg
@@ -19,8 +20,15 @@ def main():
     parser.add_argument('--img-uri', type=str, default='img/img.txt')
     parser.add_argument('--lr-model', type=str, default='lr_model.h5')
     parser.add_argument('--save', type=str, default=None)
+    parser.add_argument('--instrument', type=str, default=None,
+                        help='JSON lines file to append the time of each '
+                             'stage (decode, vgg_forward, lr_predict) to')
+    parser.add_argument('--track-memory', default=False, action='store_true',
+                        help='also record the peak memory of each stage')
     args = parser.parse_args()
 
+    timer = StageTimer(args.instrument, args.track_memory)
+
     # Create URI list
     with open(args.img_uri) as f:
         img_uri = [l.strip() for l in f.readlines()]
@@ -46,18 +54,23 @@ def main():
     print('Classifying images...')
     vgg_fc2_out = list()
     batch_size = 32
-    i = 0
-    for batch, start, end in images.get_batches(batch_size):
+    batches = images.get_batches(batch_size, timer)
+    for i, (batch, start, end) in enumerate(batches):
         print('Batch {}, images[{}:{}]'.format(i, start, end))
-        vecs = functor([batch])
+        with timer.stage('vgg_forward'):
+            vecs = functor([batch])
         vgg_fc2_out.extend(vecs[0])
-        i += 1
+
+        # One record per batch, as VGG runs on whole batches
+        timer.write(batch=i, images=img_uri[start:end])
 
     # Load trained logistic regression model
     model = load_model(args.lr_model)
 
     # Classify tensors from VGG19 using LR model
-    predictions = model.predict(np.array(vgg_fc2_out))
+    with timer.stage('lr_predict'):
+        predictions = model.predict(np.array(vgg_fc2_out))
+    timer.write(images=len(vgg_fc2_out))
 
     # Prediction dictionary. Used if the --save argument is supplied
     pred_dict = dict()
@@ -7,6 +7,7 @@ import numpy as np
 from sklearn.model_selection import StratifiedKFold
 
 import constants as const
+from stage_timer import StageTimer
 import utils
 
 
@@ -235,14 +236,21 @@ class ImageSet(object):
         self.squash = squash
         self.dim = dim
 
-    def get_batches(self, batch_size=32):
+    def get_batches(self, batch_size=32, timer=None):
+        """
+        Yields (images, start, end) for each batch of batch_size images.
+        Decoding is timed as the decode stage of timer (a
+        stage_timer.StageTimer), if given.
+        """
+        if timer is None:
+            timer = StageTimer()
+
         start = 0
         end = min(batch_size, len(self.img_paths))
 
         while start < len(self.img_paths):
-            images = _open_images(self.img_paths[start:end], self.squash, self.dim)
+            with timer.stage('decode'):
+                images = _open_images(self.img_paths[start:end], self.squash, self.dim)
             yield images, start, end
             start = end
             end = min(end + batch_size, len(self.img_paths))
-
-        raise StopIteration
@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from contextlib import nullcontext
+import json
+import time
+import tracemalloc
+
+
+class StageTimer(object):
+    """
+    Opt-in timing of the stages of classify_images.py. The wall time, CPU
+    time of the calling thread, call count and (with track_memory) peak
+    memory of each stage are summed until write() appends them, along with
+    its fields, as one JSON line to path. Without a path, nothing is
+    measured or written.
+    """
+
+    def __init__(self, path=None, track_memory=False):
+        self.path = path
+        self.track_memory = track_memory and path is not None
+        self.stages = dict()
+
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name):
+        if self.path is None:
+            return nullcontext()
+        return self._measure(name)
+
+    def write(self, **fields):
+        """
+        Appends the stages measured since the last write as one record.
+        """
+        if self.path is None:
+            return
+
+        record = dict(fields)
+        record['stages'] = self.stages
+        self.stages = dict()
+
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    @contextmanager
+    def _measure(self, name):
+        if self.track_memory:
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        cpu = time.thread_time()
+        wall = time.perf_counter()
+        try:
+            yield
+        finally:
+            totals = self.stages.setdefault(
+                name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            totals['wall'] += time.perf_counter() - wall
+            totals['cpu'] += time.thread_time() - cpu
+            totals['calls'] += 1
+
+            if self.track_memory:
+                peak = tracemalloc.get_traced_memory()[1] - start_memory
+                totals['peak_bytes'] = max(totals.get('peak_bytes', 0), peak)
@@ -0,0 +1,112 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+import time
+
+from detect_circles import HOUGH_METHODS
+from detect_circles import compute_circles
+from detect_circles import preprocess_image
+from detect_circles import read_image
+from detect_circles import scale_circles_to_shape
+from generate_runs import IMAGE_DIR
+from run_config import parse_config
+from scoring import image_loss
+from scoring import load_ground_truth
+
+
+DEFAULT_CONFIG = '1200 0 g 0 0 0 0 g 15 0 2 1 30 30 0 0'
+
+
+def benchmark(config, images, image_dir, ground_truth, methods=HOUGH_METHODS):
+    """
+    Preprocesses each image once for config and runs every circle Hough
+    method of methods on it. Returns a dict mapping each method to
+    (total Hough seconds, total loss, number of images).
+    """
+    totals = dict((m, [0.0, 0.0, 0]) for m in methods)
+
+    for imname in images:
+        image, original_shape = read_image(image_dir, imname,
+                                           config.size_bound)
+        if image is None:
+            print('Error: {} could not be read'.format(
+                      os.path.join(image_dir, imname)),
+                  file=sys.stderr)
+            continue
+
+        processed = preprocess_image(
+            image, config.size_bound, config.enable_unsharp,
+            config.unsharp_blur_type, config.unsharp_blur_ksize,
+            config.unsharp_blur_sigmaXY, config.unsharp_add_weight,
+            config.unsharp_gamma, config.blur_type, config.blur_ksize,
+            config.blur_sigmaXY)
+
+        for method in methods:
+            t = time.time()
+            circle1, circle2 = compute_circles(
+                processed, config.dp, config.minDist, config.param1,
+                config.param2, config.minRadius, config.maxRadius, method)
+            elapsed = time.time() - t
+
+            circle1, circle2 = scale_circles_to_shape(
+                circle1, circle2, original_shape, processed.shape)
+
+            totals[method][0] += elapsed
+            totals[method][1] += image_loss(ground_truth[imname], circle1,
+                                            circle2)
+            totals[method][2] += 1
+
+    return dict((m, tuple(v)) for m, v in totals.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares the speed and loss of the circle Hough '
+                    'transforms compute_circles supports on ground truth '
+                    'images.')
+    parser.add_argument('ground_truth_file')
+    parser.add_argument('--image-dir', type=str, default=IMAGE_DIR)
+    parser.add_argument('--config', type=str, action='append',
+                        help='the 16 detect_circles.py parameters, quoted; '
+                             'may be repeated (default: {})'.format(
+                                 DEFAULT_CONFIG))
+    parser.add_argument('--limit', type=int, default=None,
+                        help='only use the first LIMIT images')
+    parser.add_argument('--methods', type=str, nargs='+',
+                        choices=HOUGH_METHODS, default=list(HOUGH_METHODS))
+    args = parser.parse_args()
+
+    ground_truth = load_ground_truth(args.ground_truth_file)
+    images = sorted(ground_truth)[:args.limit]
+
+    for params in args.config or [DEFAULT_CONFIG]:
+        config = parse_config(params.split())
+        print(params)
+
+        totals = benchmark(config, images, args.image_dir, ground_truth,
+                           args.methods)
+
+        for method in args.methods:
+            seconds, loss, n = totals[method]
+            n = max(n, 1)
+            print('    {:12s} {:10.4f} s/image  {:12.1f} loss/image'.format(
+                method, seconds / n, loss / n))
+
+
+if __name__ == '__main__':
+    main()
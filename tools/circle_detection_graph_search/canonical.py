@@ -0,0 +1,168 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+from collections import OrderedDict
+import math
+import sys
+
+from generate_runs import build_param_space
+from run_config import parse_invocation
+
+
+# GaussianBlur uses fixed kernels rather than the derived sigma for
+# ksize <= this when sigma is 0
+GAUSSIAN_FIXED_KERNEL_KSIZE = 7
+
+DISABLED_UNSHARP = dict(
+    unsharp_blur_type       = 'g',
+    unsharp_blur_ksize      = 0,
+    unsharp_blur_sigmaXY    = 0,
+    unsharp_add_weight      = 0.0,
+    unsharp_gamma           = 0,
+)
+
+
+def derived_gaussian_sigma(ksize):
+    """
+    Sigma cv2.GaussianBlur derives from ksize when sigma is 0.
+    """
+    return 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+
+
+def is_valid(config):
+    """
+    Whether detect_circles.py can run config at all. OpenCV rejects even
+    (or non positive) blur kernel sizes.
+    """
+    if config.enable_unsharp and not _valid_blur(config.unsharp_blur_type,
+                                                  config.unsharp_blur_ksize):
+        return False
+
+    return _valid_blur(config.blur_type, config.blur_ksize)
+
+
+def canonical_config(config):
+    """
+    Returns the normal form of config: the representative of all configs
+    detect_circles.py produces identical output for. Returns None if config
+    is not valid.
+
+     * Unsharp parameters are ignored when unsharp masking is disabled
+     * Median blurs ignore sigma
+     * A Gaussian sigma equal to the one OpenCV derives from ksize is the
+       same as sigma 0
+     * HoughCircles treats maxRadius 0 as the larger dimension of its
+       image, which resize_image always makes exactly size_bound, so
+       maxRadius == size_bound is the same as 0
+     * HoughCircles replaces 0 < maxRadius <= minRadius with minRadius + 2
+
+    A larger maxRadius still admits circles bigger than the image, and a
+    negative one makes HoughCircles return centers only, so neither is
+    merged with 0.
+    """
+    if not is_valid(config):
+        return None
+
+    params = config._asdict()
+
+    if not config.enable_unsharp:
+        params.update(DISABLED_UNSHARP)
+    else:
+        params['unsharp_blur_sigmaXY'] = _canonical_sigma(
+            config.unsharp_blur_type, config.unsharp_blur_ksize,
+            config.unsharp_blur_sigmaXY)
+
+    params['blur_sigmaXY'] = _canonical_sigma(
+        config.blur_type, config.blur_ksize, config.blur_sigmaXY)
+
+    if config.maxRadius == config.size_bound:
+        params['maxRadius'] = 0
+    elif 0 < config.maxRadius <= config.minRadius:
+        params['maxRadius'] = config.minRadius + 2
+
+    return config._replace(**params)
+
+
+def collapse_configs(configs):
+    """
+    Groups configs into equivalence classes. Returns (classes, invalid),
+    where classes is an OrderedDict mapping each canonical config to the
+    list of its members, in the order first seen, and invalid is the list
+    of configs that cannot be run.
+    """
+    classes = OrderedDict()
+    invalid = list()
+
+    for config in configs:
+        canonical = canonical_config(config)
+
+        if canonical is None:
+            invalid.append(config)
+        else:
+            classes.setdefault(canonical, list()).append(config)
+
+    return classes, invalid
+
+
+def collapse_summary(classes, invalid):
+    n = sum(len(members) for members in classes.values()) + len(invalid)
+    saved = n - len(classes)
+
+    return '{} configs in {} equivalence classes, {} invalid: {} runs ' \
+           '({:.1f}%) saved'.format(n, len(classes), len(invalid), saved,
+                                    100.0 * saved / n if n else 0.0)
+
+
+def _valid_blur(blur_type, ksize):
+    return ksize > 0 and ksize % 2 == 1 and blur_type in ('g', 'm')
+
+
+def _canonical_sigma(blur_type, ksize, sigmaXY):
+    if blur_type == 'm':
+        return 0
+
+    if ksize > GAUSSIAN_FIXED_KERNEL_KSIZE and \
+            math.isclose(sigmaXY, derived_gaussian_sigma(ksize)):
+        return 0
+
+    return sigmaXY
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Reports how many detect_circles.py runs of a runs file '
+                    '(or of the whole generate_runs.py grid) are redundant.')
+    parser.add_argument('runs_file', nargs='?', default=None)
+    parser.add_argument('--list-invalid', action='store_true')
+    args = parser.parse_args()
+
+    if args.runs_file is None:
+        configs = build_param_space()
+    else:
+        with open(args.runs_file) as f:
+            configs = [parse_invocation(l)[2] for l in f if l.strip()]
+
+    classes, invalid = collapse_configs(configs)
+
+    print(collapse_summary(classes, invalid))
+
+    if args.list_invalid:
+        for config in invalid:
+            print('Invalid: {}'.format(config), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
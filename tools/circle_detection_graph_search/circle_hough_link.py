@@ -0,0 +1,200 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+import cv2
+import numpy as np
+
+
+# Defaults of src/imgproc/IDL/circlehoughlink.pro
+DEFAULT_BINS            = 100
+DEFAULT_MAX             = 1000
+DEFAULT_NTHETA          = 100
+DEFAULT_NHD_RAD         = 1
+DEFAULT_THRESHOLD_RATIO = 0.9
+
+# Bounds on the size of the arrays built while voting
+MAX_BATCH_VOTES         = 1 << 23
+MAX_BATCH_CELLS         = 1 << 24
+
+# Most radius planes hough_circles searches; the radius step grows past dp
+# for wider radius ranges
+MAX_RADII               = 128
+
+
+def circle_hough_link(xpts, ypts, radius, threshold=None, ncircles=1,
+                      xbins=DEFAULT_BINS, ybins=DEFAULT_BINS, xmax=DEFAULT_MAX,
+                      ymax=DEFAULT_MAX, nhd_rad=DEFAULT_NHD_RAD,
+                      ntheta=DEFAULT_NTHETA):
+    """
+    Port of CircleHoughLink (src/imgproc/IDL/circlehoughlink.pro). Finds up
+    to ncircles circles with a radius in radius through the points
+    (xpts, ypts). Returns a list of (cx, cy, r, votes), strongest first.
+
+    Every point votes once for each (cx, cy) cell the locus of ntheta
+    centers at each radius passes through. The cells cover
+    [-max(radius), xmax + max(radius)) in xbins steps (and likewise for y).
+    Peaks are taken greedily while their votes reach threshold (by default
+    0.9 times the largest count). The cells within nhd_rad of a peak are
+    then blocked out in its radius plane.
+    """
+    radius = np.asarray(radius, dtype=np.float64).ravel()
+    if radius.size == 0:
+        raise ValueError('circle_hough_link requires at least one radius')
+
+    n = min(len(xpts), len(ypts))
+    xpts = np.asarray(xpts, dtype=np.float64)[:n]
+    ypts = np.asarray(ypts, dtype=np.float64)[:n]
+
+    theta = 2 * np.arange(ntheta) * np.pi / (ntheta - 1)
+    radiusmax = radius.max()
+    delta_x = float(xmax + 2 * radiusmax) / xbins
+    delta_y = float(ymax + 2 * radiusmax) / ybins
+    plane_size = xbins * ybins
+
+    planes_per_batch = max(1, MAX_BATCH_CELLS // plane_size)
+
+    # As planes are blocked out independently, the greedy search over the
+    # whole accumulator is the merge of the greedy search of each plane, so
+    # only one batch of planes is held in memory at a time
+    peaks = list()
+    for start in range(0, len(radius), planes_per_batch):
+        radii = radius[start:start + planes_per_batch]
+        planes = _vote(xpts, ypts, radii, theta, radiusmax, delta_x, delta_y,
+                       xbins, ybins)
+
+        for i, plane in enumerate(planes):
+            for votes, kp in _plane_peaks(plane, ncircles, nhd_rad):
+                # Ties are broken by position in the accumulator, as IDL's
+                # MAX returns the first maximum
+                ir = start + i
+                peaks.append((-votes, ir * plane_size + kp, ir, kp))
+
+    if not peaks:
+        return list()
+
+    peaks.sort()
+    if threshold is None:
+        threshold = DEFAULT_THRESHOLD_RATIO * -peaks[0][0]
+
+    circles = list()
+    for neg_votes, _, ir, kp in peaks:
+        if len(circles) >= ncircles or -neg_votes < threshold:
+            break
+
+        circles.append((float((kp % xbins) * delta_x - radiusmax),
+                        float((kp // xbins) * delta_y - radiusmax),
+                        float(radius[ir]), -neg_votes))
+
+    return circles
+
+
+def hough_circles(image, dp, minDist, param1, param2, minRadius, maxRadius,
+                  ncircles=2, ntheta=DEFAULT_NTHETA):
+    """
+    Drop in replacement for cv2.HoughCircles(image, cv2.HOUGH_GRADIENT, ...)
+    based on circle_hough_link. The points are the Canny edges of image (with
+    the thresholds HoughCircles uses for param1), accumulator cells are dp
+    pixels wide, param2 is the vote threshold and peaks suppress centers
+    within minDist. maxRadius is interpreted as by HoughCircles. Returns an
+    array shaped like HoughCircles' result, or None.
+    """
+    edges = cv2.Canny(image, max(1, param1 / 2.0), param1)
+    ypts, xpts = np.nonzero(edges)
+
+    height, width = image.shape[:2]
+    if maxRadius <= 0:
+        maxRadius = max(height, width)
+    elif maxRadius <= minRadius:
+        maxRadius = minRadius + 2
+
+    step = max(dp, int(math.ceil(float(maxRadius - minRadius) / MAX_RADII)))
+    radius = np.arange(max(minRadius, 1), maxRadius + 1, step)
+
+    xbins = int(math.ceil(float(width + 2 * radius.max()) / dp))
+    ybins = int(math.ceil(float(height + 2 * radius.max()) / dp))
+
+    circles = circle_hough_link(
+        xpts, ypts, radius, threshold=param2, ncircles=ncircles, xbins=xbins,
+        ybins=ybins, xmax=width, ymax=height,
+        nhd_rad=max(1, int(math.ceil(float(minDist) / dp))), ntheta=ntheta)
+
+    if not circles:
+        return None
+
+    return np.array([[c[:3] for c in circles]], dtype=np.float32)
+
+
+def _vote(xpts, ypts, radii, theta, radiusmax, delta_x, delta_y, xbins,
+          ybins):
+    """
+    Returns the (len(radii), ybins, xbins) vote counts.
+    """
+    plane_size = xbins * ybins
+    counts = np.zeros(len(radii) * plane_size, dtype=np.int64)
+
+    rcos = radii[:, None] * np.cos(theta)[None, :]
+    rsin = radii[:, None] * np.sin(theta)[None, :]
+    offsets = (np.arange(len(radii)) * plane_size)[None, :, None]
+
+    chunk = max(1, MAX_BATCH_VOTES // rcos.size)
+
+    for start in range(0, len(xpts), chunk):
+        x = xpts[start:start + chunk, None, None]
+        y = ypts[start:start + chunk, None, None]
+
+        # Indexes are truncated towards 0 like IDL's FIX
+        ka = np.trunc((x - rcos[None] + radiusmax) / delta_x).astype(np.int64)
+        kb = np.trunc((y - rsin[None] + radiusmax) / delta_y).astype(np.int64)
+
+        k = ka + kb * xbins + offsets
+        k[(ka < 0) | (ka >= xbins) | (kb < 0) | (kb >= ybins)] = -1
+
+        # A locus passing through a cell several times votes for it once,
+        # as A[k]=A[k]+1 does in IDL
+        k.sort(axis=2)
+        first = np.ones(k.shape, dtype=bool)
+        first[..., 1:] = k[..., 1:] != k[..., :-1]
+
+        counts += np.bincount(k[first & (k >= 0)], minlength=counts.size)
+
+    return counts.reshape(len(radii), ybins, xbins)
+
+
+def _plane_peaks(plane, ncircles, nhd_rad):
+    """
+    Returns up to ncircles (votes, cell index) peaks of one radius plane,
+    blocking out the neighbourhood of each peak before finding the next.
+    """
+    plane = plane.copy()
+    ybins, xbins = plane.shape
+    flat = plane.reshape(-1)
+    peaks = list()
+
+    for _ in range(ncircles):
+        kp = int(np.argmax(flat))
+        votes = int(flat[kp])
+        if votes <= 0:
+            break
+
+        peaks.append((votes, kp))
+
+        yp, xp = divmod(kp, xbins)
+        plane[max(0, yp - nhd_rad):yp + nhd_rad + 1,
+              max(0, xp - nhd_rad):xp + nhd_rad + 1] = -1
+        plane[yp, xp] = -2
+
+    return peaks
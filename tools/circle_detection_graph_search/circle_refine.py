@@ -0,0 +1,213 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+import cv2
+import numpy as np
+
+
+# Edge points are first gathered this far from the Hough circle: the larger
+# of BAND_MIN pixels, BAND_FRACTION of its radius and BAND_DP accumulator
+# cells
+BAND_MIN            = 2.0
+BAND_FRACTION       = 0.05
+BAND_DP             = 2.0
+
+# Fit, reject outliers, gather again around the fit, this many times
+ITERATIONS          = 3
+
+# Residuals further than this many robust standard deviations (1.4826 MAD)
+# from the median residual are outliers
+OUTLIER_SIGMAS      = 3.0
+MAD_TO_SIGMA        = 1.4826
+
+# A fit needs this many edge points, spread over this many of
+# ANGLE_BINS sectors around the circle
+MIN_POINTS          = 20
+ANGLE_BINS          = 36
+MIN_ANGLE_BINS      = 6
+
+# Fits moving the center or changing the radius by more than this fraction
+# of the Hough radius are rejected
+MAX_CHANGE          = 0.2
+
+NEWTON_ITERATIONS   = 20
+NEWTON_EPSILON      = 1e-12
+
+
+def refine_circles(image, circle1, circle2, dp, canny_threshold):
+    """
+    Refines the circles found by a Hough transform on the preprocessed image
+    with a least squares fit to the edge points around them. Edges are found
+    with the Canny thresholds the Hough transforms use (canny_threshold is
+    param1), dp is the accumulator resolution of the Hough transform.
+    Circles that cannot be fit reliably, and None, are returned as they are.
+    """
+    circles = [c for c in (circle1, circle2) if c is not None]
+    if not circles:
+        return circle1, circle2
+
+    bands = [max(BAND_MIN, BAND_FRACTION * c[2], BAND_DP * dp)
+             for c in circles]
+
+    # Edges of the region around both circles, in image coordinates
+    height, width = image.shape[:2]
+    x0 = max(0, int(min(c[0] - c[2] - b for c, b in zip(circles, bands))) - 1)
+    y0 = max(0, int(min(c[1] - c[2] - b for c, b in zip(circles, bands))) - 1)
+    x1 = min(width, int(max(c[0] + c[2] + b for c, b in zip(circles, bands)))
+             + 2)
+    y1 = min(height, int(max(c[1] + c[2] + b for c, b in zip(circles, bands)))
+             + 2)
+
+    if x1 <= x0 or y1 <= y0:
+        return circle1, circle2
+
+    # The thresholds HOUGH_GRADIENT (and hough_accumulator) use, so the
+    # edges are those the Hough circles were found on
+    edges = cv2.Canny(image[y0:y1, x0:x1], max(1, canny_threshold / 2.0),
+                      canny_threshold)
+    py, px = np.nonzero(edges)
+    px = px.astype(np.float64) + x0
+    py = py.astype(np.float64) + y0
+
+    refined = [refine_circle(px, py, c, b) for c, b in zip(circles, bands)]
+    refined += [None] * (2 - len(refined))
+
+    return tuple(refined)
+
+
+def refine_circle(px, py, circle, band):
+    """
+    Fits a circle to the edge points (px, py) within band of circle,
+    rejecting outliers, and repeats around the fit. Returns the fit (x, y, r)
+    or circle if it cannot be fit reliably.
+    """
+    x, y, r = [float(v) for v in circle[:3]]
+    fit = None
+
+    for _ in range(ITERATIONS):
+        residuals = np.hypot(px - x, py - y) - r
+        near = np.abs(residuals) <= band
+        if not _enough_points(px[near], py[near], x, y):
+            break
+
+        nx, ny = px[near], py[near]
+        fit = taubin_fit(nx, ny)
+        if fit is None:
+            break
+
+        # Drop points off the fitted circle, e.g. edges of the other disk
+        # where the sun and moon overlap, and fit again
+        residuals = np.hypot(nx - fit[0], ny - fit[1]) - fit[2]
+        median = np.median(residuals)
+        sigma = MAD_TO_SIGMA * np.median(np.abs(residuals - median))
+
+        inliers = np.abs(residuals - median) <= max(OUTLIER_SIGMAS * sigma,
+                                                    0.5)
+        if not _enough_points(nx[inliers], ny[inliers], *fit[:2]):
+            fit = None
+            break
+
+        fit = taubin_fit(nx[inliers], ny[inliers])
+        if fit is None:
+            break
+
+        x, y, r = fit
+        band = max(BAND_MIN, OUTLIER_SIGMAS * sigma)
+
+    if fit is None:
+        return circle
+
+    x0, y0, r0 = [float(v) for v in circle[:3]]
+    if math.hypot(x - x0, y - y0) > MAX_CHANGE * r0 or \
+       abs(r - r0) > MAX_CHANGE * r0:
+        return circle
+
+    return (x, y, r)
+
+
+def taubin_fit(x, y):
+    """
+    Algebraic circle fit of Taubin (1991) to the points (x, y), using
+    Newton's method on its characteristic polynomial as in Chernov's
+    implementation. Unlike the simpler Kasa fit, it does not shrink circles
+    fit to short arcs. Returns (x, y, r), or None if the points are
+    collinear.
+    """
+    xm = x.mean()
+    ym = y.mean()
+    u = x - xm
+    v = y - ym
+    z = u * u + v * v
+
+    Mxx = np.mean(u * u)
+    Myy = np.mean(v * v)
+    Mxy = np.mean(u * v)
+    Mxz = np.mean(u * z)
+    Myz = np.mean(v * z)
+    Mzz = np.mean(z * z)
+
+    Mz = Mxx + Myy
+    Cov_xy = Mxx * Myy - Mxy * Mxy
+    Var_z = Mzz - Mz * Mz
+
+    A3 = 4 * Mz
+    A2 = -3 * Mz * Mz - Mzz
+    A1 = Var_z * Mz + 4 * Cov_xy * Mz - Mxz * Mxz - Myz * Myz
+    A0 = Mxz * (Mxz * Myy - Myz * Mxy) + Myz * (Myz * Mxx - Mxz * Mxy) - \
+         Var_z * Cov_xy
+
+    # Newton's method from 0 finds the root giving the fit
+    root = 0.0
+    value = float('inf')
+    for _ in range(NEWTON_ITERATIONS):
+        previous = value
+        value = A0 + root * (A1 + root * (A2 + root * A3))
+        if abs(value) > abs(previous):
+            root = 0.0
+            break
+
+        slope = A1 + root * (2 * A2 + root * 3 * A3)
+        if slope == 0:
+            break
+
+        previous_root = root
+        root = previous_root - value / slope
+        if root == 0 or abs((root - previous_root) / root) < NEWTON_EPSILON:
+            break
+
+    det = root * root - root * Mz + Cov_xy
+    if det == 0:
+        return None
+
+    cx = (Mxz * (Myy - root) - Myz * Mxy) / det / 2
+    cy = (Myz * (Mxx - root) - Mxz * Mxy) / det / 2
+
+    return (float(cx + xm), float(cy + ym), float(math.sqrt(cx * cx + cy * cy
+                                                            + Mz)))
+
+
+def _enough_points(x, y, cx, cy):
+    """
+    Whether the points (x, y) are many and spread enough around (cx, cy) to
+    fit a circle to.
+    """
+    if len(x) < MIN_POINTS:
+        return False
+
+    angles = np.arctan2(y - cy, x - cx)
+    bins = np.floor((angles + math.pi) / (2 * math.pi) * ANGLE_BINS)
+    return len(np.unique(bins)) >= MIN_ANGLE_BINS
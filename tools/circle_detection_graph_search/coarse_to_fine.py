@@ -0,0 +1,231 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+import cv2
+import numpy as np
+
+import instrumentation
+from circle_refine import BAND_DP
+from circle_refine import BAND_MIN
+from circle_refine import refine_circle
+from detect_circles import HOUGH_OPENCV
+from detect_circles import compute_resized_dims
+from detect_circles import detect_image_circles
+from detect_circles import find_circles
+from detect_circles import preprocess_config
+from image_pyramid import ImagePyramid
+
+
+DEFAULT_COARSE_BOUND    = 400
+
+# Tracked radii are searched within this fraction of the previous radius
+RADIUS_TOLERANCE        = 0.15
+
+# Margin, as a fraction of the previous radius, left around the largest
+# searched circle when cropping the tracked region
+ROI_PADDING             = 0.1
+
+
+def scale_config(config, size_bound):
+    """
+    Adapts config to images bounded by size_bound instead of
+    config.size_bound, scaling everything measured in pixels: blur kernel
+    sizes and sigmas, minDist and the radius bounds. param2 is kept, as
+    lowering the vote threshold with the resolution lets the coarse pass
+    fire on noise.
+    """
+    ratio = float(size_bound) / config.size_bound
+
+    return config._replace(
+        size_bound              = size_bound,
+        unsharp_blur_ksize      = _scale_ksize(config.unsharp_blur_ksize,
+                                               ratio),
+        unsharp_blur_sigmaXY    = _scale_sigma(config.unsharp_blur_sigmaXY,
+                                               ratio),
+        blur_ksize              = _scale_ksize(config.blur_ksize, ratio),
+        blur_sigmaXY            = _scale_sigma(config.blur_sigmaXY, ratio),
+        minDist                 = max(1, int(round(config.minDist * ratio))),
+        minRadius               = int(round(config.minRadius * ratio)),
+        maxRadius               = int(round(config.maxRadius * ratio)),
+    )
+
+
+def detect_coarse_to_fine(image, config, coarse_bound=DEFAULT_COARSE_BOUND,
+                          hough_method=HOUGH_OPENCV):
+    """
+    Two stage version of detect_circles.detect_image_circles for an image at
+    its original resolution. The circles are first found on the image
+    resized to coarse_bound with area averaging. Each of them (at most two)
+    is then fit to the edges of the original resolution image within a
+    narrow band around it (see refine_coarse), with config scaled to that
+    resolution. Circles that cannot be fit keep their coarse estimate. Returns (circle1, circle2) in original image
+    coordinates, in the order of the coarse pass. image may be an
+    image_pyramid.ImagePyramid whose base is the original resolution.
+    """
+    if isinstance(image, ImagePyramid):
+        image = image.base
+
+    # Unlike the linear interpolation of detect_circles.resize_image, area
+    # averaging keeps the noise of a large image from aliasing into votes
+    with instrumentation.stage('resize'):
+        small = cv2.resize(image, compute_resized_dims(image, coarse_bound,
+                                                       coarse_bound),
+                           interpolation=cv2.INTER_AREA)
+
+    coarse = scale_config(config, coarse_bound)
+    candidates = [c for c in detect_image_circles(small, coarse,
+                                                  original_shape=image.shape,
+                                                  hough_method=hough_method)
+                  if c is not None]
+
+    fine = scale_config(config, max(image.shape[:2]))
+
+    # The coarse circles are off by about an accumulator cell of the coarse
+    # image
+    scale = float(max(image.shape[:2])) / coarse_bound
+    band = max(BAND_MIN, BAND_DP * coarse.dp * scale)
+
+    refined = [refine_coarse(image, fine, c, band) for c in candidates]
+
+    refined += [None] * (2 - len(refined))
+    return tuple(refined)
+
+
+def refine_coarse(image, config, circle, band):
+    """
+    Fits circle, an (x, y, r) estimate, to the Canny edges (with the Hough
+    param1 thresholds) of image within band pixels of it, with
+    circle_refine.refine_circle. Only the region around circle is
+    preprocessed, with config scaled to the resolution of image. Returns
+    the fit, or circle if it cannot be fit reliably.
+    """
+    x, y, r = circle
+    height, width = image.shape[:2]
+
+    x0 = max(0, int(math.floor(x - r - band)) - 1)
+    y0 = max(0, int(math.floor(y - r - band)) - 1)
+    x1 = min(width, int(math.ceil(x + r + band)) + 2)
+    y1 = min(height, int(math.ceil(y + r + band)) + 2)
+
+    if x1 <= x0 or y1 <= y0 or r <= 0:
+        return circle
+
+    roi = image[y0:y1, x0:x1]
+
+    # A size bound equal to the region's larger dimension makes
+    # preprocess_image skip the resize
+    processed = preprocess_config(roi, config._replace(
+        size_bound=max(roi.shape[:2])))
+
+    with instrumentation.stage('refine'):
+        edges = cv2.Canny(processed, max(1, config.param1 / 2.0),
+                          config.param1)
+        py, px = np.nonzero(edges)
+
+        fit = refine_circle(px.astype(np.float64) + x0,
+                            py.astype(np.float64) + y0, circle, band)
+
+    return tuple(int(round(v)) for v in fit)
+
+
+def refine_candidates(image, config, candidates, hough_method=HOUGH_OPENCV):
+    """
+    Detects the circles closest to candidates, (x, y, r) estimates, within
+    the region of image around them, for radii within RADIUS_TOLERANCE of
+    theirs. config must be scaled to the resolution of image. Returns one
+    entry per candidate: (i, circle) for the circle the Hough transform
+    found i-th that it matched, or None if none did.
+    """
+    rois = [_roi(image, *c) for c in candidates]
+    x0 = min(r[0] for r in rois)
+    y0 = min(r[1] for r in rois)
+    x1 = max(r[2] for r in rois)
+    y1 = max(r[3] for r in rois)
+
+    if x1 <= x0 or y1 <= y0 or min(c[2] for c in candidates) <= 0:
+        return [None] * len(candidates)
+
+    roi = image[y0:y1, x0:x1]
+
+    # A size bound equal to the region's larger dimension makes
+    # preprocess_image skip the resize
+    processed = preprocess_config(roi, config._replace(
+        size_bound=max(roi.shape[:2])))
+
+    with instrumentation.stage('hough'):
+        circles = find_circles(
+            processed, config.dp, config.minDist, config.param1,
+            config.param2, min(_radius_range(c[2])[0] for c in candidates),
+            max(_radius_range(c[2])[1] for c in candidates), hough_method)
+    if circles is None:
+        circles = [[]]
+
+    matches = list()
+
+    for x, y, r in candidates:
+        best = None
+        for i, (cx, cy, cr) in enumerate(circles[0]):
+            min_radius, max_radius = _radius_range(r)
+            if not min_radius <= cr <= max_radius:
+                continue
+
+            d = (cx + x0 - x) ** 2 + (cy + y0 - y) ** 2 + (cr - r) ** 2
+            if best is None or d < best[0]:
+                best = (d, i)
+
+        if best is None or best[1] in [m[0] for m in matches if m]:
+            matches.append(None)
+            continue
+
+        cx, cy, cr = circles[0][best[1]]
+        matches.append((best[1], (int(round(cx + x0)), int(round(cy + y0)),
+                                  int(round(cr)))))
+
+    return matches
+
+
+def _radius_range(r):
+    return (int(math.floor(r * (1 - RADIUS_TOLERANCE))),
+            int(math.ceil(r * (1 + RADIUS_TOLERANCE))))
+
+
+def _roi(image, x, y, r):
+    """
+    (x0, y0, x1, y1) of the region searched around the circle (x, y, r).
+    """
+    half = int(math.ceil(_radius_range(r)[1] + r * ROI_PADDING))
+    height, width = image.shape[:2]
+
+    return (max(0, x - half), max(0, y - half),
+            min(width, x + half + 1), min(height, y + half + 1))
+
+
+def _scale_ksize(ksize, ratio):
+    if ksize <= 1:
+        return ksize
+
+    # Blur kernels must stay odd
+    scaled = int(round(ksize * ratio))
+    return max(1, scaled + (1 - scaled % 2))
+
+
+def _scale_sigma(sigma, ratio):
+    if sigma <= 0:
+        return sigma
+
+    # Keep an explicit sigma explicit, as 0 derives it from ksize
+    return max(1, int(round(sigma * ratio)))
@@ -0,0 +1,221 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+import circle_table
+from compute_imgproc_loss import read_eclipse_data_file
+
+
+DEFAULT_CUBE_FILE   = 'loss_cube.npz'
+DEFAULT_TOP         = 20
+
+# Set in each worker process by _init_worker
+_ground_truth = None
+
+
+class LossCube(object):
+    """
+    Dense (config x image) loss array. losses[i, j] is the loss of config i
+    on image j, or NaN if the config's output lacks the image.
+    """
+
+    def __init__(self, configs, images, types, losses):
+        self.configs = np.asarray(configs, dtype=np.str_)
+        self.images = np.asarray(images, dtype=np.str_)
+        self.types = np.asarray(types, dtype=np.str_)
+        self.losses = np.asarray(losses, dtype=np.float64)
+
+        # Image columns of each image type
+        self.type_index = dict(
+            (t, np.flatnonzero(self.types == t))
+            for t in np.unique(self.types).tolist())
+
+    def save(self, fpath):
+        np.savez(fpath, configs=self.configs, images=self.images,
+                 types=self.types, losses=self.losses)
+
+    @classmethod
+    def load(cls, fpath):
+        with np.load(fpath) as f:
+            return cls(f['configs'], f['images'], f['types'], f['losses'])
+
+    def scores(self, image_type=None):
+        """
+        Returns (total loss, mean loss, scored images) of every config,
+        over the images of image_type or all of them.
+        """
+        losses = self.losses
+        if image_type is not None:
+            losses = losses[:, self.type_index.get(image_type, [])]
+
+        scored = np.count_nonzero(~np.isnan(losses), axis=1)
+        total = np.nansum(losses, axis=1)
+        mean = total / np.maximum(scored, 1)
+        mean[scored == 0] = np.inf
+
+        return total, mean, scored
+
+    def leaderboard(self, image_type=None, top=DEFAULT_TOP):
+        """
+        Returns [(config, mean loss, total loss, scored images)] for the top
+        configs by mean loss over the images of image_type (or all images)
+        they were scored on. Configs missing images rank by those they have.
+        """
+        total, mean, scored = self.scores(image_type)
+        order = np.lexsort((np.arange(len(mean)), mean))[:top]
+
+        return [(str(self.configs[i]), float(mean[i]), float(total[i]),
+                 int(scored[i])) for i in order if scored[i] > 0]
+
+
+def score_files(ground_truth_file, files, processes=1):
+    """
+    Scores every output file (text or circle_table.py table) against the
+    ground truth at once. Returns a LossCube whose configs are the file
+    names.
+    """
+    truth = circle_table.table_from_eclipse_data(
+        read_eclipse_data_file(ground_truth_file))
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (truth, ))
+        try:
+            columns = pool.map(_read_columns, files, chunksize=8)
+        finally:
+            pool.terminate()
+    else:
+        _init_worker(truth)
+        columns = [_read_columns(f) for f in files]
+
+    # Stacks the (config x image x 3) circles and masks of all files and
+    # computes every loss at once, broadcasting the ground truth
+    if columns:
+        solar, solar_mask, lunar, lunar_mask, present = \
+            [np.stack(c) for c in zip(*columns)]
+
+        losses = circle_table.circle_losses(
+                     truth[circle_table.SOLAR_COL][None],
+                     truth[circle_table.SOLAR_MASK_COL][None],
+                     solar, solar_mask) + \
+                 circle_table.circle_losses(
+                     truth[circle_table.LUNAR_COL][None],
+                     truth[circle_table.LUNAR_MASK_COL][None],
+                     lunar, lunar_mask)
+        losses[~present] = np.nan
+    else:
+        losses = np.zeros((0, len(truth[circle_table.NAME_COL])))
+
+    return LossCube([os.path.basename(f) for f in files],
+                    truth[circle_table.NAME_COL],
+                    truth[circle_table.TYPE_COL], losses)
+
+
+def _init_worker(truth):
+    global _ground_truth
+    _ground_truth = truth
+
+
+def _read_columns(fpath):
+    """
+    Returns the solar and lunar circles and masks of the output file fpath,
+    aligned with the ground truth images, and the mask of the images it
+    has.
+    """
+    if circle_table.is_table_file(fpath):
+        table = circle_table.read_table(fpath)
+    else:
+        table = circle_table.table_from_eclipse_data(
+            read_eclipse_data_file(fpath))
+
+    n = len(_ground_truth[circle_table.NAME_COL])
+    exp_index, act_index = circle_table.align_tables(_ground_truth, table)
+
+    columns = list()
+    for col in (circle_table.SOLAR_COL, circle_table.SOLAR_MASK_COL,
+                circle_table.LUNAR_COL, circle_table.LUNAR_MASK_COL):
+        values = np.zeros((n, ) + table[col].shape[1:], dtype=table[col].dtype)
+        values[exp_index] = table[col][act_index]
+        columns.append(values)
+
+    present = np.zeros(n, dtype=bool)
+    present[exp_index] = True
+    columns.append(present)
+
+    return columns
+
+
+def _print_leaderboard(cube, image_type, top):
+    print('Top {} configs{}:'.format(
+        top, '' if image_type is None else ' for {} images'.format(image_type)))
+
+    for rank, (config, mean, total, scored) in enumerate(
+            cube.leaderboard(image_type, top)):
+        print('{:4d} {:12.1f} avg {:14.1f} total {:6d} images  {}'.format(
+            rank + 1, mean, total, scored, config))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Scores many output files against a ground truth file at '
+                    'once into a (config x image) loss cube, and prints '
+                    'leaderboards from it.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    score_parser = subparsers.add_parser('score')
+    score_parser.add_argument('ground_truth_file')
+    score_parser.add_argument('files', nargs='+')
+    score_parser.add_argument('--output', type=str, default=DEFAULT_CUBE_FILE)
+    score_parser.add_argument('--processes', type=int,
+                              default=multiprocessing.cpu_count())
+    score_parser.add_argument('--top', type=int, default=DEFAULT_TOP)
+
+    top_parser = subparsers.add_parser('top')
+    top_parser.add_argument('cube_file', nargs='?', default=DEFAULT_CUBE_FILE)
+    top_parser.add_argument('--type', type=str, default=None,
+                            help='rank on the images of this type only')
+    top_parser.add_argument('--top', type=int, default=DEFAULT_TOP)
+
+    args = parser.parse_args()
+
+    if args.command == 'score':
+        cube = score_files(args.ground_truth_file, args.files, args.processes)
+        cube.save(args.output)
+        print('Scored {} configs on {} images into {}'.format(
+            len(cube.configs), len(cube.images), args.output))
+        _print_leaderboard(cube, None, args.top)
+
+    elif args.command == 'top':
+        cube = LossCube.load(args.cube_file)
+
+        if args.type is not None and args.type not in cube.type_index:
+            print('Error: no {} images in {}'.format(args.type,
+                                                    args.cube_file),
+                  file=sys.stderr)
+            return
+
+        _print_leaderboard(cube, args.type, args.top)
+
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
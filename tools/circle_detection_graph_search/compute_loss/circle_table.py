@@ -0,0 +1,195 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+
+import numpy as np
+
+from compute_imgproc_loss import EXTRA_OR_MISSING_CIRCLE_COST
+from compute_imgproc_loss import read_eclipse_data_file
+from eclipse_image import EclipseImage
+
+
+TABLE_EXT           = '.npz'
+TEXT_EXT            = '.txt'
+
+# Columns of a circle table
+NAME_COL            = 'name'
+TYPE_COL            = 'type'
+SOLAR_COL           = 'solar'
+LUNAR_COL           = 'lunar'
+SOLAR_MASK_COL      = 'solar_mask'
+LUNAR_MASK_COL      = 'lunar_mask'
+
+
+def is_table_file(fpath):
+    return fpath.endswith(TABLE_EXT)
+
+
+def table_file_name(fpath):
+    """
+    Name of the circle table converted from the text file fpath. Only a .txt
+    extension is replaced, as output_run-{params} names contain dots.
+    """
+    if fpath.endswith(TEXT_EXT):
+        fpath = fpath[:-len(TEXT_EXT)]
+    return fpath + TABLE_EXT
+
+
+def make_table(names, types, solar_circles, lunar_circles):
+    """
+    Returns the columns of a circle table, a dict of equally long NumPy
+    arrays: image names and types, (n, 3) int32 solar and lunar circles
+    (x, y, r) and boolean masks that are True where the circle is present.
+    Missing circles (None) are stored as zeros.
+    """
+    solar, solar_mask = _circle_column(solar_circles)
+    lunar, lunar_mask = _circle_column(lunar_circles)
+
+    return {
+        NAME_COL:       np.array(names, dtype=np.str_).reshape(-1),
+        TYPE_COL:       np.array(types, dtype=np.str_).reshape(-1),
+        SOLAR_COL:      solar,
+        LUNAR_COL:      lunar,
+        SOLAR_MASK_COL: solar_mask,
+        LUNAR_MASK_COL: lunar_mask,
+    }
+
+
+def table_from_eclipse_data(data):
+    """
+    Circle table of a dict mapping image names to EclipseImages, as returned
+    by compute_imgproc_loss.read_eclipse_data_file.
+    """
+    names = list(data)
+    return make_table(names,
+                      [data[n].type for n in names],
+                      [data[n].solar_circle for n in names],
+                      [data[n].lunar_circle for n in names])
+
+
+def eclipse_data_from_table(table):
+    """
+    Inverse of table_from_eclipse_data.
+    """
+    data = dict()
+
+    solar = table[SOLAR_COL].tolist()
+    lunar = table[LUNAR_COL].tolist()
+    solar_mask = table[SOLAR_MASK_COL].tolist()
+    lunar_mask = table[LUNAR_MASK_COL].tolist()
+
+    for i, name in enumerate(table[NAME_COL].tolist()):
+        img                 = EclipseImage()
+        img.type            = str(table[TYPE_COL][i])
+        img.solar_circle    = tuple(solar[i]) if solar_mask[i] else None
+        img.lunar_circle    = tuple(lunar[i]) if lunar_mask[i] else None
+
+        data[name] = img
+
+    return data
+
+
+def write_table(fpath, table):
+    np.savez(fpath, **table)
+
+
+def read_table(fpath):
+    with np.load(fpath) as f:
+        return dict((col, f[col]) for col in f.files)
+
+
+def align_tables(exp_table, act_table):
+    """
+    Returns (exp_index, act_index), the rows of both tables for the image
+    names they share, in the order of exp_table.
+    """
+    act_rows = dict((n, i) for i, n in enumerate(act_table[NAME_COL].tolist()))
+
+    exp_index = list()
+    act_index = list()
+    for i, name in enumerate(exp_table[NAME_COL].tolist()):
+        if name in act_rows:
+            exp_index.append(i)
+            act_index.append(act_rows[name])
+
+    return (np.array(exp_index, dtype=np.intp),
+            np.array(act_index, dtype=np.intp))
+
+
+def circle_losses(exp, exp_mask, act, act_mask):
+    """
+    Vectorized compute_imgproc_loss._compute_circle_loss over the rows of
+    (n, 3) circle arrays and their presence masks.
+    """
+    d = exp.astype(np.float64) - act.astype(np.float64)
+    loss = d[..., 0] ** 2 + d[..., 1] ** 2 + (2 * d[..., 2]) ** 2
+
+    loss = np.where(exp_mask & act_mask, loss, 0.0)
+    return np.where(exp_mask != act_mask, EXTRA_OR_MISSING_CIRCLE_COST, loss)
+
+
+def table_losses(exp_table, act_table):
+    """
+    Returns (names, losses) of the images of exp_table also in act_table,
+    where losses are those of compute_imgproc_loss._compute_single_loss.
+    """
+    exp_index, act_index = align_tables(exp_table, act_table)
+
+    losses = circle_losses(exp_table[SOLAR_COL][exp_index],
+                           exp_table[SOLAR_MASK_COL][exp_index],
+                           act_table[SOLAR_COL][act_index],
+                           act_table[SOLAR_MASK_COL][act_index]) + \
+             circle_losses(exp_table[LUNAR_COL][exp_index],
+                           exp_table[LUNAR_MASK_COL][exp_index],
+                           act_table[LUNAR_COL][act_index],
+                           act_table[LUNAR_MASK_COL][act_index])
+
+    return exp_table[NAME_COL][exp_index], losses
+
+
+def _circle_column(circles):
+    values = np.zeros((len(circles), 3), dtype=np.int32)
+    mask = np.zeros(len(circles), dtype=bool)
+
+    for i, c in enumerate(circles):
+        if c is not None:
+            values[i] = c
+            mask[i] = True
+
+    return values, mask
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Converts pipe delimited ground truth or output_run '
+                    'files to {} circle tables, written next to '
+                    'them.'.format(TABLE_EXT))
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    for fpath in args.files:
+        if is_table_file(fpath):
+            continue
+
+        output = table_file_name(fpath)
+
+        write_table(output, table_from_eclipse_data(
+            read_eclipse_data_file(fpath)))
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
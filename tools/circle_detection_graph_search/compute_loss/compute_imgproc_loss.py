@@ -79,6 +79,17 @@ def compute_imgproc_loss(exp_data, act_data):
 
 
 def read_eclipse_data_file(fpath):
+    """
+    Returns a dict mapping image names to EclipseImages, read from a pipe
+    delimited file or a circle_table.py table.
+    """
+    # Imported here as circle_table itself depends on this module
+    import circle_table
+
+    if circle_table.is_table_file(fpath):
+        return circle_table.eclipse_data_from_table(
+            circle_table.read_table(fpath))
+
     data = dict()
 
     with open(fpath) as f:
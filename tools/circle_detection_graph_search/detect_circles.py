@@ -13,23 +13,79 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
+from contextlib import closing
+from contextlib import nullcontext
+import multiprocessing
 import os
 import sys
 import time
 
 import cv2
 
+import circle_hough_link
+import instrumentation
+from circle_refine import refine_circles
+from jpeg_decode import read_reduced
+from prefetch import DEFAULT_MAX_MB
+from prefetch import Prefetcher
+from hough_accumulator import HoughAccumulator
+from run_config import output_file_name
+from run_config import parse_config
+from run_config import VARIANT_SEP
+from run_config import pruned_file_name
+from scoring import image_loss
+from scoring import load_ground_truth
 
-def compute_circles(image, dp, minDist, param1, param2, minRadius, maxRadius):
+
+# Circle Hough transform implementations compute_circles can use
+HOUGH_OPENCV        = 'opencv'
+HOUGH_CHL           = 'chl'
+HOUGH_ACCUMULATOR   = 'accumulator'
+HOUGH_METHODS       = (HOUGH_OPENCV, HOUGH_CHL, HOUGH_ACCUMULATOR)
+
+# Set in each worker process by _init_worker
+_worker = None
+
+
+def compute_circles(image, dp, minDist, param1, param2, minRadius, maxRadius,
+                    hough_method=HOUGH_OPENCV):
+    with instrumentation.stage('hough'):
+        circles = find_circles(image, dp, minDist, param1, param2, minRadius,
+                               maxRadius, hough_method)
+
+    return extract_circles(circles)
+
+
+def find_circles(image, dp, minDist, param1, param2, minRadius, maxRadius,
+                 hough_method=HOUGH_OPENCV):
+    """
+    Returns all circles found by the hough_method circle Hough transform, as
+    an array shaped like the result of cv2.HoughCircles, or None.
+    """
+    if hough_method == HOUGH_CHL:
+        circles = circle_hough_link.hough_circles(image, dp, minDist, param1,
+                                                  param2, minRadius, maxRadius)
+    elif hough_method == HOUGH_ACCUMULATOR:
+        accumulator = HoughAccumulator(image, dp, param1,
+                                       [(minRadius, maxRadius)])
+        circles = accumulator.circles(param2, minRadius, maxRadius, minDist)
+    else:
+        circles = cv2.HoughCircles(image, cv2.HOUGH_GRADIENT, dp, minDist,
+                                   param1=param1, param2=param2,
+                                   minRadius=minRadius, maxRadius=maxRadius)
+
+    return circles
+
+
+def extract_circles(circles):
+    """
+    Returns the first two circles of a cv2.HoughCircles style result, or None
+    for those that are missing.
+    """
     circle1 = None
     circle2 = None
 
-    # Compute the circles
-    circles = cv2.HoughCircles(image, cv2.HOUGH_GRADIENT, dp, minDist,
-                               param1=param1, param2=param2,
-                               minRadius=minRadius, maxRadius=maxRadius)
-
-    # Extract the circles
     try:
         circle1 = circles[0][0]
     except (IndexError, TypeError):
@@ -61,33 +117,79 @@ def compute_resized_dims(image, max_w, max_h):
 def preprocess_image(image, size_bound, enable_unsharp, unsharp_blur_type,
                      unsharp_blur_ksize, unsharp_blur_sigmaXY,
                      unsharp_add_weight, unsharp_gamma,
-                     blur_type, blur_ksize, blur_sigmaXY):
-
+                     blur_type, blur_ksize, blur_sigmaXY,
+                     cache=None, image_key=None):
+    """
+    Runs the resize -> unsharp -> blur stages on image. If a
+    stage_cache.StageCache is passed in, every stage's output is cached
+    under image_key plus the parameters of all stages up to and including
+    it, so configurations sharing a prefix only compute it once per image.
+    """
     # Resize the image
-    processed = cv2.resize(image,
-                           compute_resized_dims(image, size_bound, size_bound))
+    key = (image_key, size_bound)
+    with instrumentation.stage('resize'):
+        processed = _cached_stage(cache, key, resize_image, image, size_bound)
 
     # Add unsharp mask
     if enable_unsharp:
-
-        # Blur image to subtract from original
-        blurred = _apply_blur(processed, unsharp_blur_type, unsharp_blur_ksize,
-                              unsharp_blur_sigmaXY)
-
-        # Apply the unsharp mask
-        processed = cv2.addWeighted(processed, 1 + unsharp_add_weight,
-                                    blurred, unsharp_add_weight - 1,
-                                    unsharp_gamma)
+        with instrumentation.stage('unsharp'):
+
+            # Blur image to subtract from original. It only depends on the
+            # resized image, so it is shared between unsharp weights
+            blurred = _cached_stage(cache,
+                                    key + ('unsharp_blur', unsharp_blur_type,
+                                           unsharp_blur_ksize,
+                                           unsharp_blur_sigmaXY),
+                                    _apply_blur, processed, unsharp_blur_type,
+                                    unsharp_blur_ksize, unsharp_blur_sigmaXY)
+
+            # Apply the unsharp mask
+            key = key + ('unsharp', unsharp_blur_type, unsharp_blur_ksize,
+                         unsharp_blur_sigmaXY, unsharp_add_weight,
+                         unsharp_gamma)
+            processed = _cached_stage(cache, key, cv2.addWeighted,
+                                      processed, 1 + unsharp_add_weight,
+                                      blurred, unsharp_add_weight - 1,
+                                      unsharp_gamma)
 
     # Apply final blur
-    processed = _apply_blur(processed, blur_type, blur_ksize, blur_sigmaXY)
+    key = key + ('blur', blur_type, blur_ksize, blur_sigmaXY)
+    with instrumentation.stage('blur'):
+        processed = _cached_stage(cache, key, _apply_blur, processed,
+                                  blur_type, blur_ksize, blur_sigmaXY)
 
     return processed
 
 
+def resize_image(image, size_bound):
+    """
+    Resizes image to fit in size_bound x size_bound. Images that already
+    have those dimensions (such as those read from an image_store pack) are
+    returned as is. An image_pyramid.ImagePyramid is resized from its
+    closest level.
+    """
+    # Imported here as image_pyramid itself depends on this module
+    from image_pyramid import ImagePyramid
+
+    if isinstance(image, ImagePyramid):
+        return image.get(size_bound)
+
+    dims = compute_resized_dims(image, size_bound, size_bound)
+
+    if dims == (image.shape[1], image.shape[0]):
+        return image
+
+    return cv2.resize(image, dims)
+
+
 def scale_circles(circle1, circle2, original, resized):
+    return scale_circles_to_shape(circle1, circle2, original.shape,
+                                  resized.shape)
+
 
-    ratio = float(original.shape[0]) / float(resized.shape[0])
+def scale_circles_to_shape(circle1, circle2, original_shape, resized_shape):
+
+    ratio = float(original_shape[0]) / float(resized_shape[0])
 
     if circle1 is not None:
         circle1 = tuple([int(round(ratio * i)) for i in circle1])
@@ -98,6 +200,140 @@ def scale_circles(circle1, circle2, original, resized):
     return circle1, circle2
 
 
+def preprocess_config(image, config, cache=None, image_key=None):
+    """
+    Runs preprocess_image with the parameters of a run_config.Config.
+    """
+    return preprocess_image(
+        image,
+        config.size_bound,
+        config.enable_unsharp,
+        config.unsharp_blur_type,
+        config.unsharp_blur_ksize,
+        config.unsharp_blur_sigmaXY,
+        config.unsharp_add_weight,
+        config.unsharp_gamma,
+        config.blur_type,
+        config.blur_ksize,
+        config.blur_sigmaXY,
+        cache=cache,
+        image_key=image_key,
+    )
+
+
+def detect_image_circles(image, config, cache=None, image_key=None,
+                         original_shape=None, hough_method=HOUGH_OPENCV,
+                         refine=False, joint=False):
+    """
+    Runs the full detection pipeline for one run_config.Config on a decoded
+    grayscale image. Returns (circle1, circle2) in original image
+    coordinates. cache and image_key are passed on to preprocess_image.
+    original_shape is needed when image has already been resized.
+    hough_method is passed on to compute_circles. With joint, the solar and
+    lunar disks are found by joint_detection.detect_sun_moon instead. With
+    refine, the circles are refined by a least squares fit to the edges
+    around them (see circle_refine.py).
+    """
+    if original_shape is None:
+        original_shape = image.shape
+
+    processed = preprocess_config(image, config, cache, image_key)
+
+    if joint:
+        # Imported here as joint_detection itself depends on this module
+        from joint_detection import detect_sun_moon
+
+        circle1, circle2 = detect_sun_moon(processed, config, hough_method)
+    else:
+        circle1, circle2 = compute_circles(
+            processed,
+            config.dp,
+            config.minDist,
+            config.param1,
+            config.param2,
+            config.minRadius,
+            config.maxRadius,
+            hough_method,
+        )
+
+    if refine:
+        with instrumentation.stage('refine'):
+            circle1, circle2 = refine_circles(processed, circle1, circle2,
+                                              config.dp, config.param1)
+
+    # Scale circles to fit on original image dimensions
+    with instrumentation.stage('scale'):
+        return scale_circles_to_shape(circle1, circle2, original_shape,
+                                      processed.shape)
+
+
+def read_image(image_dir, imname, size_bound, store=None, reduced=False):
+    """
+    Returns (image, original_shape) for imname, or (None, None) if it could
+    not be read. Images found in store (an image_store.ImageStore) are
+    returned already resized to size_bound. With reduced, JPEGs are decoded
+    at the smallest scale that still covers size_bound (see jpeg_decode.py).
+    """
+    with instrumentation.stage('decode'):
+        if store is not None:
+            image, original_shape = store.load(imname, size_bound)
+            if image is not None:
+                return image, original_shape
+
+        if reduced:
+            return read_reduced(os.path.join(image_dir, imname), size_bound)
+
+        image = cv2.imread(os.path.join(image_dir, imname),
+                           cv2.IMREAD_GRAYSCALE)
+
+    if image is None:
+        return None, None
+
+    return image, image.shape
+
+
+def result_variant(hough_method=HOUGH_OPENCV, refine=False, joint=False,
+                   coarse_bound=None, track=False):
+    """
+    Tag of the detection variant results were found with, as passed to
+    run_config.result_key. Results of the default pipeline have none, so
+    they keep their plain output file names and ledger fingerprints.
+    """
+    tags = list()
+    if hough_method != HOUGH_OPENCV:
+        tags.append(hough_method)
+    if coarse_bound is not None:
+        tags.append('coarse{}'.format(coarse_bound))
+    if track:
+        tags.append('track')
+    if refine:
+        tags.append('refine')
+    if joint:
+        tags.append('joint')
+
+    return VARIANT_SEP.join(tags)
+
+
+def format_output_line(imname, circle1, circle2):
+    """
+    One line of an output_run-{params} file.
+    """
+    # NC for 'Not classified'
+    return '|'.join([str(i) for i in [imname, 'NC', circle1, circle2]]) + '\n'
+
+
+def _cached_stage(cache, key, stage, *args):
+    if cache is None:
+        return stage(*args)
+
+    result = cache.get(key)
+    if result is None:
+        result = stage(*args)
+        cache.put(key, result)
+
+    return result
+
+
 def _apply_blur(image, blur_type, ksize, sigmaXY):
     # Use gaussian blur
     if blur_type == 'g':
@@ -118,6 +354,250 @@ def _apply_blur(image, blur_type, ksize, sigmaXY):
     return blurred
 
 
+def detect_images(images, image_dir, config, image_store=None, processes=1,
+                  hough_method=HOUGH_OPENCV, coarse_bound=None,
+                  instrument=None, track_memory=False, reduced_decode=False,
+                  prefetch=0, prefetch_mb=DEFAULT_MAX_MB, track=False,
+                  refine=False, joint=False):
+    """
+    Yields (imname, circle1, circle2) for every image in images, in order.
+    Images that cannot be read are reported and skipped. With processes > 1
+    the images are spread over a process pool; closing the generator early
+    terminates the pool. image_store is the path of an image_store.py pack
+    file to read the images from. With a coarse_bound, circles are detected
+    by coarse_to_fine.detect_coarse_to_fine on the original images instead.
+    With an instrument path, every process appends an instrumentation.py
+    record of the stages run on each image to it. reduced_decode is passed
+    on to read_image. With processes == 1 and prefetch > 0, up to prefetch
+    of the next images are decoded on background threads (holding at most
+    about prefetch_mb MB) while the current one is processed. With track
+    (and processes == 1), images are grouped into sequences and processed
+    in capture order, each frame searched around the circles of the previous
+    one (see sequence_tracking.py). refine and joint are passed on to
+    detect_image_circles.
+    """
+    pool = None
+    prefetcher = None
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (image_dir, config, image_store,
+                                     hough_method, coarse_bound, instrument,
+                                     track_memory, reduced_decode, refine,
+                                     joint))
+        detections = pool.imap(_detect_image, images)
+    elif track:
+        # Imported here as sequence_tracking itself depends on this module
+        from sequence_tracking import SequenceTracker
+        from sequence_tracking import frame_sequences
+
+        _init_worker(image_dir, config, image_store, hough_method,
+                     coarse_bound, instrument, track_memory, reduced_decode,
+                     refine, joint)
+
+        frames = [(imname, i == 0)
+                  for sequence in frame_sequences(images, image_dir)
+                  for i, imname in enumerate(sequence)]
+
+        tracker = SequenceTracker(config, hough_method)
+
+        if prefetch > 0:
+            prefetcher = Prefetcher(frames, _prefetch_frame, prefetch,
+                                    prefetch_mb)
+            detections = (_detect_tracked(tracker, imname, first, loaded)
+                          for (imname, first), loaded in prefetcher)
+        else:
+            detections = (_detect_tracked(tracker, imname, first)
+                          for imname, first in frames)
+    elif prefetch > 0:
+        _init_worker(image_dir, config, image_store, hough_method,
+                     coarse_bound, instrument, track_memory, reduced_decode,
+                     refine, joint)
+        prefetcher = Prefetcher(images, _prefetch_image, prefetch,
+                                prefetch_mb)
+        detections = (_detect_prefetched(imname, loaded)
+                      for imname, loaded in prefetcher)
+    else:
+        _init_worker(image_dir, config, image_store, hough_method,
+                     coarse_bound, instrument, track_memory, reduced_decode,
+                     refine, joint)
+        detections = map(_detect_image, images)
+
+    try:
+        for imname, circles in detections:
+            if circles is None:
+                print('Error: {} could not be read'.format(
+                          os.path.join(image_dir, imname)),
+                      file=sys.stderr)
+                continue
+
+            yield (imname, ) + circles
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if prefetcher is not None:
+            prefetcher.close()
+
+
+def _init_worker(image_dir, config, image_store, hough_method, coarse_bound,
+                 instrument=None, track_memory=False, reduced_decode=False,
+                 refine=False, joint=False):
+    global _worker
+
+    if instrument is not None:
+        instrumentation.enable(instrument, track_memory)
+
+    store = None
+    if image_store is not None:
+        # Imported here as image_store itself depends on this module
+        from image_store import ImageStore
+        store = ImageStore(image_store)
+
+    _worker = {
+        'image_dir':        image_dir,
+        'config':           config,
+        'store':            store,
+        'hough_method':     hough_method,
+        'coarse_bound':     coarse_bound,
+        'reduced_decode':   reduced_decode,
+        'refine':           refine,
+        'joint':            joint,
+    }
+
+
+def _detect_image(imname):
+    with instrumentation.record(image=imname):
+        return _detect_loaded(imname, _load_image(imname))
+
+
+def _prefetch_image(imname):
+    # Runs on a Prefetcher thread, so its decode stage gets its own record
+    with instrumentation.record(image=imname, prefetched=True):
+        return _load_image(imname)
+
+
+def _detect_prefetched(imname, loaded):
+    with instrumentation.record(image=imname):
+        return _detect_loaded(imname, loaded)
+
+
+def _prefetch_frame(frame):
+    return _prefetch_image(frame[0])
+
+
+def _detect_tracked(tracker, imname, first, loaded=None):
+    # Frames that were not prefetched are decoded within their record, as
+    # in _detect_image
+    with instrumentation.record(image=imname):
+        if loaded is None:
+            loaded = _load_image(imname)
+
+        image, original_shape = loaded
+        if image is None or first:
+            tracker.reset()
+        if image is None:
+            return imname, None
+
+        return imname, tracker.detect(image, original_shape)
+
+
+def _load_image(imname):
+    """
+    Returns the (image, original_shape) _detect_loaded needs for imname, or
+    (None, None) if it could not be read.
+    """
+    image_dir = _worker['image_dir']
+
+    if _worker['coarse_bound'] is not None:
+        # Refinement needs the original resolution, which the store lacks
+        with instrumentation.stage('decode'):
+            image = cv2.imread(os.path.join(image_dir, imname),
+                               cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            return None, None
+
+        return image, image.shape
+
+    return read_image(image_dir, imname, _worker['config'].size_bound,
+                      _worker['store'], _worker['reduced_decode'])
+
+
+def _detect_loaded(imname, loaded):
+    config = _worker['config']
+    hough_method = _worker['hough_method']
+
+    image, original_shape = loaded
+    if image is None:
+        return imname, None
+
+    if _worker['coarse_bound'] is not None:
+        # Imported here as coarse_to_fine itself depends on this module
+        from coarse_to_fine import detect_coarse_to_fine
+
+        return imname, detect_coarse_to_fine(image, config,
+                                             _worker['coarse_bound'],
+                                             hough_method)
+
+    return imname, detect_image_circles(image, config,
+                                        original_shape=original_shape,
+                                        hough_method=hough_method,
+                                        refine=_worker['refine'],
+                                        joint=_worker['joint'])
+
+
+def _parse_options(argv):
+    parser = argparse.ArgumentParser(
+        prog='detect_circles.py image_list.txt image_dir <params...>')
+    parser.add_argument('--image-store', type=str, default=None)
+    parser.add_argument('--ground-truth', type=str, default=None)
+    parser.add_argument('--loss-budget', type=float, default=None)
+    parser.add_argument('--ledger', type=str, default=None)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--hough-method', choices=HOUGH_METHODS,
+                        default=HOUGH_OPENCV)
+    parser.add_argument('--coarse-bound', type=int, default=None)
+    parser.add_argument('--reduced-decode', action='store_true')
+    parser.add_argument('--prefetch', type=int, default=0)
+    parser.add_argument('--prefetch-mb', type=int, default=DEFAULT_MAX_MB)
+    parser.add_argument('--track', action='store_true')
+    parser.add_argument('--refine', action='store_true')
+    parser.add_argument('--joint', action='store_true')
+    parser.add_argument('--instrument', type=str, default=None)
+    parser.add_argument('--track-memory', action='store_true')
+    parser.add_argument('--profile', type=str, default=None)
+    parser.add_argument('--profile-interval', type=float,
+                        default=instrumentation.DEFAULT_SAMPLE_INTERVAL)
+    options = parser.parse_args(argv)
+
+    if options.track_memory and options.instrument is None:
+        parser.error('--track-memory requires --instrument')
+
+    if options.profile is not None and options.processes > 1:
+        parser.error('--profile requires --processes 1')
+
+    if options.prefetch > 0 and options.processes > 1:
+        parser.error('--prefetch requires --processes 1')
+
+    if options.track and options.processes > 1:
+        parser.error('--track requires --processes 1')
+
+    if options.track and options.coarse_bound is not None:
+        parser.error('--track and --coarse-bound are exclusive')
+
+    if options.refine and (options.track or options.coarse_bound is not None):
+        parser.error('--refine cannot be combined with --track or '
+                     '--coarse-bound')
+
+    if options.joint and (options.track or options.coarse_bound is not None):
+        parser.error('--joint cannot be combined with --track or '
+                     '--coarse-bound')
+
+    if options.loss_budget is not None and options.ground_truth is None:
+        parser.error('--loss-budget requires --ground-truth')
+
+    return options
+
+
 def main():
     """
     params:
@@ -140,54 +620,97 @@ def main():
         param2                  int
         minRadius               int
         maxRadius               int
+
+    options (after the params above):
+        --image-store           path to an image_store.py pack file to read
+                                the images from instead of image_dir
+        --ground-truth          ground truth file to compute the loss of each
+                                image against as it is processed
+        --loss-budget           float. Stop as soon as the total loss exceeds
+                                it and write the results so far to
+                                pruned_run-{params} instead of
+                                output_run-{params}. Requires --ground-truth
+        --ledger                path to a results_ledger.py database to record
+                                the results in instead of an output file.
+                                Configs already recorded in it are skipped
+        --processes             int. Number of processes to spread the images
+                                over (default 1). Output stays in image
+                                list order
+        --hough-method          opencv/chl/accumulator. Circle Hough
+                                transform to use: cv2.HoughCircles
+                                (default), the circle_hough_link.py port of
+                                CircleHoughLink or hough_accumulator.py
+        --coarse-bound          int. Find the circles on the image resized to
+                                this bound, then refine them around each
+                                circle at the original resolution (see
+                                coarse_to_fine.py)
+        --reduced-decode        decode JPEGs at 1/2, 1/4 or 1/8 scale when
+                                that still covers size_bound, instead of
+                                decoding them in full and then resizing
+        --prefetch              int. Decode up to this many of the next
+                                images on background threads while the
+                                current one is processed (default 0, off).
+                                Requires --processes 1
+        --prefetch-mb           int. Only start decoding ahead while the
+                                decoded images waiting, and those being
+                                decoded, fit in this many MB (default 1024)
+        --track                 group the images into sequences by EXIF
+                                camera and capture time, and search each
+                                frame only around the circles of the
+                                previous one, falling back to a full search
+                                when they are lost (see
+                                sequence_tracking.py). Output is in capture
+                                order. Requires --processes 1
+        --refine                refine the circles found by the Hough
+                                transform with a least squares fit to the
+                                edge points around them (see
+                                circle_refine.py)
+        --joint                 find the strongest circle, then search for
+                                the second one only around it and with a
+                                similar radius, and label them as solar and
+                                lunar by brightness (see joint_detection.py)
+        --instrument            path of a JSON lines file to append the wall
+                                time, CPU time and call count of each stage
+                                (decode, resize, unsharp, blur, hough,
+                                second_disk, refine, scale) to, one record
+                                per image
+        --track-memory          also record the peak memory allocated by
+                                each stage. Requires --instrument
+        --profile               path to write the collapsed stacks of a
+                                sampling profiler to, for flamegraph.pl.
+                                Requires --processes 1
+        --profile-interval      float. Seconds between profiler samples
+                                (default 0.005)
     """
     t = time.time()
 
     try:
         image_list                  = sys.argv[1]
         image_dir                   = sys.argv[2]
-        size_bound                  = int(sys.argv[3])
-        enable_unsharp              = sys.argv[4] == '1'
-        unsharp_blur_type           = sys.argv[5]
-        unsharp_blur_ksize          = int(sys.argv[6])
-        unsharp_blur_sigmaXY        = int(sys.argv[7])
-        unsharp_add_weight          = float(sys.argv[8])
-        unsharp_gamma               = int(sys.argv[9])
-        blur_type                   = sys.argv[10]
-        blur_ksize                  = int(sys.argv[11])
-        blur_sigmaXY                = int(sys.argv[12])
-        dp                          = int(sys.argv[13])
-        minDist                     = int(sys.argv[14])
-        param1                      = int(sys.argv[15])
-        param2                      = int(sys.argv[16])
-        minRadius                   = int(sys.argv[17])
-        maxRadius                   = int(sys.argv[18])
+        config                      = parse_config(sys.argv[3:19])
 
     except IndexError:
         print('Error: missing arguments', file=sys.stderr)
         return
 
-    output_file = '_'.join(
-        [str(i) for i in [
-            size_bound,
-            enable_unsharp,
-            unsharp_blur_type,
-            unsharp_blur_ksize,
-            unsharp_blur_sigmaXY,
-            unsharp_add_weight,
-            unsharp_gamma,
-            blur_type,
-            blur_ksize,
-            blur_sigmaXY,
-            dp,
-            minDist,
-            param1,
-            param2,
-            minRadius,
-            maxRadius
-        ]
-    ])
-    output_file = 'output_run-' + output_file
+    options = _parse_options(sys.argv[19:])
+    variant = result_variant(options.hough_method, options.refine,
+                             options.joint, options.coarse_bound,
+                             options.track)
+
+    ground_truth = None
+    if options.ground_truth is not None:
+        ground_truth = load_ground_truth(options.ground_truth)
+
+    ledger = None
+    if options.ledger is not None:
+        # Imported here as results_ledger itself depends on this module
+        from results_ledger import ResultsLedger
+        ledger = ResultsLedger(options.ledger)
+
+        if ledger.is_complete(config, variant):
+            print('Already recorded in {}'.format(options.ledger))
+            return
 
     images = list()
     with open(image_list) as f:
@@ -197,61 +720,70 @@ def main():
         print('Error: no images found', file=sys.stderr)
         return
 
-    with open(output_file, 'w') as f:
-
-        i = 0
-
-        for imname in images:
-
-            impath = os.path.join(image_dir, imname)
-            image  = cv2.imread(impath, cv2.IMREAD_GRAYSCALE)
-            if image is None:
-                print('Error: {} could not be read'.format(impath),
-                      file=sys.stderr)
-
-            processed = preprocess_image(
-                image,
-                size_bound,
-                enable_unsharp,
-                unsharp_blur_type,
-                unsharp_blur_ksize,
-                unsharp_blur_sigmaXY,
-                unsharp_add_weight,
-                unsharp_gamma,
-                blur_type,
-                blur_ksize,
-                blur_sigmaXY,
-            )
-
-            circle1, circle2 = compute_circles(
-                processed,
-                dp,
-                minDist,
-                param1,
-                param2,
-                minRadius,
-                maxRadius
-            )
-
-            # DEBUG
-            # cv2.circle(processed, tuple(circle1[:2]), circle1[2],
-            #            (255, 255, 255), thickness=1, lineType=8)
-            # cv2.circle(processed, tuple(circle2[:2]), circle2[2],
-            #            (255, 255, 255), thickness=1, lineType=8)
-
-            # Scale circles to fit on original image dimensions
-            circle1, circle2 = scale_circles(circle1, circle2, image, processed)
-
-            # DEBUG
-            # print(tuple(circle1), tuple(circle2))
-            # cv2.circle(image, tuple(circle1[:2]), circle1[2],
-            #            (0, 255, 0), thickness=1, lineType=8)
-            # cv2.circle(image, tuple(circle2[:2]), circle2[2],
-            #            (0, 255, 0), thickness=1, lineType=8)
-
-            # NC for 'Not classified'
-            output = '|'.join([str(i) for i in [imname, 'NC', circle1, circle2]])
-            f.write(output + '\n')
+    # Results are only buffered for the ledger, which records a config in
+    # one transaction. Output files are written line by line, so a run
+    # killed part way leaves the lines of the images it finished.
+    results     = list()
+    output_file = output_file_name(config, variant)
+    n_done      = 0
+    total_loss  = 0
+    pruned      = False
+
+    profiler = None
+    if options.profile is not None:
+        profiler = instrumentation.SamplingProfiler(options.profile_interval)
+        profiler.start()
+
+    with closing(detect_images(images, image_dir, config, options.image_store,
+                               options.processes, options.hough_method,
+                               options.coarse_bound, options.instrument,
+                               options.track_memory,
+                               options.reduced_decode, options.prefetch,
+                               options.prefetch_mb, options.track,
+                               options.refine,
+                               options.joint)) as detections, \
+         (nullcontext() if ledger is not None
+          else open(output_file, 'w')) as f:
+
+        for imname, circle1, circle2 in detections:
+
+            if f is None:
+                results.append((imname, circle1, circle2))
+            else:
+                f.write(format_output_line(imname, circle1, circle2))
+
+                # So live_leaderboard.py can follow the run
+                f.flush()
+            n_done += 1
+
+            if ground_truth is not None and imname in ground_truth:
+                total_loss += image_loss(ground_truth[imname], circle1,
+                                         circle2)
+
+            if options.loss_budget is not None and \
+               total_loss > options.loss_budget:
+                pruned = True
+                break
+
+    if profiler is not None:
+        profiler.stop()
+        profiler.dump(options.profile)
+
+    if ledger is not None:
+        # Imported here as results_ledger itself depends on this module
+        from results_ledger import STATUS_DONE
+        from results_ledger import STATUS_PRUNED
+
+        ledger.record(config, results, time.time() - t,
+                      STATUS_PRUNED if pruned else STATUS_DONE, variant)
+    elif pruned:
+        os.rename(output_file, pruned_file_name(config, variant))
+
+    if pruned:
+        print('Pruned after {} of {} images: loss {} > budget {}'.format(
+            n_done, len(images), total_loss, options.loss_budget))
+    elif ground_truth is not None:
+        print('Total loss: {}'.format(total_loss))
 
     print('Elapsed: ' + str(time.time() - t))
 
@@ -13,9 +13,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from itertools import product
+import argparse
 import sys
 
+from param_space import Choice
+from param_space import Fixed
+from param_space import ParamSpace
+from param_space import Product
+from param_space import Values
+from param_space import parse_shard
+from run_config import parse_config
+
 
 IMAGE_LIST                       = 'images.txt'
 IMAGE_DIR                        = 'images'
@@ -38,14 +46,11 @@ MINRADIUS_VALS                   = (lambda s: 0, lambda s: s/32.0,
 MAXRADIUS_VALS                   = (lambda s: 0, lambda s: s)
 
 
-def print_program_invocation(size, blur_type, blur_ksize, dp, minDist, param1,
-                             param2, minRadius, maxRadius, enable_unsharp,
-                             unsharp_blur_type='g', unsharp_blur_ksize=0,
-                             unsharp_add_weight=0, unsharp_gamma=0,
-                             unsharp_blur_sigmaXY=0, blur_sigmaXY=0):
+def make_config(size, blur_type, blur_ksize, dp, minDist, param1, param2,
+                minRadius, maxRadius, enable_unsharp, unsharp_blur_type='g',
+                unsharp_blur_ksize=0, unsharp_add_weight=0, unsharp_gamma=0,
+                unsharp_blur_sigmaXY=0, blur_sigmaXY=0):
     ordered_params = (
-        IMAGE_LIST,
-        IMAGE_DIR,
         size,
         enable_unsharp,
         unsharp_blur_type,
@@ -64,80 +69,114 @@ def print_program_invocation(size, blur_type, blur_ksize, dp, minDist, param1,
         int(round(maxRadius(size))),
     )
 
-    params = ' '.join([str(i) for i in ordered_params])
-    print('python3 detect_circles.py {0}'.format(params))
+    # Parse back from the command line strings so the Config holds exactly
+    # what detect_circles.py would run with
+    return parse_config([str(i) for i in ordered_params])
 
 
-def loop_through_unsharp_params_and_generate_calls(eip, blur_sigmaXY=0):
-    i = 0
+def format_program_invocation(config):
+    params = [IMAGE_LIST, IMAGE_DIR] + [_format_param(i) for i in config]
+    return 'python3 detect_circles.py {0}'.format(' '.join(params))
 
-    (size, blur_type, blur_ksize, dp,
-     minDist, param1, param2, minRadius, maxRadius) = eip
 
-    for enable_unsharp in ENABLE_UNSHARP_VALS:
+def build_param_space():
+    """
+    Returns a param_space.ParamSpace over every run_config.Config of the
+    grid search, indexed in the order the program invocations are printed.
+    The Gaussian blur sigma and the unsharp mask parameters only exist in
+    their branch.
+    """
+    unsharp_branches = list()
+    for unsharp_blur_type in UNSHARP_BLUR_TYPE_VALS:
+        if unsharp_blur_type == 'g':
+            sigma = Values('unsharp_blur_sigmaXY', UNSHARP_BLUR_SIGMAXY_VALS)
+        else:
+            sigma = Fixed(unsharp_blur_sigmaXY=0)
+
+        unsharp_branches.append(Product(
+            Fixed(unsharp_blur_type=unsharp_blur_type),
+            Values('unsharp_blur_ksize', UNSHARP_BLUR_KSIZE_VALS),
+            Values('unsharp_add_weight', UNSHARP_ADD_WEIGHT_VALS),
+            Values('unsharp_gamma', UNSHARP_GAMMA_VALS),
+            sigma))
 
+    unsharp = list()
+    for enable_unsharp in ENABLE_UNSHARP_VALS:
         if enable_unsharp == 1:
-            # This is a generator so we have to recreate it every time its
-            # used
-            unsharp_common_params = product(UNSHARP_BLUR_TYPE_VALS,
-                                            UNSHARP_BLUR_KSIZE_VALS,
-                                            UNSHARP_ADD_WEIGHT_VALS,
-                                            UNSHARP_GAMMA_VALS)
-
-            for ucp in unsharp_common_params:
-
-                (unsharp_blur_type, unsharp_blur_ksize,
-                 unsharp_add_weight, unsharp_gamma) = ucp
-
-                if unsharp_blur_type == 'g':
-                    for unsharp_blur_sigmaXY in UNSHARP_BLUR_SIGMAXY_VALS:
-                        i += 1
-                        print_program_invocation(
-                            size, blur_type, blur_ksize, dp, minDist, param1,
-                            param2, minRadius, maxRadius,
-                            enable_unsharp, unsharp_blur_type=unsharp_blur_type,
-                            unsharp_blur_ksize=unsharp_blur_ksize,
-                            unsharp_add_weight=unsharp_add_weight,
-                            unsharp_gamma=unsharp_gamma,
-                            unsharp_blur_sigmaXY=unsharp_blur_sigmaXY,
-                            blur_sigmaXY=blur_sigmaXY)
-                else:
-                    i += 1
-                    print_program_invocation(
-                        size, blur_type, blur_ksize, dp, minDist, param1,
-                        param2, minRadius, maxRadius,
-                        enable_unsharp, unsharp_blur_type=unsharp_blur_type,
-                        unsharp_blur_ksize=unsharp_blur_ksize,
-                        unsharp_add_weight=unsharp_add_weight,
-                        unsharp_gamma=unsharp_gamma,
-                        blur_sigmaXY=blur_sigmaXY)
+            unsharp.append(Product(Fixed(enable_unsharp=enable_unsharp),
+                                   Choice(*unsharp_branches)))
         else:
-            i += 1
-            print_program_invocation(
-                size, blur_type, blur_ksize, dp, minDist, param1,
-                param2, minRadius, maxRadius,
-                enable_unsharp, blur_sigmaXY=blur_sigmaXY)
+            unsharp.append(Fixed(enable_unsharp=enable_unsharp))
 
-    return i
+    blur_branches = list()
+    for blur_type in BLUR_TYPE_VALS:
+        if blur_type == 'g':
+            sigma = Values('blur_sigmaXY', BLUR_SIGMAXY_VALS)
+        else:
+            sigma = Fixed(blur_sigmaXY=0)
 
+        blur_branches.append(Product(
+            Fixed(blur_type=blur_type),
+            Values('blur_ksize', BLUR_KSIZE_VALS),
+            Values('dp', DP_VALS),
+            Values('minDist', MINDIST_VALS),
+            Values('param1', PARAM1_VALS),
+            Values('param2', PARAM2_VALS),
+            Values('minRadius', MINRADIUS_VALS),
+            Values('maxRadius', MAXRADIUS_VALS),
+            sigma,
+            Choice(*unsharp)))
 
-def main():
-    i = 0
+    root = Product(Values('size', SIZE_VALS), Choice(*blur_branches))
+    return ParamSpace(root, lambda assignment: make_config(**assignment))
 
-    every_iter_params = product(SIZE_VALS, BLUR_TYPE_VALS, BLUR_KSIZE_VALS,
-                                DP_VALS, MINDIST_VALS, PARAM1_VALS,
-                                PARAM2_VALS, MINRADIUS_VALS, MAXRADIUS_VALS)
 
-    for eip in every_iter_params:
+def generate_configs():
+    """
+    Yields every run_config.Config of the grid search, in the order the
+    program invocations are printed.
+    """
+    yield from build_param_space()
 
-        blur_type = eip[1]
 
-        if blur_type == 'g':
-             for blur_sigmaXY in BLUR_SIGMAXY_VALS:
-                 i += loop_through_unsharp_params_and_generate_calls(
-                    eip, blur_sigmaXY)
-        else:
-            i += loop_through_unsharp_params_and_generate_calls(eip)
+def _format_param(value):
+    # enable_unsharp is passed on the command line as 1/0
+    if isinstance(value, bool):
+        return str(int(value))
+
+    # Whole weights are passed as ints (2, not 2.0)
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Prints the detect_circles.py invocation of every '
+                    'configuration of the grid search.')
+    parser.add_argument('--shuffle-seed', type=int, default=None,
+                        help='print the configurations in a pseudo random '
+                             'order determined by this seed')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help='k/n: only print shard k (0 based) of n')
+    args = parser.parse_args()
+
+    space = build_param_space()
+
+    if args.shard is not None:
+        k, n = args.shard
+        configs = space.shard(k, n, args.shuffle_seed)
+    elif args.shuffle_seed is not None:
+        configs = space.shard(0, 1, args.shuffle_seed)
+    else:
+        configs = space
+
+    i = 0
+
+    for config in configs:
+        print(format_program_invocation(config))
+        i += 1
 
     print(str(i) + ' iterations', file=sys.stderr)
 
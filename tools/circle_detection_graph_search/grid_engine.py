@@ -0,0 +1,505 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+from collections import OrderedDict
+from itertools import groupby
+import os
+import sys
+import time
+
+from canonical import collapse_configs
+from canonical import collapse_summary
+from circle_refine import refine_circles
+from coarse_to_fine import detect_coarse_to_fine
+from detect_circles import HOUGH_ACCUMULATOR
+from detect_circles import HOUGH_METHODS
+from detect_circles import HOUGH_OPENCV
+from detect_circles import detect_image_circles
+from detect_circles import extract_circles
+from detect_circles import format_output_line
+from detect_circles import preprocess_config
+from detect_circles import read_image
+from detect_circles import resize_image
+from detect_circles import result_variant
+from detect_circles import scale_circles_to_shape
+from generate_runs import IMAGE_DIR
+from generate_runs import IMAGE_LIST
+from generate_runs import build_param_space
+from hough_accumulator import HoughAccumulator
+from image_pyramid import ImagePyramid
+from image_store import ImageStore
+from param_space import parse_shard
+from results_ledger import ResultsLedger
+from run_config import config_fingerprint
+from run_config import config_params_str
+from run_config import output_file_name
+from run_config import parse_invocation
+from stage_cache import StageCache
+
+
+DEFAULT_BLOCK_SIZE  = 256
+DEFAULT_CACHE_MB    = 512
+
+
+def read_runs_file(fpath):
+    """
+    Reads a runs file as printed by generate_runs.py. Returns an
+    OrderedDict mapping (image_list, image_dir) to the list of Configs to
+    run against it.
+    """
+    runs = OrderedDict()
+
+    with open(fpath) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            image_list, image_dir, config = parse_invocation(line)
+            runs.setdefault((image_list, image_dir), list()).append(config)
+
+    return runs
+
+
+def read_image_list(fpath):
+    with open(fpath) as f:
+        return [l.strip() for l in f.readlines() if l.strip()]
+
+
+def evaluate_block(configs, images, image_dir, cache=None, store=None,
+                   runtimes=None, hough_method=HOUGH_OPENCV, refine=False,
+                   joint=False, streams=None, coarse_bound=None,
+                   cancel=None):
+    """
+    Evaluates every config in configs against every image, decoding each
+    image only once. Returns a dict mapping each config to a list of
+    (imname, circle1, circle2), in image order.
+
+    If cache is a StageCache, preprocessing stages shared between configs
+    are computed once per image. If store is an ImageStore, images are read
+    from it rather than decoded from image_dir. If runtimes is a dict, the
+    time spent on each config is added to runtimes[config]. hough_method is
+    passed on to detect_circles.compute_circles; with HOUGH_ACCUMULATOR,
+    configs that only differ in param2, minRadius and maxRadius share one
+    HoughAccumulator per image, unless joint. refine and joint are passed
+    on to detect_circles.detect_image_circles. With a coarse_bound, circles
+    are detected by coarse_to_fine.detect_coarse_to_fine on the original
+    images instead. If streams is a dict (see open_streams), the output line
+    of each result is also written to the files in streams[config], which
+    are flushed after every image. If cancel is a threading.Event, the
+    results so far are returned as soon as it is set, before the next image
+    or config.
+    """
+    results = OrderedDict((c, list()) for c in configs)
+
+    # Evaluate configs sharing a preprocessing prefix back to back, so the
+    # prefix is still cached when the next config needs it
+    configs = sorted(configs, key=_hough_order)
+    size_bounds = sorted(set(c.size_bound for c in configs))
+    if coarse_bound is not None:
+        # detect_coarse_to_fine only needs the original image
+        size_bounds = list()
+
+    # The second search of a joint detection depends on the first disk, so
+    # configs cannot share one accumulator
+    sweep = hough_method == HOUGH_ACCUMULATOR and not joint and \
+        coarse_bound is None
+
+    groups = [[c] for c in configs]
+    if sweep:
+        groups = [list(g) for _, g in groupby(configs, key=_accumulator_key)]
+
+    for imname in images:
+        if cancel is not None and cancel.is_set():
+            return results
+
+        pyramid = _read_pyramid(imname, image_dir, size_bounds, store,
+                                coarse_bound is not None)
+        if pyramid is None:
+            print('Error: {} could not be read'.format(
+                      os.path.join(image_dir, imname)),
+                  file=sys.stderr)
+            continue
+
+        for group in groups:
+            if cancel is not None and cancel.is_set():
+                return results
+
+            t = time.time()
+
+            if sweep:
+                circles = _sweep_group(group, pyramid, pyramid.shape, cache,
+                                       imname, refine)
+            elif coarse_bound is not None:
+                circles = [detect_coarse_to_fine(pyramid, group[0],
+                                                 coarse_bound, hough_method)]
+            else:
+                circles = [detect_image_circles(pyramid, group[0], cache,
+                                                imname, pyramid.shape,
+                                                hough_method, refine, joint)]
+
+            for config, (circle1, circle2) in zip(group, circles):
+                results[config].append((imname, circle1, circle2))
+
+                if streams is not None:
+                    line = format_output_line(imname, circle1, circle2)
+                    for f in streams[config]:
+                        f.write(line)
+
+            if runtimes is not None:
+                # The cost of a shared accumulator is split evenly
+                elapsed = (time.time() - t) / len(group)
+                for config in group:
+                    runtimes[config] = runtimes.get(config, 0) + elapsed
+
+        # Nothing cached for this image is needed again
+        if cache is not None:
+            cache.clear()
+
+        # So live_leaderboard.py can follow configs while they run
+        if streams is not None:
+            for files in streams.values():
+                for f in files:
+                    f.flush()
+
+    return results
+
+
+def _sweep_group(group, image, original_shape, cache, imname, refine=False):
+    """
+    Returns (circle1, circle2) for every config of group, which share
+    everything but param2, minRadius and maxRadius, from one
+    HoughAccumulator.
+    """
+    config = group[0]
+    processed = preprocess_config(image, config, cache, imname)
+
+    accumulator = HoughAccumulator(processed, config.dp, config.param1,
+                                   set((c.minRadius, c.maxRadius)
+                                       for c in group))
+
+    results = list()
+    for c in group:
+        circle1, circle2 = extract_circles(accumulator.circles(
+            c.param2, c.minRadius, c.maxRadius, c.minDist))
+
+        if refine:
+            circle1, circle2 = refine_circles(processed, circle1, circle2,
+                                              config.dp, config.param1)
+
+        results.append(scale_circles_to_shape(circle1, circle2,
+                                              original_shape,
+                                              processed.shape))
+
+    return results
+
+
+def write_results(results, output_dir, variant=''):
+    """
+    Writes the output_run-{params} file of every config in results, found
+    with the detect_circles.result_variant variant.
+    """
+    for config, circles in results.items():
+        with open(os.path.join(output_dir, output_file_name(config, variant)),
+                  'w') as f:
+            f.writelines([format_output_line(*c) for c in circles])
+
+
+def open_streams(configs, output_dir, members=None, variant=''):
+    """
+    Opens the output_run-{params} file of every config, or with members of
+    every member of its canonical.collapse_configs class, for
+    evaluate_block to stream results to. variant is the
+    detect_circles.result_variant the results are found with. Returns a
+    dict mapping each config to its files.
+    """
+    streams = dict()
+
+    for config in configs:
+        streams[config] = [
+            open(os.path.join(output_dir, output_file_name(m, variant)), 'w')
+            for m in (members[config] if members is not None else [config])
+        ]
+
+    return streams
+
+
+def close_streams(streams):
+    for files in streams.values():
+        for f in files:
+            f.close()
+
+
+def remaining_configs(configs, completed, skipped, variant=''):
+    """
+    Yields the configs whose fingerprint, for the
+    detect_circles.result_variant variant, is not in completed, counting
+    the others in skipped[0]. configs are consumed lazily.
+    """
+    for config in configs:
+        if completed and config_fingerprint(config, variant) in completed:
+            skipped[0] += 1
+        else:
+            yield config
+
+
+def run(runs, block_size, output_dir, cache=None, store=None, ledger=None,
+        collapse=False, hough_method=HOUGH_OPENCV, refine=False, joint=False,
+        coarse_bound=None):
+    """
+    Runs all configs in runs (as returned by read_runs_file) block by block.
+    The configs of each image list may be any iterable, e.g. a
+    ParamSpace.shard, and are only consumed one block at a time. If ledger
+    is a ResultsLedger, configs it already holds are skipped and results are
+    recorded in it instead of written to output_dir.
+
+    With collapse, the configs of each image list are first grouped into
+    canonical.collapse_configs equivalence classes. Each class is evaluated
+    once and its results are recorded for every member; invalid configs are
+    skipped. hough_method, refine, joint and coarse_bound are passed on to
+    evaluate_block. Returns the number of configs evaluated.
+    """
+    n = 0
+
+    for (image_list, image_dir), configs in runs.items():
+        images = read_image_list(image_list)
+
+        if len(images) == 0:
+            print('Error: no images found in {}'.format(image_list),
+                  file=sys.stderr)
+            continue
+
+        completed = set()
+        if ledger is not None:
+            completed = ledger.completed()
+
+        skipped = [0]
+        configs = remaining_configs(configs, completed, skipped,
+                                    result_variant(hough_method, refine,
+                                                   joint, coarse_bound))
+
+        members = None
+        if collapse:
+            members, invalid = collapse_configs(configs)
+            print(collapse_summary(members, invalid))
+            for config in invalid:
+                print('Error: skipping invalid config {}'.format(
+                          config_params_str(config)),
+                      file=sys.stderr)
+            configs = members.keys()
+
+        start = 0
+        block = list()
+
+        for config in configs:
+            block.append(config)
+            if len(block) == block_size:
+                _run_block(block, start, images, image_dir, output_dir,
+                           cache, store, ledger, members, hough_method,
+                           refine, joint, coarse_bound)
+                start += len(block)
+                block = list()
+
+        if block:
+            _run_block(block, start, images, image_dir, output_dir, cache,
+                       store, ledger, members, hough_method, refine, joint,
+                       coarse_bound)
+            start += len(block)
+
+        if ledger is not None:
+            print('Skipped {} completed configs'.format(skipped[0]))
+
+        n += start
+
+    return n
+
+
+def _run_block(block, start, images, image_dir, output_dir, cache, store,
+               ledger, members=None, hough_method=HOUGH_OPENCV,
+               refine=False, joint=False, coarse_bound=None):
+    t = time.time()
+    variant = result_variant(hough_method, refine, joint, coarse_bound)
+
+    # Without a ledger, results are written to the output files as each
+    # image is done
+    streams = None
+    if ledger is None:
+        streams = open_streams(block, output_dir, members, variant)
+
+    runtimes = dict()
+    try:
+        results = evaluate_block(block, images, image_dir, cache, store,
+                                 runtimes, hough_method, refine, joint,
+                                 streams, coarse_bound)
+    finally:
+        if streams is not None:
+            close_streams(streams)
+
+    # Fan the results of each equivalence class out to its members
+    if members is not None:
+        results = OrderedDict((m, circles) for c, circles in results.items()
+                              for m in members[c])
+        runtimes = dict((m, runtimes.get(c)) for c in block
+                        for m in members[c])
+
+    if ledger is not None:
+        for config, circles in results.items():
+            ledger.record(config, circles, runtimes.get(config),
+                          variant=variant)
+
+    print('Block configs[{}:{}] elapsed: {}'.format(
+        start, start + len(block), time.time() - t))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Evaluates a runs file produced by generate_runs.py '
+                    '(or a shard of the generate_runs.py grid) in process, '
+                    'decoding each image once per block of configurations.')
+    parser.add_argument('runs_file', nargs='?', default=None,
+                        help='runs file; if omitted, configs are decoded '
+                             'directly from the generate_runs.py grid')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help='k/n: without a runs file, only run shard k '
+                             '(0 based) of n of the grid')
+    parser.add_argument('--shuffle-seed', type=int, default=None,
+                        help='without a runs file, run the grid in a pseudo '
+                             'random order determined by this seed')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE,
+                        help='number of configurations evaluated against '
+                             'each decoded image')
+    parser.add_argument('--output-dir', type=str, default='.')
+    parser.add_argument('--cache-mb', type=int, default=DEFAULT_CACHE_MB,
+                        help='memory budget for cached preprocessing '
+                             'stages, 0 disables caching')
+    parser.add_argument('--image-store', type=str, default=None,
+                        help='image_store.py pack file to read images from')
+    parser.add_argument('--ledger', type=str, default=None,
+                        help='results_ledger.py database to record results '
+                             'in instead of output files; configs already '
+                             'recorded in it are skipped')
+    parser.add_argument('--hough-method', choices=HOUGH_METHODS,
+                        default=HOUGH_OPENCV,
+                        help='circle Hough transform; with accumulator, '
+                             'configs differing only in param2 and radius '
+                             'bounds share one vote pass per image')
+    parser.add_argument('--collapse', action='store_true',
+                        help='evaluate each class of equivalent configs '
+                             'once and copy its results to every member')
+    parser.add_argument('--refine', action='store_true',
+                        help='refine the Hough circles with a least squares '
+                             'fit to the edges around them')
+    parser.add_argument('--joint', action='store_true',
+                        help='search for the second disk around the first '
+                             'one and label them solar and lunar')
+    parser.add_argument('--coarse-bound', type=int, default=None,
+                        help='find the circles on the image resized to this '
+                             'bound, then refine them at the original '
+                             'resolution')
+    args = parser.parse_args()
+
+    if args.coarse_bound is not None and (args.refine or args.joint):
+        parser.error('--coarse-bound cannot be combined with --refine or '
+                     '--joint')
+
+    t = time.time()
+
+    cache = None
+    if args.cache_mb > 0:
+        cache = StageCache(args.cache_mb * 1024 * 1024)
+
+    store = None
+    if args.image_store is not None:
+        store = ImageStore(args.image_store)
+
+    ledger = None
+    if args.ledger is not None:
+        ledger = ResultsLedger(args.ledger)
+
+    if args.runs_file is not None:
+        runs = read_runs_file(args.runs_file)
+    else:
+        k, n = args.shard if args.shard is not None else (0, 1)
+        runs = {(IMAGE_LIST, IMAGE_DIR):
+                build_param_space().shard(k, n, args.shuffle_seed)}
+
+    n = run(runs, args.block_size, args.output_dir, cache, store, ledger,
+            args.collapse, args.hough_method, args.refine, args.joint,
+            args.coarse_bound)
+
+    print('{} configs, elapsed: {}'.format(n, time.time() - t))
+    if cache is not None:
+        print(cache)
+
+
+def _read_pyramid(imname, image_dir, size_bounds, store, full=False):
+    """
+    Returns an image_pyramid.ImagePyramid of imname with a level for each
+    of size_bounds, shared by all configs, or None if imname could not be
+    read. Levels come from store when it has them, the others are resized
+    from the original image, which is decoded at most once. With full, the
+    pyramid also has the original image as its base.
+    """
+    pyramid = None
+    if store is not None:
+        pyramid = store.pyramid(imname)
+
+    missing = [b for b in size_bounds if pyramid is None or b not in pyramid]
+
+    # Stores only hold resized levels
+    lacks_base = full and (pyramid is None or
+                           pyramid.base.shape != pyramid.shape)
+    if not missing and not lacks_base:
+        return pyramid
+
+    image, original_shape = read_image(image_dir, imname,
+                                       max(size_bounds, default=0))
+    if image is None:
+        return None
+
+    levels = [resize_image(image, b) for b in missing]
+    if pyramid is None:
+        return ImagePyramid([image] + levels, original_shape)
+
+    if lacks_base:
+        levels.append(image)
+
+    for level in levels:
+        pyramid.add_level(level)
+
+    return pyramid
+
+
+def _preprocess_order(config):
+    return (config.size_bound, config.enable_unsharp,
+            config.unsharp_blur_type, config.unsharp_blur_ksize,
+            config.unsharp_blur_sigmaXY, config.unsharp_add_weight,
+            config.unsharp_gamma, config.blur_type, config.blur_ksize,
+            config.blur_sigmaXY)
+
+
+def _accumulator_key(config):
+    # Configs sharing these can share a HoughAccumulator
+    return _preprocess_order(config) + (config.dp, config.param1)
+
+
+def _hough_order(config):
+    return _accumulator_key(config) + (config.minDist, config.param2,
+                                       config.minRadius, config.maxRadius)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cv2
+import numpy as np
+
+
+# Fixed point precision of the vote positions, as in OpenCV
+SHIFT       = 10
+ONE         = 1 << SHIFT
+
+# Bound on the number of votes computed at once
+MAX_BATCH_VOTES = 1 << 23
+
+
+class HoughAccumulator(object):
+    """
+    A circle Hough gradient transform, modelled on the HOUGH_GRADIENT
+    method of OpenCV 3's cv2.HoughCircles, of one preprocessed image for
+    one (dp, param1), reusable for any param2 and any of the (minRadius,
+    maxRadius) pairs in radius_bounds. It only approximates
+    cv2.HoughCircles: other OpenCV versions find different circles, so
+    its results are kept apart from theirs (see
+    detect_circles.result_variant).
+
+    The Canny edges and gradients are computed once. Every edge point votes
+    along its gradient, and the votes for radii between consecutive radius
+    bounds are summed into prefix accumulators. The accumulator of a
+    (minRadius, maxRadius) pair is the difference of two of them. param2
+    only selects among the resulting centers.
+    """
+
+    def __init__(self, image, dp, param1, radius_bounds):
+        self.shape = image.shape[:2]
+        self.dp = dp
+
+        edges = cv2.Canny(image, max(1, param1 / 2.0), param1)
+        dx = cv2.Sobel(image, cv2.CV_16S, 1, 0, ksize=3)
+        dy = cv2.Sobel(image, cv2.CV_16S, 0, 1, ksize=3)
+
+        ys, xs = np.nonzero(edges)
+        vx = dx[ys, xs].astype(np.float64)
+        vy = dy[ys, xs].astype(np.float64)
+
+        # Points without a gradient neither vote nor count towards radii
+        keep = (vx != 0) | (vy != 0)
+        xs, ys, vx, vy = xs[keep], ys[keep], vx[keep], vy[keep]
+        self._points = np.stack([xs, ys], axis=1).astype(np.float32)
+
+        rows, cols = self.shape
+        idp = 1.0 / dp
+        self._acols = int(np.ceil(cols * idp))
+        self._arows = int(np.ceil(rows * idp))
+
+        mag = np.sqrt(vx * vx + vy * vy)
+        self._sx = np.rint(vx * idp * ONE / mag).astype(np.int64)
+        self._sy = np.rint(vy * idp * ONE / mag).astype(np.int64)
+        self._x0 = np.rint(xs * idp * ONE).astype(np.int64)
+        self._y0 = np.rint(ys * idp * ONE).astype(np.int64)
+
+        ranges = [self.radius_range(*b) for b in radius_bounds]
+        bounds = sorted(set([r[0] for r in ranges] +
+                            [r[1] + 1 for r in ranges]))
+
+        self._prefix = self._accumulate(bounds)
+        self._centers = dict()
+        self._radii = dict()
+
+    def radius_range(self, minRadius, maxRadius):
+        """
+        The radii voted for with minRadius and maxRadius, interpreted as
+        cv2.HoughCircles does.
+        """
+        minRadius = max(minRadius, 0)
+        if maxRadius <= 0:
+            maxRadius = max(self.shape)
+        elif maxRadius <= minRadius:
+            maxRadius = minRadius + 2
+        return minRadius, maxRadius
+
+    def circles(self, param2, minRadius, maxRadius, minDist, ncircles=2):
+        """
+        Returns the first ncircles circles found with these parameters, as
+        an array shaped like the result of cv2.HoughCircles, or None.
+        (minRadius, maxRadius) must be one of the radius_bounds the
+        accumulator was built for.
+        """
+        rng = self.radius_range(minRadius, maxRadius)
+        votes, centers = self._candidates(rng)
+        radii = self._radii.setdefault(rng, dict())
+
+        min_dist = max(minDist, self.dp) ** 2
+        found = list()
+
+        for center, n_votes in zip(centers, votes):
+            # Centers are in descending order of votes
+            if n_votes <= param2:
+                break
+
+            y, x = divmod(int(center), self._acols + 2)
+            cx = (x + 0.5) * self.dp
+            cy = (y + 0.5) * self.dp
+
+            if any((c[0] - cx) ** 2 + (c[1] - cy) ** 2 < min_dist
+                   for c in found):
+                continue
+
+            if center not in radii:
+                radii[center] = self._best_radius(cx, cy, rng)
+            r_best, max_count = radii[center]
+
+            if max_count > param2:
+                found.append((cx, cy, r_best))
+                if len(found) >= ncircles:
+                    break
+
+        if not found:
+            return None
+
+        return np.array([found], dtype=np.float32)
+
+    def sweep(self, settings, minDist, ncircles=2):
+        """
+        Returns the circles for each (param2, minRadius, maxRadius) of
+        settings.
+        """
+        return [self.circles(param2, minRadius, maxRadius, minDist, ncircles)
+                for param2, minRadius, maxRadius in settings]
+
+    def _accumulate(self, bounds):
+        """
+        Returns a dict mapping each bound b to the accumulator of the votes
+        for radii below b.
+        """
+        astep = self._acols + 2
+        size = (self._arows + 2) * astep
+        total = np.zeros(size, dtype=np.int64)
+        prefix = {bounds[0]: total.copy()}
+
+        n = max(1, len(self._x0))
+        chunk = max(1, MAX_BATCH_VOTES // (2 * n))
+
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            for start in range(lo, hi, chunk):
+                r = np.arange(start, min(start + chunk, hi),
+                              dtype=np.int64)[None, :]
+
+                # Votes on both sides of each point
+                for sign in (1, -1):
+                    x2 = (self._x0[:, None] + sign * r * self._sx[:, None]) \
+                        >> SHIFT
+                    y2 = (self._y0[:, None] + sign * r * self._sy[:, None]) \
+                        >> SHIFT
+
+                    inside = (x2 >= 0) & (x2 < self._acols) & \
+                             (y2 >= 0) & (y2 < self._arows)
+                    cells = (y2[inside] + 1) * astep + x2[inside] + 1
+                    total += np.bincount(cells, minlength=size)
+
+            prefix[hi] = total.copy()
+
+        return prefix
+
+    def _candidates(self, rng):
+        """
+        Returns (votes, centers) of the local accumulator maxima for the
+        radius range rng, in descending order of votes.
+        """
+        if rng not in self._centers:
+            acc = (self._prefix[rng[1] + 1] - self._prefix[rng[0]]).reshape(
+                self._arows + 2, self._acols + 2)
+
+            # Interior cells of OpenCV's (offset by one) accumulator
+            core = acc[2:-2, 2:-2]
+            local_max = (core > acc[2:-2, 1:-3]) & (core > acc[2:-2, 3:-1]) & \
+                        (core > acc[1:-3, 2:-2]) & (core > acc[3:-1, 2:-2]) & \
+                        (core > 0)
+
+            ys, xs = np.nonzero(local_max)
+            votes = core[ys, xs]
+
+            # Center indexes in OpenCV's accumulator, whose data starts at
+            # (1, 1)
+            centers = (ys + 1) * (self._acols + 2) + xs + 1
+
+            order = np.lexsort((centers, -votes))
+            self._centers[rng] = (votes[order], centers[order])
+
+        return self._centers[rng]
+
+    def _best_radius(self, cx, cy, rng):
+        """
+        Returns (radius, support) of the radius best supported by the edge
+        points around (cx, cy), grouping distances within dp of each other.
+        """
+        min_radius, max_radius = rng
+        d = self._points - np.array([cx, cy], dtype=np.float32)
+        r2 = (d * d).sum(axis=1)
+        r2 = r2[(r2 >= min_radius * min_radius) &
+                (r2 <= max_radius * max_radius)]
+
+        if len(r2) == 0:
+            return 0.0, 0
+
+        dist = np.sort(np.sqrt(r2))
+        n = len(dist)
+        dr = self.dp
+
+        r_best = 0.0
+        max_count = 0
+        start = 0
+
+        # OpenCV scans the distances from the smallest up, closing a group
+        # whenever the next distance is more than dr past the group's first.
+        # The last group is never closed.
+        while True:
+            end = int(np.searchsorted(dist, dist[start] + dr, side='right'))
+            if end >= n or dist[end] > max_radius:
+                break
+
+            count = end - start
+
+            # Median distance of the group, as indexed by OpenCV in its
+            # descending order
+            r_cur = dist[n - 1 - ((2 * n - 2 - end - start) // 2)]
+
+            if count * r_best >= max_count * r_cur or \
+               (r_best < np.finfo(np.float32).eps and count >= max_count):
+                r_best = float(r_cur)
+                max_count = count
+
+            start = end
+
+        return r_best, max_count
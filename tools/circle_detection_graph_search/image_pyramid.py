@@ -0,0 +1,126 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cv2
+
+from detect_circles import compute_resized_dims
+from detect_circles import resize_image
+
+
+# Octave levels are halved down to this bound
+DEFAULT_MIN_BOUND   = 200
+
+
+class ImagePyramid(object):
+    """
+    One image at several resolutions. Any size bound is served from the
+    smallest level that still covers it, instead of from the full
+    resolution image. shape is the shape of the original image, so a
+    pyramid can stand in for it: detect_circles.resize_image (and so
+    preprocess_image and detect_image_circles) accept one.
+    """
+
+    def __init__(self, levels, original_shape=None):
+        """
+        levels are the image at any resolutions, all with the original
+        image's aspect ratio. The largest of them is taken as the original
+        unless original_shape is given.
+        """
+        if original_shape is None:
+            original_shape = max(levels, key=_area).shape
+        self.shape = tuple(original_shape[:2])
+
+        self.levels = list()
+        self._by_dims = dict()
+        for level in levels:
+            self.add_level(level)
+
+    @classmethod
+    def build(cls, image, size_bounds=(), min_bound=DEFAULT_MIN_BOUND,
+              original_shape=None):
+        """
+        Builds the pyramid of image: a level for each of size_bounds,
+        resized from image exactly as detect_circles.resize_image would, and
+        octave levels, each half of the one before, down to min_bound.
+        """
+        levels = [image] + [resize_image(image, b) for b in size_bounds]
+
+        return cls(levels + octaves(image, min_bound), original_shape)
+
+    @property
+    def base(self):
+        """
+        The largest level.
+        """
+        return self.levels[0]
+
+    def get(self, size_bound):
+        """
+        Returns the image resized to fit in size_bound x size_bound. A level
+        of those dimensions is returned as is, otherwise the smallest level
+        covering them is resized (and the result kept as a new level).
+        """
+        dims = compute_resized_dims(self, size_bound, size_bound)
+
+        level = self._by_dims.get(dims)
+        if level is not None:
+            return level
+
+        source = self.base
+        for level in self.levels:
+            if level.shape[1] >= dims[0] and level.shape[0] >= dims[1]:
+                source = level
+
+        resized = cv2.resize(source, dims)
+        self.add_level(resized)
+
+        return resized
+
+    def add_level(self, level):
+        """
+        Adds level, the image at another resolution.
+        """
+        self.levels.append(level)
+        self.levels.sort(key=_area, reverse=True)
+        self._by_dims[(level.shape[1], level.shape[0])] = level
+
+    def __contains__(self, size_bound):
+        """
+        Whether the pyramid has a level of exactly the dimensions
+        size_bound resizes the image to.
+        """
+        return compute_resized_dims(self, size_bound, size_bound) in \
+            self._by_dims
+
+
+def octaves(image, min_bound=DEFAULT_MIN_BOUND):
+    """
+    Returns image halved, halved again and so on, with area interpolation,
+    for as long as the result is at least min_bound on its longer side.
+    """
+    levels = list()
+
+    octave = image
+    while max(octave.shape[:2]) // 2 >= min_bound:
+        octave = cv2.resize(octave, (octave.shape[1] // 2,
+                                     octave.shape[0] // 2),
+                            interpolation=cv2.INTER_AREA)
+        levels.append(octave)
+
+    return levels
+
+
+def _area(level):
+    return level.shape[0] * level.shape[1]
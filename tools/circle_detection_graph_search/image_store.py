@@ -0,0 +1,202 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from detect_circles import read_image
+from detect_circles import resize_image
+from generate_runs import IMAGE_DIR
+from generate_runs import IMAGE_LIST
+from generate_runs import SIZE_VALS
+from image_pyramid import ImagePyramid
+from image_pyramid import octaves
+
+
+# Pack file layout: the grayscale pixels of every (image, size_bound) pair,
+# each starting on an ALIGNMENT byte boundary, followed by a JSON index, the
+# index length as a little endian uint64 and MAGIC. The index maps image names
+# to their original (height, width) and to the offset and shape of each stored
+# size bound, and of each stored octave (see image_pyramid.octaves) under
+# OCTAVE_KEY and its number.
+MAGIC           = b'EMPPACK1'
+ALIGNMENT       = 4096
+TRAILER_FMT     = '<Q8s'
+DEFAULT_PACK    = 'images.pack'
+OCTAVE_KEY      = 'octave'
+
+
+class ImageStore(object):
+    """
+    Read only view of a pack file written by build_image_store. The pack is
+    opened with np.memmap, so all processes reading it on a machine share
+    one page cache copy of the pixels.
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self._data = np.memmap(fpath, dtype=np.uint8, mode='r')
+
+        trailer_size = struct.calcsize(TRAILER_FMT)
+        index_len, magic = struct.unpack(
+            TRAILER_FMT, self._data[-trailer_size:].tobytes())
+
+        if magic != MAGIC:
+            raise ValueError('{} is not an image pack file'.format(fpath))
+
+        index_end = len(self._data) - trailer_size
+        self._index = json.loads(
+            self._data[index_end - index_len:index_end].tobytes()
+            .decode('utf-8'))
+
+    def load(self, imname, size_bound):
+        """
+        Returns (image, original_shape) where image is imname resized to
+        size_bound, exactly as detect_circles.resize_image would produce
+        it. Returns (None, None) if the pack does not contain it.
+        """
+        try:
+            entry = self._index[imname]
+            level = entry['levels'][str(size_bound)]
+        except KeyError:
+            return None, None
+
+        return self._level(level), tuple(entry['original_shape'])
+
+    def pyramid(self, imname):
+        """
+        Returns an image_pyramid.ImagePyramid of all levels stored for
+        imname, or None if the pack does not contain it.
+        """
+        try:
+            entry = self._index[imname]
+        except KeyError:
+            return None
+
+        return ImagePyramid([self._level(l) for l in entry['levels'].values()],
+                            entry['original_shape'])
+
+    def _level(self, level):
+        h, w = level['shape']
+        image = self._data[level['offset']:level['offset'] + h * w]
+
+        return image.reshape((h, w))
+
+    def __contains__(self, imname):
+        return imname in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+
+def build_image_store(images, image_dir, fpath, size_bounds=SIZE_VALS,
+                      reduced=False, min_octave=None):
+    """
+    Decodes every image to grayscale, resizes it to each of size_bounds and
+    writes the results to the pack file fpath. Unreadable images are
+    reported and left out. Returns the number of images stored. With
+    reduced, JPEGs are decoded at the smallest scale covering the largest
+    size bound. With a min_octave, the octaves of the image down to that
+    bound are stored too, those smaller than the largest size bound, so
+    ImageStore.pyramid can serve bounds between them cheaply.
+    """
+    index = dict()
+
+    with open(fpath, 'wb') as f:
+
+        for imname in images:
+
+            image, original_shape = read_image(image_dir, imname,
+                                               max(size_bounds),
+                                               reduced=reduced)
+            if image is None:
+                print('Error: {} could not be read'.format(
+                          os.path.join(image_dir, imname)),
+                      file=sys.stderr)
+                continue
+
+            resized = [(str(b), resize_image(image, b)) for b in size_bounds]
+            if min_octave is not None:
+                resized += [('{}{}'.format(OCTAVE_KEY, i + 1), o)
+                            for i, o in enumerate(octaves(image, min_octave))
+                            if max(o.shape) < max(size_bounds)]
+
+            levels = dict()
+            for key, level in resized:
+                level = np.ascontiguousarray(level)
+
+                # Pad so every image starts on an aligned offset
+                offset = f.tell()
+                if offset % ALIGNMENT:
+                    offset += ALIGNMENT - offset % ALIGNMENT
+                    f.seek(offset)
+
+                f.write(level.tobytes())
+                levels[key] = {
+                    'offset': offset,
+                    'shape': level.shape,
+                }
+
+            index[imname] = {
+                'original_shape': original_shape,
+                'levels': levels,
+            }
+
+        index_bytes = json.dumps(index).encode('utf-8')
+        f.write(index_bytes)
+        f.write(struct.pack(TRAILER_FMT, len(index_bytes), MAGIC))
+
+    return len(index)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Decodes the images in an image list once and packs '
+                    'them, resized to every size bound, into a single file '
+                    'that detect_circles.py and grid_engine.py can memory '
+                    'map.')
+    parser.add_argument('--image-list', type=str, default=IMAGE_LIST)
+    parser.add_argument('--image-dir', type=str, default=IMAGE_DIR)
+    parser.add_argument('--output', type=str, default=DEFAULT_PACK)
+    parser.add_argument('--size-bounds', type=int, nargs='+',
+                        default=list(SIZE_VALS))
+    parser.add_argument('--reduced-decode', action='store_true',
+                        help='decode JPEGs at 1/2, 1/4 or 1/8 scale when that '
+                             'still covers the largest size bound')
+    parser.add_argument('--octaves', type=int, default=None, metavar='BOUND',
+                        help='also store the image halved repeatedly down to '
+                             'BOUND, to serve other size bounds from')
+    args = parser.parse_args()
+
+    t = time.time()
+
+    with open(args.image_list) as f:
+        images = [l.strip() for l in f.readlines() if l.strip()]
+
+    n = build_image_store(images, args.image_dir, args.output,
+                          args.size_bounds, args.reduced_decode, args.octaves)
+
+    print('Stored {} of {} images in {}'.format(n, len(images), args.output))
+    print('Elapsed: ' + str(time.time() - t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# The active Recorder, set by enable. Until then stage and record return a
+# shared no-op context manager
+_recorder = None
+
+
+class _NullContext(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullContext()
+
+
+def enable(path, track_memory=False):
+    """
+    Starts recording to the JSON lines file path (appended to, so several
+    processes can share it). With track_memory, tracemalloc is started and
+    each stage also records the peak memory it allocated, at the cost of
+    slowing down allocations.
+    """
+    global _recorder
+    _recorder = Recorder(path, track_memory)
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+def enabled():
+    return _recorder is not None
+
+
+def record(**fields):
+    """
+    Context manager grouping the stages run within it into one record,
+    written when it exits along with fields.
+    """
+    if _recorder is None:
+        return _NULL
+    return _recorder.record(fields)
+
+
+def stage(name):
+    """
+    Context manager measuring the code within it as stage name of the
+    current record.
+    """
+    if _recorder is None:
+        return _NULL
+    return _recorder.stage(name)
+
+
+class Recorder(object):
+    """
+    Writes one JSON object per record:
+
+        {"image": ..., "stages": {name: {"wall": s, "cpu": s, "calls": n,
+                                         "peak_bytes": n}}}
+
+    Stages of the same name within a record are summed (peak_bytes is their
+    maximum). Stages run outside of a record are each written as a record
+    of their own. Stages may nest; the peak memory of a stage includes that
+    of the stages within it. Each thread has its own current record, and
+    cpu is the CPU time of that thread alone (so prefetch threads decoding
+    meanwhile do not count), but tracemalloc peaks include the allocations
+    of every thread.
+    """
+
+    def __init__(self, path, track_memory=False):
+        self.path = path
+        self.track_memory = track_memory
+
+        self._fd = None
+        self._pid = None
+        self._local = threading.local()
+
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def record(self, fields):
+        return _Record(self, fields)
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    @property
+    def _current(self):
+        return getattr(self._local, 'current', None)
+
+    @_current.setter
+    def _current(self, record):
+        self._local.current = record
+
+    @property
+    def _peaks(self):
+        if not hasattr(self._local, 'peaks'):
+            self._local.peaks = list()
+        return self._local.peaks
+
+    def write(self, record):
+        # Opened per process, as forked pool workers inherit the recorder.
+        # Each record is written with a single append, so records from
+        # several processes do not interleave.
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path,
+                               os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+
+        os.write(self._fd, (json.dumps(record) + '\n').encode('utf-8'))
+
+    def _start_peak(self):
+        current, peak = tracemalloc.get_traced_memory()
+
+        # The enclosing stage keeps the peak reached so far
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+
+        tracemalloc.reset_peak()
+        self._peaks.append(current)
+        return current
+
+    def _end_peak(self, start):
+        peak = max(tracemalloc.get_traced_memory()[1], self._peaks.pop())
+
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+
+        return max(0, peak - start)
+
+
+class _Record(object):
+
+    def __init__(self, recorder, fields):
+        self.recorder = recorder
+        self.fields = fields
+        self.stages = dict()
+
+    def __enter__(self):
+        self._outer = self.recorder._current
+        self.recorder._current = self
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder._current = self._outer
+
+        record = dict(self.fields)
+        record['stages'] = self.stages
+        self.recorder.write(record)
+        return False
+
+    def add(self, name, wall, cpu, peak):
+        totals = self.stages.get(name)
+        if totals is None:
+            totals = self.stages[name] = {'wall': 0.0, 'cpu': 0.0, 'calls': 0}
+
+        totals['wall'] += wall
+        totals['cpu'] += cpu
+        totals['calls'] += 1
+
+        if peak is not None:
+            totals['peak_bytes'] = max(totals.get('peak_bytes', 0), peak)
+
+
+class _Stage(object):
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        if self.recorder.track_memory:
+            self._memory = self.recorder._start_peak()
+
+        self._cpu = time.thread_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = time.thread_time() - self._cpu
+
+        peak = None
+        if self.recorder.track_memory:
+            peak = self.recorder._end_peak(self._memory)
+
+        current = self.recorder._current
+        if current is None:
+            with self.recorder.record({}) as current:
+                current.add(self.name, wall, cpu, peak)
+        else:
+            current.add(self.name, wall, cpu, peak)
+
+        return False
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of a thread (the one creating the profiler by default)
+    every interval seconds from a background thread, counting identical
+    stacks. Use as a context manager or with start() and stop().
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        if thread_id is None:
+            self.thread_id = threading.get_ident()
+
+        self.counts = dict()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def collapsed(self):
+        """
+        Returns the 'frame;frame;... count' lines of the samples, outermost
+        frame first.
+        """
+        return ['{} {}'.format(stack, n)
+                for stack, n in sorted(self.counts.items())]
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.writelines(l + '\n' for l in self.collapsed())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+
+            key = ';'.join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
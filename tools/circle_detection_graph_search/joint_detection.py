@@ -0,0 +1,202 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+import numpy as np
+
+import instrumentation
+from detect_circles import HOUGH_OPENCV
+from detect_circles import find_circles
+
+
+# The apparent radii of the sun and moon differ by at most about 7%, so the
+# second disk is searched within this fraction of the first one's radius
+RADIUS_TOLERANCE    = 0.1
+
+# The moon only shows where it overlaps the sun, so the second disk's center
+# is searched within this many radii of the first one's. Shallower overlaps,
+# less than a tenth of the radii deep, are not told apart from edge noise.
+MAX_CENTER_DISTANCE = 1.9
+
+# Candidates whose center and radius are both within this fraction of the
+# first disk's radius (or dp pixels) of it are duplicates of the first disk
+DUPLICATE_DISTANCE  = 0.1
+
+# The moon is only visible where it covers the sun, so the overlap of the two
+# disks must be darker than the midpoint of their uncovered parts, and darker
+# than the brighter one by this many gray levels
+MIN_CONTRAST        = 10
+
+# A disk whose uncovered part is smaller than this fraction of its area lies
+# (almost) within the other, and cannot be told apart from it by brightness
+MIN_UNCOVERED       = 0.05
+
+
+def detect_sun_moon(image, config, hough_method=HOUGH_OPENCV):
+    """
+    Joint alternative to detect_circles.compute_circles for the
+    preprocessed image. The strongest circle of a search with config is
+    taken as the first disk. The second disk is then searched for only
+    around it, for radii within RADIUS_TOLERANCE of its radius, skipping
+    duplicates of the first disk. Returns (solar, lunar): the disk with the
+    brighter interior is the sun, and a disk found alone is the sun.
+    Missing disks are None.
+    """
+    with instrumentation.stage('hough'):
+        circles = find_circles(image, config.dp, config.minDist,
+                               config.param1, config.param2,
+                               config.minRadius, config.maxRadius,
+                               hough_method)
+
+    if circles is None or len(circles[0]) == 0:
+        return None, None
+
+    first = tuple(circles[0][0][:3])
+
+    with instrumentation.stage('second_disk'):
+        second = find_second_disk(image, config, first, hough_method)
+
+    if second is None:
+        return first, None
+
+    return label_disks(image, first, second)
+
+
+def find_second_disk(image, config, first, hough_method=HOUGH_OPENCV):
+    """
+    Returns the strongest circle near the disk first, with a radius within
+    RADIUS_TOLERANCE of its radius, that is not a duplicate of it, or None.
+    """
+    x, y, r = first
+    if r <= 0:
+        return None
+
+    min_radius = max(1, int(math.floor(r * (1 - RADIUS_TOLERANCE))))
+    max_radius = int(math.ceil(r * (1 + RADIUS_TOLERANCE)))
+
+    half = int(math.ceil(MAX_CENTER_DISTANCE * r + max_radius)) + 1
+    height, width = image.shape[:2]
+    x0 = max(0, int(x) - half)
+    y0 = max(0, int(y) - half)
+    x1 = min(width, int(x) + half + 1)
+    y1 = min(height, int(y) + half + 1)
+
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    # Centers may be close together, so duplicates are filtered here rather
+    # than by minDist
+    circles = find_circles(image[y0:y1, x0:x1], config.dp, 1, config.param1,
+                           config.param2, min_radius, max_radius,
+                           hough_method)
+    if circles is None:
+        return None
+
+    duplicate = max(DUPLICATE_DISTANCE * r, config.dp)
+
+    for cx, cy, cr in circles[0][:, :3]:
+        candidate = (float(cx + x0), float(cy + y0), float(cr))
+
+        d = math.hypot(candidate[0] - x, candidate[1] - y)
+        if d > MAX_CENTER_DISTANCE * r:
+            continue
+
+        if d <= duplicate and abs(cr - r) <= duplicate:
+            continue
+
+        if not _occludes(image, first, candidate):
+            continue
+
+        return candidate
+
+    return None
+
+
+def label_disks(image, a, b):
+    """
+    Returns the disks a and b as (solar, lunar). The uncovered part of the
+    sun is brighter than that of the moon, which only shows against the
+    sun. When one disk lies (almost) within the other they keep their order.
+    """
+    regions = _region_means(image, a, b)
+    if regions is None:
+        return a, b
+
+    _, only_a, only_b, enclosed = regions
+    if enclosed or only_a is None or only_b is None:
+        return a, b
+
+    if only_b > only_a:
+        return b, a
+
+    return a, b
+
+
+def _occludes(image, a, b):
+    """
+    Whether one of the overlapping disks a and b darkens the other where
+    they overlap, as the moon does the sun.
+    """
+    regions = _region_means(image, a, b)
+    if regions is None:
+        return False
+
+    overlap, only_a, only_b = regions[:3]
+    uncovered = [m for m in (only_a, only_b) if m is not None]
+    if not uncovered:
+        return False
+
+    if overlap + MIN_CONTRAST > max(uncovered):
+        return False
+
+    return len(uncovered) < 2 or overlap < (only_a + only_b) / 2.0
+
+
+def _region_means(image, a, b):
+    """
+    Returns the mean of the overlap of the disks a and b, the means of the
+    parts of a outside b and of b outside a (None for empty parts), and
+    whether either part is smaller than MIN_UNCOVERED of its disk. Returns
+    None if the disks do not overlap.
+    """
+    x0 = max(0, int(math.floor(min(a[0] - a[2], b[0] - b[2]))))
+    y0 = max(0, int(math.floor(min(a[1] - a[2], b[1] - b[2]))))
+    x1 = min(image.shape[1], int(math.ceil(max(a[0] + a[2], b[0] + b[2]))) + 1)
+    y1 = min(image.shape[0], int(math.ceil(max(a[1] + a[2], b[1] + b[2]))) + 1)
+
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    roi = image[y0:y1, x0:x1]
+    ys, xs = np.mgrid[y0:y1, x0:x1]
+
+    in_a = (xs - a[0]) ** 2 + (ys - a[1]) ** 2 <= a[2] * a[2]
+    in_b = (xs - b[0]) ** 2 + (ys - b[1]) ** 2 <= b[2] * b[2]
+
+    overlap = in_a & in_b
+    if not overlap.any():
+        return None
+
+    means = list()
+    enclosed = False
+    for inside, outside in ((in_a, in_b), (in_b, in_a)):
+        only = inside & ~outside
+        means.append(roi[only].mean() if only.any() else None)
+
+        if np.count_nonzero(only) < MIN_UNCOVERED * np.count_nonzero(inside):
+            enclosed = True
+
+    return roi[overlap].mean(), means[0], means[1], enclosed
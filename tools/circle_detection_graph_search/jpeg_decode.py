@@ -0,0 +1,250 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import datetime
+import math
+import struct
+
+import cv2
+
+
+# Grayscale imread flags decoding JPEGs at 1/factor of their size in the DCT
+# domain, largest reduction first
+REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
+# Start of frame markers, holding the image size. 0xC4 (DHT), 0xC8 (JPG)
+# and 0xCC (DAC) share the range but are not frames.
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+# Markers without a length field
+STANDALONE_MARKERS = set(range(0xD0, 0xDA)) | set([0x01])
+
+# EXIF data is held in an APP1 segment, as a TIFF structure
+APP1_MARKER                 = 0xE1
+EXIF_HEADER                 = b'Exif\0\0'
+EXIF_ASCII                  = 2
+EXIF_LONG                   = 4
+EXIF_TIME_FORMAT            = '%Y:%m:%d %H:%M:%S'
+
+MAKE_TAG                    = 0x010F
+MODEL_TAG                   = 0x0110
+DATETIME_TAG                = 0x0132
+EXIF_IFD_TAG                = 0x8769
+DATETIME_ORIGINAL_TAG       = 0x9003
+SUBSEC_TIME_ORIGINAL_TAG    = 0x9291
+
+
+def jpeg_size(fpath):
+    """
+    Returns (height, width) from the frame header of the JPEG file fpath,
+    as stored (i.e. before any EXIF rotation), or None if fpath is not a
+    JPEG file.
+    """
+    try:
+        with open(fpath, 'rb') as f:
+            for marker, length in _segments(f):
+                if marker in SOF_MARKERS:
+                    header = f.read(5)
+                    if len(header) < 5:
+                        return None
+                    _, height, width = struct.unpack('>BHH', header)
+                    return height, width
+
+                f.seek(length - 2, 1)
+    except (IOError, OSError):
+        return None
+
+
+def capture_info(fpath):
+    """
+    Returns (camera, capture_time) from the EXIF data of the JPEG file
+    fpath. camera is the 'Make Model' string, or None. capture_time is the
+    seconds since the epoch of DateTimeOriginal (falling back to DateTime),
+    including its SubSecTimeOriginal fraction, as if taken in UTC, or None.
+    Returns None if fpath has no EXIF data.
+    """
+    try:
+        with open(fpath, 'rb') as f:
+            for marker, length in _segments(f):
+                if marker == APP1_MARKER:
+                    data = f.read(length - 2)
+                    if data.startswith(EXIF_HEADER):
+                        return _parse_exif(data[len(EXIF_HEADER):])
+                else:
+                    f.seek(length - 2, 1)
+    except (IOError, OSError):
+        pass
+
+    return None
+
+
+def reduction_factor(shape, size_bound):
+    """
+    The largest DCT domain reduction of an image of this (height, width)
+    that still covers size_bound, so resizing to size_bound afterwards only
+    ever shrinks it. 1 if none does.
+    """
+    for factor, _ in REDUCED_FLAGS:
+        if int(math.ceil(float(max(shape)) / factor)) >= size_bound:
+            return factor
+    return 1
+
+
+def read_reduced(fpath, size_bound):
+    """
+    Decodes fpath to grayscale at the smallest scale that still covers
+    size_bound. Returns (image, original_shape), where original_shape is the
+    shape a full decode would have had, or (None, None) if fpath could not
+    be read. Files other than JPEGs are decoded in full.
+    """
+    stored = jpeg_size(fpath)
+
+    factor = 1
+    if stored is not None:
+        factor = reduction_factor(stored, size_bound)
+
+    if factor == 1:
+        image = cv2.imread(fpath, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            return None, None
+        return image, image.shape
+
+    image = cv2.imread(fpath, dict(REDUCED_FLAGS)[factor])
+    if image is None:
+        return None, None
+
+    # imread applies the EXIF orientation, which may swap the dimensions.
+    # libjpeg rounds reduced dimensions up.
+    height, width = stored
+    reduced = (int(math.ceil(float(height) / factor)),
+               int(math.ceil(float(width) / factor)))
+
+    if image.shape[:2] != reduced and image.shape[:2] == reduced[::-1]:
+        height, width = width, height
+
+    return image, (height, width)
+
+
+def _segments(f):
+    """
+    Yields (marker, length) of every segment of the JPEG file f up to the
+    first frame or scan header, with f positioned after the length field.
+    The caller must read or skip length - 2 bytes before resuming.
+    """
+    if f.read(2) != b'\xff\xd8':
+        return
+
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return
+        if byte != b'\xff':
+            continue
+
+        # Any number of fill bytes may precede a marker
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return
+
+        marker = ord(marker)
+        if marker in STANDALONE_MARKERS or marker == 0:
+            continue
+
+        length = f.read(2)
+        if len(length) < 2:
+            return
+        length = struct.unpack('>H', length)[0]
+
+        yield marker, length
+
+        # Frame headers end the metadata. Start of scan: entropy coded data
+        # follows.
+        if marker in SOF_MARKERS or marker == 0xDA:
+            return
+
+
+def _parse_exif(tiff):
+    if tiff[:2] == b'II':
+        order = '<'
+    elif tiff[:2] == b'MM':
+        order = '>'
+    else:
+        return None
+
+    try:
+        ifd0 = _read_ifd(tiff, order, struct.unpack(order + 'I', tiff[4:8])[0])
+
+        exif = dict()
+        if EXIF_IFD_TAG in ifd0:
+            exif = _read_ifd(tiff, order, ifd0[EXIF_IFD_TAG])
+    except struct.error:
+        return None
+
+    camera = ' '.join(ifd0[t] for t in (MAKE_TAG, MODEL_TAG)
+                      if ifd0.get(t)) or None
+
+    capture_time = _exif_time(exif.get(DATETIME_ORIGINAL_TAG) or
+                              ifd0.get(DATETIME_TAG),
+                              exif.get(SUBSEC_TIME_ORIGINAL_TAG))
+
+    return camera, capture_time
+
+
+def _read_ifd(tiff, order, offset):
+    """
+    Returns a dict mapping the tags of the IFD at offset to their value, for
+    the ASCII and LONG entries only.
+    """
+    entries = dict()
+
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    for i in range(count):
+        entry = tiff[offset + 2 + 12 * i:offset + 14 + 12 * i]
+        tag, value_type, n, value = struct.unpack(order + 'HHI4s', entry)
+
+        if value_type == EXIF_ASCII:
+            if n > 4:
+                start = struct.unpack(order + 'I', value)[0]
+                value = tiff[start:start + n]
+            entries[tag] = value[:n].split(b'\0')[0].decode(
+                'ascii', 'replace').strip()
+
+        elif value_type == EXIF_LONG and n == 1:
+            entries[tag] = struct.unpack(order + 'I', value)[0]
+
+    return entries
+
+
+def _exif_time(text, subsec):
+    if not text:
+        return None
+
+    try:
+        t = datetime.datetime.strptime(text, EXIF_TIME_FORMAT)
+    except ValueError:
+        return None
+
+    seconds = calendar.timegm(t.timetuple())
+    if subsec and subsec.isdigit():
+        seconds += float('0.' + subsec)
+
+    return seconds
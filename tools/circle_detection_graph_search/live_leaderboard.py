@@ -0,0 +1,260 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+from collections import Counter
+import math
+import os
+import sys
+import time
+
+from run_config import OUTPUT_FILE_PREFIX
+from run_config import PRUNED_FILE_PREFIX
+from scoring import TABLE_EXT
+from scoring import image_loss
+from scoring import load_ground_truth
+from scoring import parse_output_line
+
+
+DEFAULT_TOP         = 20
+DEFAULT_INTERVAL    = 5.0
+
+CLEAR_SCREEN        = '\033[2J\033[H'
+
+
+class Leaderboard(object):
+    """
+    Running losses of partially evaluated configs against a ground truth
+    (a dict of EclipseImages, as returned by scoring.load_ground_truth).
+    Configs are keyed by their params string. An image scored again for the
+    same config replaces its earlier loss.
+    """
+
+    def __init__(self, ground_truth):
+        self.ground_truth = ground_truth
+        self.type_sizes = Counter(img.type for img in ground_truth.values())
+        self.losses = dict()
+
+    def add(self, params, imname, circle1, circle2):
+        exp_img = self.ground_truth.get(imname)
+        if exp_img is None:
+            return
+
+        self.losses.setdefault(params, dict())[imname] = \
+            image_loss(exp_img, circle1, circle2)
+
+    def estimate(self, params):
+        """
+        Returns (estimated total loss, standard error, scored images,
+        observed total loss) of params over the whole ground truth. The
+        estimate is stratified by image type, so it is not skewed by image
+        lists that group images of one type. Types without any scored image
+        are estimated from the config's overall mean.
+        """
+        losses = self.losses.get(params, dict())
+        observed = sum(losses.values())
+        if not losses:
+            return float('inf'), float('inf'), 0, 0
+
+        by_type = dict()
+        for imname, loss in losses.items():
+            by_type.setdefault(self.ground_truth[imname].type, list()).append(
+                loss)
+
+        overall_mean, overall_var = _mean_var(list(losses.values()))
+
+        total = 0.0
+        variance = 0.0
+        for image_type, size in self.type_sizes.items():
+            sample = by_type.get(image_type)
+            if not sample:
+                total += size * overall_mean
+                variance += size * size * overall_var / len(losses)
+                continue
+
+            mean, var = _mean_var(sample)
+            if len(sample) < 2:
+                var = overall_var
+
+            total += size * mean
+
+            # Finite population correction: a fully scored type is exact
+            if len(sample) < size:
+                variance += size * size * var / len(sample) * \
+                    (1 - float(len(sample)) / size)
+
+        return total, math.sqrt(max(variance, 0.0)), len(losses), observed
+
+    def top(self, n=DEFAULT_TOP, min_images=1):
+        """
+        Returns [(params, estimate...)] of the n configs with the lowest
+        estimated total loss among those with at least min_images scored.
+        """
+        rows = [(params, ) + self.estimate(params) for params in self.losses]
+        rows = [r for r in rows if r[3] >= min_images]
+        rows.sort(key=lambda r: (r[1], r[0]))
+        return rows[:n]
+
+    def format(self, n=DEFAULT_TOP, min_images=1):
+        lines = ['{} configs, {} ground truth images'.format(
+                     len(self.losses), len(self.ground_truth)),
+                 '{:>4} {:>12} {:>10} {:>11} {:>12}  {}'.format(
+                     'rank', 'est. total', '+/-', 'images', 'observed',
+                     'params')]
+
+        for rank, (params, total, error, scored, observed) in enumerate(
+                self.top(n, min_images)):
+            lines.append('{:4d} {:12.1f} {:10.1f} {:5d}/{:<5d} {:12.1f}  {}'.format(
+                rank + 1, total, error, scored, len(self.ground_truth),
+                observed, params))
+
+        return '\n'.join(lines)
+
+
+class OutputFileTail(object):
+    """
+    Follows the output_run-{params} and pruned_run-{params} files of a
+    directory, reading the lines appended to them since the last poll. A
+    file that shrinks is read again from the start. Incomplete last lines
+    are left for the next poll.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._offsets = dict()
+
+    def poll(self):
+        """
+        Returns (params, imname, circle1, circle2) of the new lines.
+        """
+        new = list()
+
+        for entry in os.scandir(self.directory):
+            # Only text outputs are followed, not circle_table.py tables
+            if entry.name.endswith(TABLE_EXT):
+                continue
+
+            for prefix in (OUTPUT_FILE_PREFIX, PRUNED_FILE_PREFIX):
+                if entry.name.startswith(prefix):
+                    params = entry.name[len(prefix):]
+                    new.extend((params, ) + r for r in self._read(entry.path))
+                    break
+
+        return new
+
+    def _read(self, fpath):
+        offset = self._offsets.get(fpath, 0)
+
+        try:
+            with open(fpath, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() < offset:
+                    offset = 0
+
+                f.seek(offset)
+                data = f.read()
+        except OSError:
+            return list()
+
+        end = data.rfind(b'\n') + 1
+        self._offsets[fpath] = offset + end
+
+        return [parse_output_line(l) for l in
+                data[:end].decode('utf-8').splitlines() if l.strip()]
+
+
+class LedgerTail(object):
+    """
+    Follows the circles recorded in a results_ledger.py database.
+    """
+
+    def __init__(self, fpath):
+        # Imported here as results_ledger imports detect_circles and cv2,
+        # which following output files does not need
+        from results_ledger import ResultsLedger
+
+        self.ledger = ResultsLedger(fpath)
+        self._row_id = 0
+
+    def poll(self):
+        rows = self.ledger.circles_since(self._row_id)
+        if rows:
+            self._row_id = rows[-1][0]
+
+        return [r[1:] for r in rows]
+
+
+def _mean_var(values):
+    mean = float(sum(values)) / len(values)
+
+    # The spread of a single value is unknown
+    if len(values) < 2:
+        return mean, float('inf')
+
+    var = sum((v - mean) ** 2 for v in values) / (len(values) - 1)
+    return mean, var
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Shows a continuously updated leaderboard of a running '
+                    'sweep, scoring output files (or ledger records) as they '
+                    'are written.')
+    parser.add_argument('ground_truth_file')
+    parser.add_argument('--output-dir', type=str, default='.',
+                        help='directory of the output_run-* files')
+    parser.add_argument('--ledger', type=str, default=None,
+                        help='follow a results_ledger.py database instead')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP)
+    parser.add_argument('--min-images', type=int, default=1,
+                        help='only rank configs with this many images scored')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                        help='seconds between updates')
+    parser.add_argument('--once', default=False, action='store_true',
+                        help='print the leaderboard once and exit')
+    args = parser.parse_args()
+
+    if args.ledger is not None and not os.path.exists(args.ledger):
+        print('Error: {} does not exist'.format(args.ledger), file=sys.stderr)
+        return
+
+    board = Leaderboard(load_ground_truth(args.ground_truth_file))
+
+    if args.ledger is not None:
+        source = LedgerTail(args.ledger)
+    else:
+        source = OutputFileTail(args.output_dir)
+
+    try:
+        while True:
+            for row in source.poll():
+                board.add(*row)
+
+            if not args.once and sys.stdout.isatty():
+                sys.stdout.write(CLEAR_SCREEN)
+
+            print(board.format(args.top, args.min_images))
+            sys.stdout.flush()
+
+            if args.once:
+                break
+
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
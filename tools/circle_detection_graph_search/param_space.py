@@ -0,0 +1,215 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bisect import bisect_right
+import hashlib
+from itertools import product
+import random
+
+
+# Rounds of the Feistel network used to permute indexes
+FEISTEL_ROUNDS = 4
+
+
+class Values(object):
+    """
+    One parameter taking each of values in turn.
+    """
+
+    def __init__(self, name, values):
+        self.name   = name
+        self.values = tuple(values)
+        self.size   = len(self.values)
+
+    def decode(self, i):
+        return {self.name: self.values[i]}
+
+    def iterate(self):
+        for value in self.values:
+            yield {self.name: value}
+
+
+class Fixed(object):
+    """
+    A single assignment of one or more parameters.
+    """
+
+    def __init__(self, **assignment):
+        self.assignment = assignment
+        self.size       = 1
+
+    def decode(self, i):
+        return dict(self.assignment)
+
+    def iterate(self):
+        yield dict(self.assignment)
+
+
+class Product(object):
+    """
+    Every combination of the assignments of children. As with
+    itertools.product, the last child varies fastest.
+    """
+
+    def __init__(self, *children):
+        self.children = children
+        self.size     = 1
+        for child in children:
+            self.size *= child.size
+
+    def decode(self, i):
+        assignment = dict()
+
+        for child in reversed(self.children):
+            i, j = divmod(i, child.size)
+            assignment.update(child.decode(j))
+
+        return assignment
+
+    def iterate(self):
+        for parts in product(*[list(c.iterate()) for c in self.children]):
+            assignment = dict()
+            for part in parts:
+                assignment.update(part)
+            yield assignment
+
+
+class Choice(object):
+    """
+    The assignments of each branch, one branch after the other. Used for
+    conditional parameters that only exist in some branches.
+    """
+
+    def __init__(self, *branches):
+        self.branches = branches
+        self.size     = 0
+        self._starts  = list()
+
+        for branch in branches:
+            self._starts.append(self.size)
+            self.size += branch.size
+
+    def decode(self, i):
+        b = bisect_right(self._starts, i) - 1
+        return self.branches[b].decode(i - self._starts[b])
+
+    def iterate(self):
+        for branch in self.branches:
+            yield from branch.iterate()
+
+
+class ParamSpace(object):
+    """
+    Indexable view of a parameter space described by a tree of Values,
+    Fixed, Product and Choice nodes. Assignments are decoded on demand, so
+    the space is never materialized. make_item turns an assignment dict
+    into the item returned (e.g. a run_config.Config).
+    """
+
+    def __init__(self, root, make_item):
+        self.root       = root
+        self.make_item  = make_item
+
+    def __len__(self):
+        return self.root.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('ParamSpace index out of range')
+
+        return self.make_item(self.root.decode(i))
+
+    def __iter__(self):
+        for assignment in self.root.iterate():
+            yield self.make_item(assignment)
+
+    def permutation(self, seed):
+        return Permutation(len(self), seed)
+
+    def shard(self, k, n, seed=None):
+        """
+        Yields the items of shard k (0 based) of n. Shards are disjoint and
+        together cover the whole space. With a seed, items are drawn in a
+        pseudo random order shared by all shards.
+        """
+        permutation = None
+        if seed is not None:
+            permutation = self.permutation(seed)
+
+        for i in range(k, len(self), n):
+            if permutation is not None:
+                i = permutation[i]
+            yield self[i]
+
+
+class Permutation(object):
+    """
+    Pseudo random permutation of range(size) with O(1) memory and lookup.
+    A Feistel network permutes the smallest even-bit power of two covering
+    size. Indexes mapped past size are passed through the network again
+    (cycle walking) until they land in range.
+    """
+
+    def __init__(self, size, seed):
+        self.size = size
+
+        bits = max(2, (max(size - 1, 1)).bit_length())
+        bits += bits % 2
+        self._half_bits = bits // 2
+        self._half_mask = (1 << self._half_bits) - 1
+
+        rng = random.Random(seed)
+        self._keys = [rng.getrandbits(64) for _ in range(FEISTEL_ROUNDS)]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.size:
+            raise IndexError('Permutation index out of range')
+
+        i = self._encrypt(i)
+        while i >= self.size:
+            i = self._encrypt(i)
+        return i
+
+    def _encrypt(self, i):
+        left = i >> self._half_bits
+        right = i & self._half_mask
+
+        for key in self._keys:
+            left, right = right, left ^ self._round(right, key)
+
+        return (left << self._half_bits) | right
+
+    def _round(self, value, key):
+        digest = hashlib.blake2b(value.to_bytes(8, 'little'), digest_size=8,
+                                 key=key.to_bytes(8, 'little')).digest()
+        return int.from_bytes(digest, 'little') & self._half_mask
+
+
+def parse_shard(text):
+    """
+    Parses a 'k/n' shard specification (shard k, 0 based, of n) as given on
+    the command line. Returns (k, n).
+    """
+    k, n = [int(i) for i in text.split('/')]
+
+    if n < 1 or not 0 <= k < n:
+        raise ValueError('Invalid shard: ' + text)
+
+    return k, n
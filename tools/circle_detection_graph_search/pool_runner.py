@@ -0,0 +1,384 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import queue
+import sys
+import time
+
+import numpy as np
+
+from detect_circles import HOUGH_METHODS
+from detect_circles import HOUGH_OPENCV
+from detect_circles import read_image
+from detect_circles import resize_image
+from detect_circles import result_variant
+from generate_runs import IMAGE_DIR
+from generate_runs import IMAGE_LIST
+from generate_runs import SIZE_VALS
+from generate_runs import build_param_space
+from grid_engine import DEFAULT_CACHE_MB
+from grid_engine import close_streams
+from grid_engine import evaluate_block
+from grid_engine import open_streams
+from grid_engine import read_image_list
+from grid_engine import read_runs_file
+from grid_engine import remaining_configs
+from image_pyramid import ImagePyramid
+from image_store import ALIGNMENT
+from param_space import parse_shard
+from results_ledger import ResultsLedger
+from stage_cache import StageCache
+
+
+DEFAULT_BATCH_SIZE  = 16
+
+# Batches handed to the pool ahead of the results, per worker process. More
+# would only hold configs of a lazily generated shard in memory.
+BATCHES_IN_FLIGHT   = 2
+
+# Set in each worker process by _init_worker
+_worker = None
+
+
+class SharedImages(object):
+    """
+    Decoded grayscale images, resized to each of a set of size bounds, held
+    in one multiprocessing.shared_memory block that every worker process
+    maps. load() and pyramid() have the interface of image_store.ImageStore,
+    so a SharedImages can be passed to grid_engine.evaluate_block as its store.
+    """
+
+    def __init__(self, shm, index, owner=False):
+        self.shm = shm
+        self.index = index
+        self.owner = owner
+
+    @classmethod
+    def create(cls, images, image_dir, size_bounds, reduced=False,
+               full=False):
+        """
+        Decodes every image once (see detect_circles.read_image for
+        reduced), resizes it to each size bound and copies the results into
+        a new shared memory block. With full, the original image is kept
+        too, as the level of its larger dimension. Unreadable images are
+        reported and left out.
+        """
+        levels = list()
+        index = dict()
+        size = 0
+
+        for imname in images:
+            image, original_shape = read_image(image_dir, imname,
+                                               max(size_bounds, default=0),
+                                               reduced=reduced)
+            if image is None:
+                print('Error: {} could not be read'.format(
+                          os.path.join(image_dir, imname)),
+                      file=sys.stderr)
+                continue
+
+            bounds = list(size_bounds)
+            if full:
+                bounds.append(max(original_shape[:2]))
+
+            entry = {'original_shape': tuple(original_shape), 'levels': {}}
+            for size_bound in bounds:
+                resized = resize_image(image, size_bound)
+
+                # Pad so every image starts on an aligned offset
+                size += -size % ALIGNMENT
+                entry['levels'][size_bound] = (size, resized.shape)
+                levels.append((size, resized))
+                size += resized.nbytes
+
+            index[imname] = entry
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        data = np.ndarray((shm.size, ), dtype=np.uint8, buffer=shm.buf)
+
+        for offset, resized in levels:
+            data[offset:offset + resized.nbytes] = resized.reshape(-1)
+
+        return cls(shm, index, owner=True)
+
+    @classmethod
+    def attach(cls, name, index):
+        # Pool workers share the resource tracker of the process that
+        # created the block, so attaching does not change when it is
+        # unlinked
+        return cls(shared_memory.SharedMemory(name=name), index)
+
+    def load(self, imname, size_bound):
+        try:
+            entry = self.index[imname]
+            level = entry['levels'][size_bound]
+        except KeyError:
+            return None, None
+
+        return self._level(*level), entry['original_shape']
+
+    def pyramid(self, imname):
+        """
+        Returns an image_pyramid.ImagePyramid of the shared levels of
+        imname, as image_store.ImageStore.pyramid does, or None.
+        """
+        try:
+            entry = self.index[imname]
+        except KeyError:
+            return None
+
+        levels = [self._level(*l) for l in entry['levels'].values()]
+        return ImagePyramid(levels, entry['original_shape'])
+
+    def _level(self, offset, shape):
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf,
+                          offset=offset)
+
+    def __contains__(self, imname):
+        return imname in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def run(runs, size_bounds, processes, batch_size, output_dir, ledger=None,
+        cache_mb=DEFAULT_CACHE_MB, hough_method=HOUGH_OPENCV, reduced=False,
+        refine=False, joint=False, coarse_bound=None):
+    """
+    Runs all configs in runs (as returned by grid_engine.read_runs_file, or
+    any iterables of configs) on a pool of long lived worker processes. The
+    images of each image list are decoded once into shared memory, for the
+    size bounds in size_bounds. Workers take batch_size configs at a time
+    and evaluate them with grid_engine.evaluate_block, which hough_method,
+    refine, joint and coarse_bound are passed on to. With a coarse_bound,
+    the images are shared at their original resolution instead of
+    size_bounds. At most BATCHES_IN_FLIGHT batches per process are taken
+    from configs ahead of the results. Results are recorded in ledger by
+    this process or, without one, streamed to output files by the workers
+    as each image is done. Returns the number of configs evaluated.
+    """
+    n = 0
+    variant = result_variant(hough_method, refine, joint, coarse_bound)
+
+    # detect_coarse_to_fine only needs the original images
+    full = coarse_bound is not None
+    if full:
+        size_bounds = list()
+
+    for (image_list, image_dir), configs in runs.items():
+        images = read_image_list(image_list)
+
+        t = time.time()
+        shared = SharedImages.create(images, image_dir, size_bounds, reduced,
+                                     full)
+        print('Decoded {} images into {} MB of shared memory in {:.1f} s'
+              .format(len(shared), shared.shm.size // (1024 * 1024),
+                      time.time() - t))
+
+        if len(shared) == 0:
+            print('Error: no images found in {}'.format(image_list),
+                  file=sys.stderr)
+            shared.close()
+            continue
+
+        completed = set()
+        if ledger is not None:
+            completed = ledger.completed()
+
+        pool = multiprocessing.Pool(
+            processes, _init_worker,
+            (shared.shm.name, shared.index,
+             [i for i in images if i in shared], image_dir, cache_mb,
+             hough_method, refine, joint, coarse_bound,
+             output_dir if ledger is None else None))
+
+        try:
+            skipped = [0]
+            batches = _batches(remaining_configs(configs, completed, skipped,
+                                                 variant),
+                               batch_size)
+
+            # Unlike imap_unordered, which takes every batch up front, only
+            # hand out a batch once an earlier one is done
+            done = queue.Queue()
+            in_flight = 0
+            for batch in batches:
+                if in_flight == BATCHES_IN_FLIGHT * processes:
+                    n += _record(_result(done), ledger, variant)
+                    in_flight -= 1
+
+                pool.apply_async(_run_batch, (batch, ), callback=done.put,
+                                 error_callback=done.put)
+                in_flight += 1
+
+            for _ in range(in_flight):
+                n += _record(_result(done), ledger, variant)
+        finally:
+            pool.terminate()
+            pool.join()
+            shared.close()
+
+        if ledger is not None:
+            print('Skipped {} completed configs'.format(skipped[0]))
+
+    return n
+
+
+def _batches(configs, batch_size):
+    batch = list()
+
+    for config in configs:
+        batch.append(config)
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+
+    if batch:
+        yield batch
+
+
+def _result(done):
+    result = done.get()
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def _record(results, ledger, variant):
+    # Without a ledger, workers stream the output files themselves
+    if ledger is not None:
+        for config, (circles, runtime) in results.items():
+            ledger.record(config, circles, runtime, variant=variant)
+
+    return len(results)
+
+
+def _init_worker(shm_name, index, images, image_dir, cache_mb, hough_method,
+                 refine, joint, coarse_bound, output_dir):
+    global _worker
+
+    cache = None
+    if cache_mb > 0:
+        cache = StageCache(cache_mb * 1024 * 1024)
+
+    _worker = {
+        'store':        SharedImages.attach(shm_name, index),
+        'images':       images,
+        'image_dir':    image_dir,
+        'cache':        cache,
+        'hough_method': hough_method,
+        'refine':       refine,
+        'joint':        joint,
+        'coarse_bound': coarse_bound,
+        'output_dir':   output_dir,
+        'variant':      result_variant(hough_method, refine, joint,
+                                       coarse_bound),
+    }
+
+
+def _run_batch(batch):
+    """
+    Returns a dict mapping each config of batch to (circles, runtime).
+    """
+    streams = None
+    if _worker['output_dir'] is not None:
+        streams = open_streams(batch, _worker['output_dir'],
+                               variant=_worker['variant'])
+
+    runtimes = dict()
+    try:
+        results = evaluate_block(batch, _worker['images'],
+                                 _worker['image_dir'], _worker['cache'],
+                                 _worker['store'], runtimes,
+                                 _worker['hough_method'], _worker['refine'],
+                                 _worker['joint'], streams,
+                                 _worker['coarse_bound'])
+    finally:
+        if streams is not None:
+            close_streams(streams)
+
+    return dict((c, (circles, runtimes.get(c)))
+                for c, circles in results.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Runs a runs file (or a shard of the generate_runs.py '
+                    'grid) on a pool of worker processes sharing the '
+                    'decoded images in shared memory, instead of one '
+                    'detect_circles.py process per configuration.')
+    parser.add_argument('runs_file', nargs='?', default=None,
+                        help='runs file; if omitted, configs are decoded '
+                             'directly from the generate_runs.py grid')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help='k/n: without a runs file, only run shard k '
+                             '(0 based) of n of the grid')
+    parser.add_argument('--shuffle-seed', type=int, default=None)
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='configs handed to a worker at a time')
+    parser.add_argument('--output-dir', type=str, default='.')
+    parser.add_argument('--cache-mb', type=int, default=DEFAULT_CACHE_MB,
+                        help='per worker memory budget for cached '
+                             'preprocessing stages, 0 disables caching')
+    parser.add_argument('--ledger', type=str, default=None)
+    parser.add_argument('--hough-method', choices=HOUGH_METHODS,
+                        default=HOUGH_OPENCV)
+    parser.add_argument('--reduced-decode', action='store_true')
+    parser.add_argument('--refine', action='store_true')
+    parser.add_argument('--joint', action='store_true')
+    parser.add_argument('--coarse-bound', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.coarse_bound is not None and (args.refine or args.joint or
+                                          args.reduced_decode):
+        parser.error('--coarse-bound cannot be combined with --refine, '
+                     '--joint or --reduced-decode')
+
+    t = time.time()
+
+    ledger = None
+    if args.ledger is not None:
+        ledger = ResultsLedger(args.ledger)
+
+    if args.runs_file is not None:
+        runs = read_runs_file(args.runs_file)
+        size_bounds = sorted(set(c.size_bound for configs in runs.values()
+                                 for c in configs))
+    else:
+        k, n = args.shard if args.shard is not None else (0, 1)
+        runs = {(IMAGE_LIST, IMAGE_DIR):
+                build_param_space().shard(k, n, args.shuffle_seed)}
+        size_bounds = list(SIZE_VALS)
+
+    n = run(runs, size_bounds, args.processes, args.batch_size,
+            args.output_dir, ledger, args.cache_mb, args.hough_method,
+            args.reduced_decode, args.refine, args.joint, args.coarse_bound)
+
+    print('{} configs, elapsed: {}'.format(n, time.time() - t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_DEPTH       = 4
+DEFAULT_MAX_MB      = 1024
+
+
+class Prefetcher(object):
+    """
+    Iterates over (item, load(item)) for every item of items, in order,
+    while up to depth of the following items are loaded ahead on a pool of
+    threads (depth of them by default, so slow reads overlap). A load is
+    only started while the loaded but not yet consumed results, plus every
+    load in flight and the new one at the size of the largest result so
+    far, fit in max_mb MB of NumPy arrays (results are sized by the nbytes
+    of their elements). Until the first result is in, one load at a time is
+    in flight. The next item is loaded whatever the cap, so a single result
+    larger than it is still returned.
+
+    load should release the GIL for most of its work, as cv2.imread does.
+    Exceptions raised by load are raised when its item is reached. Use as
+    a context manager, or call close(), to stop loading early.
+    """
+
+    def __init__(self, items, load, depth=DEFAULT_DEPTH, max_mb=DEFAULT_MAX_MB,
+                 threads=None):
+        self.items = iter(items)
+        self.load = load
+        self.depth = max(1, depth)
+        self.max_bytes = max_mb * 1024 * 1024
+
+        if threads is None:
+            threads = self.depth
+        self._executor = ThreadPoolExecutor(max(1, min(threads, self.depth)))
+        self._pending = deque()
+        self._exhausted = False
+        self._sized = False
+        self._largest = 0
+
+    def __iter__(self):
+        try:
+            while True:
+                self._fill()
+                if not self._pending:
+                    return
+
+                item, future = self._pending.popleft()
+                result = future.result()
+                self._measure(result)
+                yield item, result
+        finally:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+    def _fill(self):
+        while not self._exhausted and len(self._pending) < self.depth:
+            # The next item is always loaded, whatever the cap
+            if self._pending and not self._fits():
+                return
+
+            try:
+                item = next(self.items)
+            except StopIteration:
+                self._exhausted = True
+                return
+
+            self._pending.append((item, self._executor.submit(self.load,
+                                                              item)))
+
+    def _fits(self):
+        held = 0
+        loading = 1
+        for _, future in self._pending:
+            if not future.done():
+                loading += 1
+            elif future.exception() is None:
+                held += self._measure(future.result())
+
+        if not self._sized:
+            return False
+        return held + loading * self._largest <= self.max_bytes
+
+    def _measure(self, result):
+        size = _nbytes(result)
+        self._sized = True
+        self._largest = max(self._largest, size)
+        return size
+
+
+def _nbytes(result):
+    if isinstance(result, (tuple, list)):
+        return sum(_nbytes(r) for r in result)
+    return getattr(result, 'nbytes', 0)
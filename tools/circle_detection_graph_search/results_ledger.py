@@ -0,0 +1,279 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from detect_circles import format_output_line
+from run_config import OUTPUT_FILE_PREFIX
+from run_config import PRUNED_FILE_PREFIX
+from run_config import config_fingerprint
+from run_config import output_file_name
+from run_config import parse_output_file_name
+from run_config import parse_result_key
+from run_config import result_key
+from scoring import load_results
+
+
+STATUS_DONE     = 'done'
+STATUS_PRUNED   = 'pruned'
+
+# Seconds a writer waits for another process to release the database
+BUSY_TIMEOUT    = 300
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    fingerprint     TEXT PRIMARY KEY,
+    params          TEXT NOT NULL,
+    status          TEXT NOT NULL,
+    runtime         REAL,
+    n_images        INTEGER NOT NULL,
+    recorded        REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS circles (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    fingerprint     TEXT NOT NULL,
+    image           TEXT NOT NULL,
+    solar_x         INTEGER,
+    solar_y         INTEGER,
+    solar_r         INTEGER,
+    lunar_x         INTEGER,
+    lunar_y         INTEGER,
+    lunar_r         INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS circles_fingerprint ON circles (fingerprint);
+'''
+
+CIRCLE_COLUMNS = ('fingerprint, image, solar_x, solar_y, solar_r, lunar_x, '
+                  'lunar_y, lunar_r')
+
+
+class ResultsLedger(object):
+    """
+    SQLite store of grid search results, keyed by
+    run_config.config_fingerprint. Several processes (or machines sharing a
+    local disk) can record into the same ledger; each config's results are
+    written in a single transaction, so a crashed run never leaves a
+    partially recorded config behind.
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self._conn = sqlite3.connect(fpath, timeout=BUSY_TIMEOUT)
+
+        # Write ahead logging lets readers proceed while another process is
+        # writing
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+
+    def record(self, config, circles, runtime=None, status=STATUS_DONE,
+               variant=''):
+        """
+        Records the results of config, run with the detection variant
+        variant (see detect_circles.result_variant). circles is a list of
+        (imname, circle1, circle2), as returned by grid_engine.evaluate_block.
+        """
+        fingerprint = config_fingerprint(config, variant)
+
+        rows = [(fingerprint, imname) + _circle_columns(circle1) +
+                _circle_columns(circle2)
+                for imname, circle1, circle2 in circles]
+
+        with self._conn:
+            self._conn.execute('DELETE FROM circles WHERE fingerprint = ?',
+                               (fingerprint, ))
+            self._conn.executemany(
+                'INSERT INTO circles ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+                .format(CIRCLE_COLUMNS), rows)
+            self._conn.execute(
+                'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                (fingerprint, result_key(config, variant), status, runtime,
+                 len(rows), time.time()))
+
+    def completed(self):
+        """
+        Returns the set of fingerprints of every recorded config.
+        """
+        return set(r[0] for r in
+                   self._conn.execute('SELECT fingerprint FROM runs'))
+
+    def is_complete(self, config, variant=''):
+        row = self._conn.execute('SELECT 1 FROM runs WHERE fingerprint = ?',
+                                 (config_fingerprint(config, variant), )
+                                 ).fetchone()
+        return row is not None
+
+    def runs(self, status=None):
+        """
+        Returns a list of (config, variant, status, runtime, n_images).
+        """
+        query = 'SELECT params, status, runtime, n_images FROM runs'
+        args = ()
+        if status is not None:
+            query += ' WHERE status = ?'
+            args = (status, )
+
+        return [parse_result_key(r[0]) + r[1:]
+                for r in self._conn.execute(query, args)]
+
+    def circles(self, config, variant=''):
+        """
+        Returns the recorded (imname, circle1, circle2) of config.
+        """
+        rows = self._conn.execute(
+            'SELECT image, solar_x, solar_y, solar_r, lunar_x, lunar_y, '
+            'lunar_r FROM circles WHERE fingerprint = ? ORDER BY id',
+            (config_fingerprint(config, variant), ))
+
+        return [(r[0], _circle_from_columns(r[1:4]),
+                 _circle_from_columns(r[4:7])) for r in rows]
+
+    def circles_since(self, row_id):
+        """
+        Returns (id, params, imname, circle1, circle2) of every circle row
+        recorded after the row row_id, in recording order. Row ids are
+        never reused, so re-recorded configs show up again with new ids.
+        """
+        rows = self._conn.execute(
+            'SELECT c.id, r.params, c.image, c.solar_x, c.solar_y, '
+            'c.solar_r, c.lunar_x, c.lunar_y, c.lunar_r FROM circles c '
+            'JOIN runs r ON c.fingerprint = r.fingerprint '
+            'WHERE c.id > ? ORDER BY c.id', (row_id, ))
+
+        return [r[:3] + (_circle_from_columns(r[3:6]),
+                         _circle_from_columns(r[6:9])) for r in rows]
+
+    def close(self):
+        self._conn.close()
+
+
+def import_output_files(ledger, paths):
+    """
+    Records existing output_run-{params} (and pruned_run-{params}) files in
+    ledger. Directories in paths are scanned for such files. Returns the
+    number of files imported.
+    """
+    n = 0
+
+    for fpath in _iter_output_files(paths):
+        status = STATUS_DONE
+        if os.path.basename(fpath).startswith(PRUNED_FILE_PREFIX):
+            status = STATUS_PRUNED
+
+        config, variant = parse_output_file_name(fpath)
+        ledger.record(config, load_results(fpath), status=status,
+                      variant=variant)
+        n += 1
+
+    return n
+
+
+def export_output_files(ledger, output_dir):
+    """
+    Writes an output_run-{params} file for every completed config in
+    ledger, e.g. to score them with compute_imgproc_loss.py. Returns the
+    number of files written.
+    """
+    n = 0
+
+    for config, variant, _, _, _ in ledger.runs(STATUS_DONE):
+        fname = output_file_name(config, variant)
+        with open(os.path.join(output_dir, fname), 'w') as f:
+            f.writelines([format_output_line(*c)
+                          for c in ledger.circles(config, variant)])
+        n += 1
+
+    return n
+
+
+def _iter_output_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for entry in os.scandir(path):
+            if entry.name.startswith((OUTPUT_FILE_PREFIX, PRUNED_FILE_PREFIX)):
+                yield entry.path
+
+
+def _circle_columns(circle):
+    if circle is None:
+        return (None, None, None)
+    return tuple(int(i) for i in circle)
+
+
+def _circle_from_columns(columns):
+    if columns[0] is None:
+        return None
+    return tuple(columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Manages a grid search results ledger.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    import_parser = subparsers.add_parser(
+        'import', help='record existing output_run-* files')
+    import_parser.add_argument('ledger')
+    import_parser.add_argument('paths', nargs='+',
+                               help='output files or directories of them')
+
+    export_parser = subparsers.add_parser(
+        'export', help='write output_run-* files for completed configs')
+    export_parser.add_argument('ledger')
+    export_parser.add_argument('--output-dir', type=str, default='.')
+
+    status_parser = subparsers.add_parser(
+        'status', help='summarize the recorded configs')
+    status_parser.add_argument('ledger')
+
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+
+    ledger = ResultsLedger(args.ledger)
+
+    if args.command == 'import':
+        n = import_output_files(ledger, args.paths)
+        print('Imported {} files'.format(n))
+
+    elif args.command == 'export':
+        n = export_output_files(ledger, args.output_dir)
+        print('Exported {} files'.format(n))
+
+    elif args.command == 'status':
+        counts = dict()
+        for _, _, status, _, _ in ledger.runs():
+            counts[status] = counts.get(status, 0) + 1
+
+        if not counts:
+            print('No configs recorded', file=sys.stderr)
+        for status in sorted(counts):
+            print('{}: {}'.format(status, counts[status]))
+
+    ledger.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import namedtuple
+import hashlib
+import os
+import shlex
+
+
+PARAM_NAMES = (
+    'size_bound',
+    'enable_unsharp',
+    'unsharp_blur_type',
+    'unsharp_blur_ksize',
+    'unsharp_blur_sigmaXY',
+    'unsharp_add_weight',
+    'unsharp_gamma',
+    'blur_type',
+    'blur_ksize',
+    'blur_sigmaXY',
+    'dp',
+    'minDist',
+    'param1',
+    'param2',
+    'minRadius',
+    'maxRadius',
+)
+
+# One detect_circles.py parameter configuration, in command line order
+# (excluding the image list and image directory arguments)
+Config = namedtuple('Config', PARAM_NAMES)
+
+OUTPUT_FILE_PREFIX = 'output_run-'
+PRUNED_FILE_PREFIX = 'pruned_run-'
+
+# Separates the params of a result key from its variant, e.g. the Hough
+# method (see detect_circles.result_variant)
+VARIANT_SEP = '-'
+
+
+def parse_config(args):
+    """
+    Builds a Config from the 16 detect_circles.py parameter strings that
+    follow image_list.txt and image_dir on the command line. Raises
+    IndexError if arguments are missing.
+    """
+    return Config(
+        size_bound              = int(args[0]),
+        enable_unsharp          = args[1] == '1',
+        unsharp_blur_type       = args[2],
+        unsharp_blur_ksize      = int(args[3]),
+        unsharp_blur_sigmaXY    = int(args[4]),
+        unsharp_add_weight      = float(args[5]),
+        unsharp_gamma           = int(args[6]),
+        blur_type               = args[7],
+        blur_ksize              = int(args[8]),
+        blur_sigmaXY            = int(args[9]),
+        dp                      = int(args[10]),
+        minDist                 = int(args[11]),
+        param1                  = int(args[12]),
+        param2                  = int(args[13]),
+        minRadius               = int(args[14]),
+        maxRadius               = int(args[15]),
+    )
+
+
+def parse_invocation(line):
+    """
+    Parses one line printed by generate_runs.py, i.e.
+    'python3 detect_circles.py <image_list> <image_dir> <params...>'.
+    Returns (image_list, image_dir, Config).
+    """
+    tokens = shlex.split(line)
+
+    # Skip over the interpreter and script name
+    while tokens and not tokens[0].endswith('detect_circles.py'):
+        tokens.pop(0)
+
+    args = tokens[1:]
+    return args[0], args[1], parse_config(args[2:])
+
+
+def output_file_name(config, variant=''):
+    """
+    Name of the file detect_circles.py writes its results to for config,
+    run with the detection variant variant.
+    """
+    return OUTPUT_FILE_PREFIX + result_key(config, variant)
+
+
+def parse_output_file_name(fname):
+    """
+    Inverse of output_file_name (and pruned_file_name). Returns the
+    (Config, variant) encoded in an output_run-{params} file name.
+    """
+    name = os.path.basename(fname)
+
+    for prefix in (OUTPUT_FILE_PREFIX, PRUNED_FILE_PREFIX):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+            break
+    else:
+        raise ValueError('Not a detect_circles.py output file: ' + fname)
+
+    return parse_result_key(name)
+
+
+def config_params_str(config):
+    """
+    Canonical string form of config, as used in output file names.
+    """
+    return '_'.join([str(i) for i in config])
+
+
+def parse_config_params_str(params):
+    """
+    Inverse of config_params_str.
+    """
+    args = params.split('_')
+
+    # enable_unsharp is written out as True/False
+    args[1] = '1' if args[1] == 'True' else '0'
+
+    return parse_config(args)
+
+
+def result_key(config, variant=''):
+    """
+    config_params_str of config, followed by variant unless it is empty.
+    Results of different detection variants of a config are kept apart by
+    it, while those of the default one keep the plain params string.
+    """
+    params = config_params_str(config)
+    if not variant:
+        return params
+
+    return params + VARIANT_SEP + variant
+
+
+def parse_result_key(key):
+    """
+    Inverse of result_key. Returns (Config, variant).
+    """
+    params, _, variant = key.partition(VARIANT_SEP)
+    return parse_config_params_str(params), variant
+
+
+def config_fingerprint(config, variant=''):
+    """
+    Stable identifier of config run with the detection variant variant,
+    used to key stored results.
+    """
+    return hashlib.sha1(result_key(config, variant).encode('utf-8')) \
+        .hexdigest()
+
+
+def pruned_file_name(config, variant=''):
+    """
+    Name detect_circles.py gives the results of config when the run was
+    stopped early for exceeding its loss budget.
+    """
+    return PRUNED_FILE_PREFIX + result_key(config, variant)
@@ -0,0 +1,71 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+# compute_loss is a directory of scripts rather than a package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'compute_loss'))
+
+# Re-exported for scripts that tell circle_table.py tables apart
+from circle_table import TABLE_EXT
+from compute_imgproc_loss import IMAGE_PATH_IDX
+from compute_imgproc_loss import LUNAR_CIRCLE_IDX
+from compute_imgproc_loss import SOLAR_CIRCLE_IDX
+from compute_imgproc_loss import _compute_single_loss
+from compute_imgproc_loss import _parse_circle_str
+from compute_imgproc_loss import read_eclipse_data_file
+from eclipse_image import EclipseImage
+
+
+def load_ground_truth(fpath):
+    """
+    Returns a dict mapping image names to ground truth EclipseImages.
+    """
+    return read_eclipse_data_file(fpath)
+
+
+def image_loss(exp_img, circle1, circle2):
+    """
+    Loss of one detection (circle1 taken as the solar circle and circle2 as
+    the lunar circle, as in output_run-{params} files) against the ground
+    truth EclipseImage exp_img.
+    """
+    act_img = EclipseImage()
+    act_img.solar_circle = circle1
+    act_img.lunar_circle = circle2
+
+    return _compute_single_loss(exp_img, act_img)
+
+
+def parse_output_line(line):
+    """
+    Inverse of detect_circles.format_output_line. Returns
+    (imname, circle1, circle2).
+    """
+    fields = line.strip().split('|')
+    return (fields[IMAGE_PATH_IDX],
+            _parse_circle_str(fields[SOLAR_CIRCLE_IDX]),
+            _parse_circle_str(fields[LUNAR_CIRCLE_IDX]))
+
+
+def load_results(fpath):
+    """
+    Reads an output_run-{params} file. Returns a list of
+    (imname, circle1, circle2).
+    """
+    return [(imname, img.solar_circle, img.lunar_circle)
+            for imname, img in read_eclipse_data_file(fpath).items()]
@@ -0,0 +1,167 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import os
+
+import instrumentation
+from coarse_to_fine import refine_candidates
+from detect_circles import HOUGH_OPENCV
+from detect_circles import compute_circles
+from detect_circles import preprocess_config
+from detect_circles import resize_image
+from detect_circles import scale_circles_to_shape
+from jpeg_decode import capture_info
+
+
+# Frames further apart than this many seconds start a new sequence
+MAX_FRAME_GAP       = 10.0
+
+# A tracked circle whose center moved more than this fraction of its
+# previous radius is not trusted
+MAX_SHIFT           = 0.2
+
+# Frames tracked in a row before the whole image is searched again, to pick
+# up circles the previous search missed
+REDETECT_INTERVAL   = 25
+
+
+def frame_sequences(images, image_dir):
+    """
+    Splits images into sequences of consecutive frames from one camera,
+    using their EXIF capture time and camera. Returns a list of lists of
+    image names, each in capture order. A new sequence starts wherever the
+    camera changes or MAX_FRAME_GAP seconds pass between frames. Images
+    without a capture time form sequences of their own, after the others.
+    """
+    timed = list()
+    untimed = list()
+
+    for i, imname in enumerate(images):
+        info = capture_info(os.path.join(image_dir, imname))
+        if info is None or info[1] is None:
+            untimed.append([imname])
+        else:
+            camera, capture_time = info
+            timed.append((camera or '', capture_time, i, imname))
+
+    timed.sort()
+
+    sequences = list()
+    previous = None
+
+    for camera, capture_time, _, imname in timed:
+        if previous is None or camera != previous[0] or \
+           capture_time - previous[1] > MAX_FRAME_GAP:
+            sequences.append(list())
+
+        sequences[-1].append(imname)
+        previous = (camera, capture_time)
+
+    return sequences + untimed
+
+
+class SequenceTracker(object):
+    """
+    Detects the circles of the frames of a sequence, one frame after the
+    other. Once a search of the whole frame has found circles, the next
+    frames are only searched in a region around the previous circles and
+    within coarse_to_fine.RADIUS_TOLERANCE of their radii. The whole frame
+    is searched again when a circle is lost, moves more than MAX_SHIFT of
+    its radius, the frame size changes, or REDETECT_INTERVAL frames have
+    been tracked.
+    """
+
+    def __init__(self, config, hough_method=HOUGH_OPENCV):
+        self.config = config
+        self.hough_method = hough_method
+
+        self.full_searches = 0
+        self.tracked = 0
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the previous frame, e.g. at the start of a new sequence.
+        """
+        self._circles = list()
+        self._shape = None
+        self._run = 0
+
+    def detect(self, image, original_shape=None):
+        """
+        detect_circles.detect_image_circles for the next frame of the
+        sequence. Returns (circle1, circle2) in original image coordinates.
+        """
+        if original_shape is None:
+            original_shape = image.shape
+
+        # Circles are tracked at the config's resolution
+        with instrumentation.stage('resize'):
+            resized = resize_image(image, self.config.size_bound)
+
+        circles = None
+        if self._circles and resized.shape == self._shape and \
+           self._run < REDETECT_INTERVAL:
+            circles = self._track(resized)
+
+        if circles is None:
+            circles = self._search(resized)
+            self.full_searches += 1
+            self._run = 0
+        else:
+            self.tracked += 1
+            self._run += 1
+
+        self._circles = [tuple(int(round(v)) for v in c)
+                         for c in circles if c is not None]
+        self._shape = resized.shape
+
+        with instrumentation.stage('scale'):
+            return scale_circles_to_shape(circles[0], circles[1],
+                                          original_shape, resized.shape)
+
+    def _search(self, resized):
+        """
+        Returns the (circle1, circle2) of a search of the whole frame, at
+        the frame's resolution.
+        """
+        config = self.config
+        processed = preprocess_config(resized, config)
+
+        return compute_circles(processed, config.dp, config.minDist,
+                               config.param1, config.param2, config.minRadius,
+                               config.maxRadius, self.hough_method)
+
+    def _track(self, resized):
+        """
+        Returns the circles found around the previous ones, or None if any
+        of them was lost. Circles keep the order of the previous frame, so
+        the solar and lunar circles stay apart while they overlap.
+        """
+        matches = refine_candidates(resized, self.config, self._circles,
+                                    self.hough_method)
+
+        for (x, y, r), match in zip(self._circles, matches):
+            if match is None:
+                return None
+
+            cx, cy, _ = match[1]
+            if math.hypot(cx - x, cy - y) > MAX_SHIFT * r:
+                return None
+
+        circles = [m[1] for m in matches]
+        return circles + [None] * (2 - len(circles))
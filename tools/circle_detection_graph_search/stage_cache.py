@@ -0,0 +1,80 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class StageCache(object):
+    """
+    LRU cache of intermediate preprocessing results (numpy arrays) keyed by
+    the parameter prefix that produced them. The total size of the cached
+    arrays is kept under max_bytes by evicting the least recently used
+    entries.
+
+    Cached arrays are shared between callers and must not be modified in
+    place.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes  = max_bytes
+        self.nbytes     = 0
+        self.hits       = 0
+        self.misses     = 0
+        self._entries   = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the array cached under key, or None.
+        """
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        # Arrays larger than the whole budget are never cached
+        if value.nbytes > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key).nbytes
+
+        self._entries[key] = value
+        self.nbytes += value.nbytes
+
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        template = '<{0} entries: {1} bytes: {2}/{3} hits: {4} misses: {5}>'
+        return template.format(self.__class__.__name__, len(self),
+                               self.nbytes, self.max_bytes, self.hits,
+                               self.misses)
@@ -0,0 +1,203 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import math
+import random
+import sys
+import time
+
+from generate_runs import IMAGE_DIR
+from generate_runs import format_program_invocation
+from generate_runs import build_param_space
+from grid_engine import DEFAULT_CACHE_MB
+from grid_engine import evaluate_block
+from image_store import ImageStore
+from scoring import image_loss
+from scoring import load_ground_truth
+from stage_cache import StageCache
+
+
+DEFAULT_NUM_CONFIGS     = 729
+DEFAULT_MIN_IMAGES      = 8
+DEFAULT_ETA             = 3
+DEFAULT_TOP             = 10
+
+
+def stratified_order(ground_truth, rng):
+    """
+    Orders the ground truth images so that every prefix of the order has
+    roughly the same proportion of each image type as the whole set.
+    """
+    by_type = dict()
+    for imname in sorted(ground_truth):
+        by_type.setdefault(ground_truth[imname].type, list()).append(imname)
+
+    keyed = list()
+    for names in by_type.values():
+        rng.shuffle(names)
+
+        # Spread each type evenly over [0, 1), with a random phase so that
+        # no type is always drawn first
+        phase = rng.random()
+        for i, imname in enumerate(names):
+            keyed.append(((i + phase) / len(names), imname))
+
+    return [imname for _, imname in sorted(keyed)]
+
+
+def sample_configs(n, rng):
+    """
+    Draws n distinct configurations uniformly from the generate_runs.py grid.
+    """
+    space = build_param_space()
+    return [space[i] for i in rng.sample(range(len(space)), min(n, len(space)))]
+
+
+def successive_halving(configs, images, ground_truth, image_dir, min_images,
+                       eta, cache=None, store=None):
+    """
+    Scores configs on the first min_images of images, keeps the best
+    1 / eta of them, and repeats with eta times more images until the
+    survivors have been scored on every image. Images scored in earlier
+    rungs are not evaluated again.
+
+    Returns a list of (mean_loss, n_images, config) for the configs of the
+    last rung, best first, which is empty without configs.
+    """
+    if not configs:
+        return list()
+
+    scores      = dict((c, [0.0, 0]) for c in configs)
+    survivors   = list(configs)
+    n_done      = 0
+    n_images    = min_images
+
+    while True:
+        t = time.time()
+        n_images = min(n_images, len(images))
+
+        results = evaluate_block(survivors, images[n_done:n_images],
+                                 image_dir, cache, store)
+
+        for config, circles in results.items():
+            for imname, circle1, circle2 in circles:
+                scores[config][0] += image_loss(ground_truth[imname],
+                                                circle1, circle2)
+                scores[config][1] += 1
+
+        ranked = sorted(survivors, key=lambda c: _mean_loss(scores[c]))
+        n_done = n_images
+
+        print('Rung: {} configs x {} images, best avg loss {}, '
+              'elapsed: {}'.format(len(survivors), n_images,
+                                   _mean_loss(scores[ranked[0]]),
+                                   time.time() - t))
+
+        if n_images >= len(images):
+            break
+
+        survivors = ranked[:max(1, len(ranked) // eta)]
+        n_images *= eta
+
+    return [(_mean_loss(scores[c]), scores[c][1], c) for c in ranked]
+
+
+def hyperband(images, ground_truth, image_dir, min_images, eta, rng,
+              cache=None, store=None):
+    """
+    Runs successive halving brackets that trade off the number of configs
+    against the number of images they are first scored on, from many
+    configs on min_images images to few configs on all images.
+
+    Returns the merged final rungs of all brackets, best first.
+    """
+    s_max = max(0, int(math.log(len(images) / float(min_images), eta)))
+    final = list()
+
+    for s in range(s_max, -1, -1):
+        n_configs   = int(math.ceil((s_max + 1) / float(s + 1) * eta ** s))
+        n_images    = max(min_images, int(len(images) / eta ** s))
+
+        print('Bracket s={}: {} configs starting on {} images'.format(
+            s, n_configs, n_images))
+
+        final.extend(successive_halving(
+            sample_configs(n_configs, rng), images, ground_truth, image_dir,
+            n_images, eta, cache, store))
+
+    return sorted(final, key=lambda r: r[0])
+
+
+def _mean_loss(score):
+    if score[1] == 0:
+        return float('inf')
+    return score[0] / score[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Successive halving / Hyperband search over the '
+                    'generate_runs.py parameter grid, scored against a '
+                    'ground truth file.')
+    parser.add_argument('ground_truth_file')
+    parser.add_argument('--image-dir', type=str, default=IMAGE_DIR)
+    parser.add_argument('--image-store', type=str, default=None)
+    parser.add_argument('--num-configs', type=int, default=DEFAULT_NUM_CONFIGS,
+                        help='configs sampled for plain successive halving')
+    parser.add_argument('--min-images', type=int, default=DEFAULT_MIN_IMAGES,
+                        help='images in the first (smallest) rung')
+    parser.add_argument('--eta', type=int, default=DEFAULT_ETA,
+                        help='1 / eta of the configs advance to each rung')
+    parser.add_argument('--hyperband', default=False, action='store_true')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP)
+    parser.add_argument('--cache-mb', type=int, default=DEFAULT_CACHE_MB)
+    args = parser.parse_args()
+
+    t = time.time()
+    rng = random.Random(args.seed)
+
+    ground_truth = load_ground_truth(args.ground_truth_file)
+    images = stratified_order(ground_truth, rng)
+
+    cache = None
+    if args.cache_mb > 0:
+        cache = StageCache(args.cache_mb * 1024 * 1024)
+
+    store = None
+    if args.image_store is not None:
+        store = ImageStore(args.image_store)
+
+    if args.hyperband:
+        ranked = hyperband(images, ground_truth, args.image_dir,
+                           args.min_images, args.eta, rng, cache, store)
+    else:
+        ranked = successive_halving(
+            sample_configs(args.num_configs, rng), images, ground_truth,
+            args.image_dir, args.min_images, args.eta, cache, store)
+
+    if not ranked:
+        print('Error: no configs to search', file=sys.stderr)
+
+    for mean_loss, n_images, config in ranked[:args.top]:
+        print('{} ({} images): {}'.format(mean_loss, n_images,
+                                          format_program_invocation(config)))
+
+    print('Elapsed: ' + str(time.time() - t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import cv2
+import numpy as np
+
+from coarse_to_fine import detect_coarse_to_fine
+from coarse_to_fine import scale_config
+from detect_circles import detect_image_circles
+from run_config import parse_config
+
+
+DISK        = (2077, 1141, 449)
+SHAPE       = (2600, 3900)
+
+CONFIGS     = [
+    '1800 0 g 0 0 0 0 g 9 0 1 1 30 60 56 1800',
+    '1200 1 g 9 5 0.8 0 m 9 0 2 1 30 30 37 1200',
+]
+
+
+def synthetic_disk(disk=DISK, shape=SHAPE, noise=40, seed=0):
+    """
+    A bright disk on a dark background, blurred and with uniform noise.
+    """
+    image = np.full(shape, 20, np.uint8)
+    cv2.circle(image, disk[:2], disk[2], 230, -1)
+    image = cv2.GaussianBlur(image, (5, 5), 0)
+
+    noise = np.random.RandomState(seed).randint(0, noise, shape)
+    return cv2.add(image, noise.astype(np.uint8))
+
+
+def error(circle, disk=DISK):
+    return max(abs(a - b) for a, b in zip(circle, disk))
+
+
+class CoarseToFineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.image = synthetic_disk()
+
+    def test_scale_config_keeps_param2(self):
+        config = parse_config(CONFIGS[0].split())
+        coarse = scale_config(config, 400)
+
+        self.assertEqual(coarse.param2, config.param2)
+        self.assertEqual(coarse.minRadius, 12)
+        self.assertEqual(coarse.maxRadius, 400)
+
+    def test_accuracy_is_kept(self):
+        for params in CONFIGS:
+            config = parse_config(params.split())
+
+            circle1, _ = detect_coarse_to_fine(self.image, config, 400)
+            plain, _ = detect_image_circles(self.image, config)
+
+            self.assertLessEqual(error(circle1), 2, params)
+            self.assertLessEqual(error(circle1), error(plain) + 1, params)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,365 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+
+import generate_runs as gr
+from generate_runs import IMAGE_DIR
+from generate_runs import format_program_invocation
+from generate_runs import make_config
+from grid_engine import evaluate_block
+from image_store import ImageStore
+from scoring import image_loss
+from scoring import load_ground_truth
+from stage_cache import StageCache
+
+
+DEFAULT_EVALUATIONS     = 500
+DEFAULT_STARTUP         = 20
+DEFAULT_CANDIDATES      = 24
+DEFAULT_GAMMA           = 0.25
+DEFAULT_LOG             = 'tpe_log.jsonl'
+DEFAULT_TOP             = 10
+DEFAULT_CACHE_MB        = 256
+
+# Weight of the uniform prior mixed into every density estimate
+PRIOR_WEIGHT            = 1.0
+
+# Bandwidth, in value index steps, of the kernel used for ordinal params
+ORDINAL_BANDWIDTH       = 1.0
+
+# (name, values, ordinal, condition) for every parameter of the
+# generate_runs.py grid. condition is None or (parent name, parent values for
+# which this parameter is used). minRadius and maxRadius values are indexes
+# into MINRADIUS_VALS/MAXRADIUS_VALS, as those depend on the size bound.
+SEARCH_SPACE = (
+    ('size_bound',            gr.SIZE_VALS,                   True,  None),
+    ('enable_unsharp',        gr.ENABLE_UNSHARP_VALS,         False, None),
+    ('unsharp_blur_type',     gr.UNSHARP_BLUR_TYPE_VALS,      False,
+     ('enable_unsharp', (1, ))),
+    ('unsharp_blur_ksize',    gr.UNSHARP_BLUR_KSIZE_VALS,     True,
+     ('enable_unsharp', (1, ))),
+    ('unsharp_blur_sigmaXY',  gr.UNSHARP_BLUR_SIGMAXY_VALS,   True,
+     ('unsharp_blur_type', ('g', ))),
+    ('unsharp_add_weight',    gr.UNSHARP_ADD_WEIGHT_VALS,     True,
+     ('enable_unsharp', (1, ))),
+    ('unsharp_gamma',         gr.UNSHARP_GAMMA_VALS,          True,
+     ('enable_unsharp', (1, ))),
+    ('blur_type',             gr.BLUR_TYPE_VALS,              False, None),
+    ('blur_ksize',            gr.BLUR_KSIZE_VALS,             True,  None),
+    ('blur_sigmaXY',          gr.BLUR_SIGMAXY_VALS,           True,
+     ('blur_type', ('g', ))),
+    ('dp',                    gr.DP_VALS,                     True,  None),
+    ('minDist',               gr.MINDIST_VALS,                True,  None),
+    ('param1',                gr.PARAM1_VALS,                 True,  None),
+    ('param2',                gr.PARAM2_VALS,                 True,  None),
+    ('minRadius',             range(len(gr.MINRADIUS_VALS)),  True,  None),
+    ('maxRadius',             range(len(gr.MAXRADIUS_VALS)),  True,  None),
+)
+
+# Set in each worker process by _init_worker
+_worker = None
+
+
+def is_active(point, condition):
+    """
+    Whether a parameter with the given condition is used by point, a dict
+    of the values chosen so far.
+    """
+    if condition is None:
+        return True
+
+    parent, values = condition
+    return parent in point and point[parent] in values
+
+
+def point_to_config(point):
+    """
+    Builds the run_config.Config for a point of SEARCH_SPACE. Parameters
+    that are not active get the same defaults generate_runs.py uses.
+    """
+    optional = dict()
+    for name in ('unsharp_blur_type', 'unsharp_blur_ksize',
+                 'unsharp_add_weight', 'unsharp_gamma',
+                 'unsharp_blur_sigmaXY', 'blur_sigmaXY'):
+        if name in point:
+            optional[name] = point[name]
+
+    return make_config(point['size_bound'], point['blur_type'],
+                       point['blur_ksize'], point['dp'], point['minDist'],
+                       point['param1'], point['param2'],
+                       gr.MINRADIUS_VALS[point['minRadius']],
+                       gr.MAXRADIUS_VALS[point['maxRadius']],
+                       point['enable_unsharp'], **optional)
+
+
+def sample_uniform(rng):
+    point = dict()
+    for name, values, _, condition in SEARCH_SPACE:
+        if is_active(point, condition):
+            point[name] = rng.choice(values)
+    return point
+
+
+def propose(observations, rng, gamma=DEFAULT_GAMMA,
+            n_candidates=DEFAULT_CANDIDATES):
+    """
+    Proposes the next point to evaluate with the Tree-structured Parzen
+    Estimator. observations is a list of (point, loss). The best gamma
+    fraction of them fits the density l(x), the rest g(x). Candidates are
+    drawn from l(x), and the one maximizing l(x) / g(x) is returned.
+    """
+    ranked = sorted(observations, key=lambda o: o[1])
+    n_good = max(1, int(math.ceil(gamma * len(ranked))))
+    good = [p for p, _ in ranked[:n_good]]
+    bad  = [p for p, _ in ranked[n_good:]]
+
+    best_point = None
+    best_score = -float('inf')
+
+    for _ in range(n_candidates):
+        point = dict()
+        score = 0.0
+
+        # Parameters are sampled in SEARCH_SPACE order, so a parameter's
+        # condition is always decided before the parameter itself
+        for name, values, ordinal, condition in SEARCH_SPACE:
+            if not is_active(point, condition):
+                continue
+
+            l = _density(good, name, values, ordinal)
+            g = _density(bad, name, values, ordinal)
+
+            i = _weighted_choice(l, rng)
+            point[name] = values[i]
+            score += math.log(l[i]) - math.log(g[i])
+
+        if score > best_score:
+            best_point = point
+            best_score = score
+
+    return best_point
+
+
+def load_observations(fpath):
+    """
+    Reads the (point, loss) observations logged by a previous run.
+    """
+    observations = list()
+
+    if not os.path.exists(fpath):
+        return observations
+
+    with open(fpath) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                observations.append((record['point'], record['loss']))
+
+    return observations
+
+
+def evaluate(point):
+    """
+    Average loss of point over the ground truth images. Runs in a worker
+    process set up by _init_worker.
+    """
+    config = point_to_config(point)
+    results = evaluate_block([config], _worker['images'],
+                             _worker['image_dir'], _worker['cache'],
+                             _worker['store'])
+
+    total = 0.0
+    n = 0
+    for imname, circle1, circle2 in results[config]:
+        total += image_loss(_worker['ground_truth'][imname], circle1, circle2)
+        n += 1
+
+    if n == 0:
+        return float('inf')
+
+    return total / n
+
+
+def search(ground_truth_file, image_dir, image_store, log_file,
+           n_evaluations, n_startup, processes, rng, cache_mb):
+    """
+    Runs up to n_evaluations evaluations (counting those already in
+    log_file), keeping up to processes of them running at once. Every
+    finished evaluation is appended to log_file, so an interrupted search
+    resumes where it stopped. Returns all observations.
+    """
+    observations = load_observations(log_file)
+    seen = set(_point_key(p) for p, _ in observations)
+    running = dict()
+
+    if len(observations):
+        print('Resuming from {} logged evaluations'.format(len(observations)))
+
+    executor = ProcessPoolExecutor(
+        max_workers=processes, initializer=_init_worker,
+        initargs=(ground_truth_file, image_dir, image_store, cache_mb))
+
+    with executor, open(log_file, 'a') as log:
+
+        submitted = len(observations)
+
+        while submitted < n_evaluations or running:
+
+            while submitted < n_evaluations and len(running) < processes:
+                point = _next_point(observations, seen, n_startup, rng)
+                seen.add(_point_key(point))
+                running[executor.submit(evaluate, point)] = point
+                submitted += 1
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                point = running.pop(future)
+                loss = future.result()
+                observations.append((point, loss))
+
+                log.write(json.dumps({
+                    'point': point,
+                    'loss': loss,
+                    'config': format_program_invocation(
+                        point_to_config(point)),
+                }) + '\n')
+                log.flush()
+
+                best = min(o[1] for o in observations)
+                print('[{}/{}] loss {} (best {})'.format(
+                    len(observations), n_evaluations, loss, best))
+
+    return observations
+
+
+def _next_point(observations, seen, n_startup, rng):
+    # Proposals already evaluated (or running) are retried a few times and
+    # then replaced with a uniform sample
+    for _ in range(10):
+        if len(observations) < n_startup:
+            point = sample_uniform(rng)
+        else:
+            point = propose(observations, rng)
+
+        if _point_key(point) not in seen:
+            return point
+
+    return sample_uniform(rng)
+
+
+def _point_key(point):
+    return tuple(sorted(point.items()))
+
+
+def _density(points, name, values, ordinal):
+    """
+    Smoothed probability of each of values for parameter name, estimated
+    from the points in which it is active. Ordinal parameters spread each
+    observation over neighbouring values with a Gaussian kernel.
+    """
+    k = len(values)
+    weights = [PRIOR_WEIGHT / k] * k
+
+    for point in points:
+        if name not in point:
+            continue
+
+        j = values.index(point[name])
+
+        if not ordinal:
+            weights[j] += 1.0
+            continue
+
+        kernel = [math.exp(-0.5 * ((i - j) / ORDINAL_BANDWIDTH) ** 2)
+                  for i in range(k)]
+        norm = sum(kernel)
+        for i in range(k):
+            weights[i] += kernel[i] / norm
+
+    total = sum(weights)
+    return [w / total for w in weights]
+
+
+def _weighted_choice(weights, rng):
+    r = rng.random()
+    for i, w in enumerate(weights):
+        r -= w
+        if r < 0:
+            return i
+    return len(weights) - 1
+
+
+def _init_worker(ground_truth_file, image_dir, image_store, cache_mb):
+    global _worker
+
+    ground_truth = load_ground_truth(ground_truth_file)
+
+    _worker = {
+        'ground_truth': ground_truth,
+        'images': sorted(ground_truth),
+        'image_dir': image_dir,
+        'cache': StageCache(cache_mb * 1024 * 1024) if cache_mb > 0 else None,
+        'store': ImageStore(image_store) if image_store else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Sequential model based (TPE) search over the '
+                    'generate_runs.py parameter space, minimizing the '
+                    'average imgproc loss against a ground truth file.')
+    parser.add_argument('ground_truth_file')
+    parser.add_argument('--image-dir', type=str, default=IMAGE_DIR)
+    parser.add_argument('--image-store', type=str, default=None)
+    parser.add_argument('--log', type=str, default=DEFAULT_LOG,
+                        help='evaluation log, appended to and resumed from')
+    parser.add_argument('--evaluations', type=int, default=DEFAULT_EVALUATIONS)
+    parser.add_argument('--startup', type=int, default=DEFAULT_STARTUP,
+                        help='random evaluations before the model is used')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP)
+    parser.add_argument('--cache-mb', type=int, default=DEFAULT_CACHE_MB,
+                        help='preprocessing stage cache budget per process')
+    args = parser.parse_args()
+
+    t = time.time()
+
+    observations = search(args.ground_truth_file, args.image_dir,
+                          args.image_store, args.log, args.evaluations,
+                          args.startup, args.processes,
+                          random.Random(args.seed), args.cache_mb)
+
+    for point, loss in sorted(observations, key=lambda o: o[1])[:args.top]:
+        print('{}: {}'.format(loss,
+                              format_program_invocation(point_to_config(point))))
+
+    print('Elapsed: ' + str(time.time() - t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,505 @@
+#
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+from collections import deque
+from itertools import islice
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from detect_circles import HOUGH_METHODS
+from detect_circles import HOUGH_OPENCV
+from detect_circles import result_variant
+from generate_runs import IMAGE_DIR
+from generate_runs import IMAGE_LIST
+from generate_runs import build_param_space
+from grid_engine import DEFAULT_CACHE_MB
+from grid_engine import evaluate_block
+from grid_engine import read_image_list
+from grid_engine import read_runs_file
+from grid_engine import write_results
+from image_store import ImageStore
+from results_ledger import ResultsLedger
+from run_config import config_fingerprint
+from run_config import config_params_str
+from run_config import parse_config_params_str
+from stage_cache import StageCache
+
+
+DEFAULT_PORT            = 7000
+DEFAULT_BATCH_SIZE      = 16
+
+# Seconds without a heartbeat after which a worker is presumed dead and its
+# batch is handed out again
+DEFAULT_LEASE           = 120
+
+# Heartbeats a worker sends per lease, so one lost heartbeat does not cost
+# it its batch
+HEARTBEATS_PER_LEASE    = 3
+
+# Seconds an idle worker waits before asking for work again
+RETRY_INTERVAL          = 5
+
+# Most workers running the same batch at once. Once nothing is left to hand
+# out, idle workers duplicate the longest running batches so a slow or
+# stuck node does not hold up the end of the sweep.
+MAX_COPIES              = 2
+
+SOCKET_TIMEOUT          = 60
+
+# Protocol: every request is one JSON object on its own line, answered by
+# one JSON line, over a fresh TCP connection.
+#
+#   {"op": "get", "worker": w}
+#       -> {"batch": id, "image_list": .., "image_dir": .., "configs": [..],
+#           "options": {..}, "lease": seconds}
+#        | {"wait": seconds} | {"done": true}
+#   {"op": "heartbeat", "worker": w, "batch": id}
+#       -> {"ok": still running}; false once the lease expired or another
+#          copy of the batch completed, and the worker drops the batch
+#   {"op": "put", "worker": w, "batch": id, "results": [[params, circles,
+#    runtime], ..]}
+#       -> {"ok": true}
+#
+# Configs are sent as run_config.config_params_str strings, circles as
+# [imname, circle1, circle2] lists. options are the hough_method, refine,
+# joint and coarse_bound the coordinator was started with, which workers
+# pass on to grid_engine.evaluate_block.
+
+
+class WorkQueue(object):
+    """
+    Coordinator state: which batches are pending, leased to workers or
+    complete. batches is an iterator of (image_list, image_dir, configs)
+    and is only consumed as workers ask for work. Not thread safe.
+    """
+
+    def __init__(self, batches, lease=DEFAULT_LEASE):
+        self.lease      = lease
+        self._batches   = enumerate(batches)
+        self._exhausted = False
+        self._requeued  = deque()
+        self._work      = dict()
+        self._leases    = dict()
+        self.completed  = set()
+
+    @property
+    def finished(self):
+        return self._exhausted and not self._requeued and not self._leases
+
+    def get(self, worker, now=None):
+        """
+        Leases a batch to worker. Returns (batch_id, batch), or None if
+        there is nothing worker can do right now.
+        """
+        now = time.time() if now is None else now
+        self.expire(now)
+
+        batch_id = None
+        if self._requeued:
+            batch_id = self._requeued.popleft()
+        else:
+            batch_id = self._next_batch()
+
+        if batch_id is None:
+            batch_id = self._straggler(worker)
+            if batch_id is None:
+                return None
+
+        self._leases.setdefault(batch_id, dict())[worker] = (now + self.lease,
+                                                             now)
+        return batch_id, self._work[batch_id]
+
+    def heartbeat(self, worker, batch_id, now=None):
+        """
+        Extends worker's lease on batch_id. Returns False if the batch is
+        already complete.
+        """
+        now = time.time() if now is None else now
+
+        leases = self._leases.get(batch_id)
+        if leases is None or worker not in leases:
+            return batch_id not in self.completed
+
+        leases[worker] = (now + self.lease, leases[worker][1])
+        return True
+
+    def complete(self, worker, batch_id):
+        """
+        Marks batch_id complete. Returns False if another worker already
+        completed it, in which case its results should be discarded.
+        """
+        if batch_id in self.completed:
+            return False
+
+        self.completed.add(batch_id)
+        self._leases.pop(batch_id, None)
+        self._work.pop(batch_id, None)
+        if batch_id in self._requeued:
+            self._requeued.remove(batch_id)
+
+        return True
+
+    def expire(self, now):
+        """
+        Drops leases not renewed in time and requeues their batches.
+        """
+        for batch_id in list(self._leases):
+            leases = self._leases[batch_id]
+            for worker in [w for w, (deadline, _) in leases.items()
+                           if deadline < now]:
+                print('Worker {} lost batch {}'.format(worker, batch_id),
+                      file=sys.stderr)
+                del leases[worker]
+
+            if not leases:
+                del self._leases[batch_id]
+                self._requeued.appendleft(batch_id)
+
+    def _next_batch(self):
+        if self._exhausted:
+            return None
+
+        try:
+            batch_id, batch = next(self._batches)
+        except StopIteration:
+            self._exhausted = True
+            return None
+
+        self._work[batch_id] = batch
+        return batch_id
+
+    def _straggler(self, worker):
+        # Duplicate the batch that has been running the longest
+        candidates = [(min(s for _, s in leases.values()), batch_id)
+                      for batch_id, leases in self._leases.items()
+                      if worker not in leases and len(leases) < MAX_COPIES]
+        if not candidates:
+            return None
+        return min(candidates)[1]
+
+
+def make_batches(runs, batch_size, completed=frozenset(), variant=''):
+    """
+    Splits runs (as returned by grid_engine.read_runs_file) into
+    (image_list, image_dir, configs) batches of up to batch_size configs,
+    leaving out configs whose fingerprint (for the
+    detect_circles.result_variant variant) is in completed.
+    """
+    for (image_list, image_dir), configs in runs.items():
+        configs = (c for c in configs
+                   if config_fingerprint(c, variant) not in completed)
+
+        while True:
+            batch = list(islice(configs, batch_size))
+            if not batch:
+                break
+            yield image_list, image_dir, batch
+
+
+def serve(queue, port, output_dir, ledger=None, options=None):
+    """
+    Hands out the batches of queue to workers until every batch is complete,
+    then writes (or records in ledger) the results they send back. options
+    is a dict of the hough_method, refine, joint and coarse_bound workers
+    evaluate the batches with.
+    """
+    options = dict() if options is None else options
+
+    class Handler(socketserver.StreamRequestHandler):
+        timeout = SOCKET_TIMEOUT
+
+        def handle(self):
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = _handle_request(queue, request, output_dir, ledger,
+                                       options)
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+    socketserver.TCPServer.allow_reuse_address = True
+    server = socketserver.TCPServer(('', port), Handler)
+    server.timeout = 1
+
+    with server:
+        while not queue.finished:
+            server.handle_request()
+            queue.expire(time.time())
+
+        # Tell workers still asking for work that the sweep is over
+        deadline = time.time() + RETRY_INTERVAL * 2
+        while time.time() < deadline:
+            server.handle_request()
+
+
+def _handle_request(queue, request, output_dir, ledger, options):
+    worker = request.get('worker')
+    op = request.get('op')
+
+    if op == 'get':
+        if queue.finished:
+            return {'done': True}
+
+        lease = queue.get(worker)
+        if lease is None:
+            return {'wait': RETRY_INTERVAL}
+
+        batch_id, (image_list, image_dir, configs) = lease
+        print('Batch {} -> {}'.format(batch_id, worker))
+        return {
+            'batch': batch_id,
+            'image_list': image_list,
+            'image_dir': image_dir,
+            'configs': [config_params_str(c) for c in configs],
+            'options': options,
+            'lease': queue.lease,
+        }
+
+    if op == 'heartbeat':
+        return {'ok': queue.heartbeat(worker, request['batch'])}
+
+    if op == 'put':
+        if queue.complete(worker, request['batch']):
+            _collect(request['results'], output_dir, ledger,
+                     result_variant(**options))
+            print('Batch {} done by {} ({} complete)'.format(
+                request['batch'], worker, len(queue.completed)))
+        return {'ok': True}
+
+    return {'error': 'unknown op: {}'.format(op)}
+
+
+def _collect(results, output_dir, ledger, variant):
+    for params, circles, runtime in results:
+        config = parse_config_params_str(params)
+        circles = [(imname, _circle(c1), _circle(c2))
+                   for imname, c1, c2 in circles]
+
+        if ledger is not None:
+            ledger.record(config, circles, runtime, variant=variant)
+        else:
+            write_results({config: circles}, output_dir, variant)
+
+
+def _circle(value):
+    if value is None:
+        return None
+    return tuple(value)
+
+
+def request(address, message):
+    """
+    Sends one message to the coordinator at (host, port) and returns its
+    response.
+    """
+    with socket.create_connection(address, timeout=SOCKET_TIMEOUT) as sock:
+        sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        return json.loads(sock.makefile('rb').readline().decode('utf-8'))
+
+
+def work(address, cache_mb=DEFAULT_CACHE_MB, image_store=None):
+    """
+    Asks the coordinator at address for batches and evaluates them until it
+    reports the sweep is done. Heartbeats are sent at the interval the
+    coordinator's lease calls for, and a batch whose heartbeat is rejected
+    is dropped unfinished. Returns the number of batches evaluated.
+    """
+    worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+    cache = StageCache(cache_mb * 1024 * 1024) if cache_mb > 0 else None
+    store = ImageStore(image_store) if image_store else None
+    n = 0
+
+    while True:
+        try:
+            response = request(address, {'op': 'get', 'worker': worker})
+        except (OSError, ValueError) as e:
+            # The coordinator is gone once the sweep is done
+            print('Error: coordinator unreachable: {}'.format(e),
+                  file=sys.stderr)
+            return n
+
+        if response.get('done'):
+            return n
+
+        if 'wait' in response:
+            time.sleep(response['wait'])
+            continue
+
+        batch_id = response['batch']
+        configs = [parse_config_params_str(p) for p in response['configs']]
+
+        interval = response.get('lease', DEFAULT_LEASE) / HEARTBEATS_PER_LEASE
+
+        stop = threading.Event()
+        rejected = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat,
+                                     args=(address, worker, batch_id, stop,
+                                           rejected, interval))
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        try:
+            runtimes = dict()
+            results = evaluate_block(
+                configs, read_image_list(response['image_list']),
+                response['image_dir'], cache, store, runtimes,
+                cancel=rejected, **response.get('options', {}))
+        finally:
+            stop.set()
+
+        if rejected.is_set():
+            print('Batch {} taken back by the coordinator, dropped'.format(
+                      batch_id),
+                  file=sys.stderr)
+            continue
+
+        try:
+            request(address, {
+                'op': 'put',
+                'worker': worker,
+                'batch': batch_id,
+                'results': [[config_params_str(c), circles, runtimes.get(c)]
+                            for c, circles in results.items()],
+            })
+        except (OSError, ValueError) as e:
+            # Only a duplicate of a batch that is already complete can
+            # outlive the coordinator
+            print('Error: coordinator unreachable: {}'.format(e),
+                  file=sys.stderr)
+            return n
+
+        n += 1
+
+
+def _heartbeat(address, worker, batch_id, stop, rejected, interval):
+    while not stop.wait(interval):
+        try:
+            response = request(address, {'op': 'heartbeat', 'worker': worker,
+                                         'batch': batch_id})
+        except (OSError, ValueError):
+            continue
+
+        if not response.get('ok'):
+            rejected.set()
+            return
+
+
+def _work_process(address, cache_mb, image_store):
+    n = work(address, cache_mb, image_store)
+    print('Worker {} evaluated {} batches'.format(os.getpid(), n))
+
+
+def _parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Distributes a grid search over workers on any number '
+                    'of machines. The coordinator hands out batches of '
+                    'configurations on demand and collects the results.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    serve_parser = subparsers.add_parser('serve', help='run the coordinator')
+    serve_parser.add_argument('runs_file', nargs='?', default=None,
+                              help='runs file; if omitted, the whole '
+                                   'generate_runs.py grid is run')
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument('--batch-size', type=int,
+                              default=DEFAULT_BATCH_SIZE)
+    serve_parser.add_argument('--lease', type=float, default=DEFAULT_LEASE,
+                              help='seconds without a heartbeat before a '
+                                   'batch is handed out again')
+    serve_parser.add_argument('--output-dir', type=str, default='.')
+    serve_parser.add_argument('--ledger', type=str, default=None,
+                              help='results_ledger.py database to record '
+                                   'results in; configs already recorded in '
+                                   'it are skipped')
+    serve_parser.add_argument('--hough-method', choices=HOUGH_METHODS,
+                              default=HOUGH_OPENCV)
+    serve_parser.add_argument('--refine', action='store_true')
+    serve_parser.add_argument('--joint', action='store_true')
+    serve_parser.add_argument('--coarse-bound', type=int, default=None)
+
+    work_parser = subparsers.add_parser('work', help='run workers')
+    work_parser.add_argument('address', help='host:port of the coordinator')
+    work_parser.add_argument('--processes', type=int,
+                             default=multiprocessing.cpu_count())
+    work_parser.add_argument('--cache-mb', type=int, default=DEFAULT_CACHE_MB,
+                             help='preprocessing stage cache budget per '
+                                  'process')
+    work_parser.add_argument('--image-store', type=str, default=None)
+
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+
+    t = time.time()
+
+    if args.command == 'serve':
+        if args.coarse_bound is not None and (args.refine or args.joint):
+            serve_parser.error('--coarse-bound cannot be combined with '
+                               '--refine or --joint')
+
+        options = {
+            'hough_method': args.hough_method,
+            'refine':       args.refine,
+            'joint':        args.joint,
+            'coarse_bound': args.coarse_bound,
+        }
+
+        if args.runs_file is not None:
+            runs = read_runs_file(args.runs_file)
+        else:
+            runs = {(IMAGE_LIST, IMAGE_DIR): build_param_space()}
+
+        ledger = None
+        completed = frozenset()
+        if args.ledger is not None:
+            ledger = ResultsLedger(args.ledger)
+            completed = ledger.completed()
+
+        queue = WorkQueue(make_batches(runs, args.batch_size, completed,
+                                       result_variant(**options)),
+                          args.lease)
+        serve(queue, args.port, args.output_dir, ledger, options)
+
+        print('{} batches, elapsed: {}'.format(len(queue.completed),
+                                               time.time() - t))
+
+    elif args.command == 'work':
+        address = _parse_address(args.address)
+        processes = [multiprocessing.Process(
+                         target=_work_process,
+                         args=(address, args.cache_mb, args.image_store))
+                     for _ in range(args.processes)]
+
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+
+        print('Elapsed: ' + str(time.time() - t))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,14 @@ import sys
 from ast import literal_eval
 import math
 
+import circle_table
 import util
 
 OUTPUT_FILE = "output.html"
 TRUTH_FILE = "image_data.txt"
+TRUTH_TABLE = "image_data.npz"
+METADATA_FILE = "metadata.txt"
+METADATA_TABLE = "metadata.npz"
 
 HTML = """
 <script defer src="https://code.getmdl.io/1.2.1/material.min.js"></script>
@@ -402,24 +406,59 @@ def euclidean_distance(circle1, circle2):
 	return math.sqrt((dx ** 2) + (dy ** 2))
 
 
-def read_metadata(original_path, processed_path, original_bucket, processed_bucket, converter):
+def read_circle_table(path):
+    table = circle_table.eclipse_data_from_table(circle_table.read_table(path))
+
+    return dict((name, dict(sun = img.solar_circle, moon = img.lunar_circle))
+                for name, img in table.items())
 
-    try: 
-        truth_file = open(os.path.join(original_path, TRUTH_FILE), 'r')
-    except FileNotFoundError:
-        truth_file = None
-        
-    if truth_file is not None:
 
-        truth_positions = {}
+def read_truth_file(path):
+    truth_positions = {}
+
+    with open(path, 'r') as truth_file:
         for line in truth_file:
             tokens = line.split('|')
 
             position = dict(sun = literal_eval(tokens[2]), moon = literal_eval(tokens[3]))
 
             truth_positions[tokens[0]] = position
-    
-    f = open(os.path.join(processed_path, "metadata.txt"), 'r')
+
+    return truth_positions
+
+
+def parse_circle_token(token):
+    if token.startswith('c'):
+        return literal_eval(token[1:])
+    return None
+
+
+def read_metadata(original_path, processed_path, original_bucket, processed_bucket, converter):
+
+    # The circle_table.py version of the ground truth is used when present,
+    # as it is read without parsing every circle
+    truth_table = os.path.join(original_path, TRUTH_TABLE)
+    truth_positions = None
+
+    if os.path.exists(truth_table):
+        truth_positions = read_circle_table(truth_table)
+    else:
+        try: 
+            truth_positions = read_truth_file(os.path.join(original_path, TRUTH_FILE))
+        except FileNotFoundError:
+            pass
+
+    # Likewise the found sun and moon are read from a circle_table.py
+    # version of the metadata (solar and lunar columns) when present. The
+    # text rows are still read for everything else.
+    metadata_table = os.path.join(processed_path, METADATA_TABLE)
+    found_positions = None
+
+    if os.path.exists(metadata_table):
+        found_positions = read_circle_table(metadata_table)
+
+    with open(os.path.join(processed_path, METADATA_FILE), 'r') as f:
+        lines = f.readlines()
 
     metadata_items = []
     time_score = 0
@@ -428,7 +467,7 @@ def read_metadata(original_path, processed_path, original_bucket, processed_buck
     sun_radius_sum = 0
     sun_count = 0
 
-    for line in f.readlines():
+    for line in lines:
         tokens = line.split('|')
         
         img_name = os.path.basename(tokens[0])
@@ -462,21 +501,28 @@ def read_metadata(original_path, processed_path, original_bucket, processed_buck
         item['comments'] = comments
         item['circles'] = circles
         
-        if tokens[1].startswith('c'):
-            item['found_sun'] = literal_eval(tokens[1][1:])
+        if found_positions is not None and img_name in found_positions:
+            found_sun = found_positions[img_name]['sun']
+            found_moon = found_positions[img_name]['moon']
+        else:
+            found_sun = parse_circle_token(tokens[1])
+            found_moon = parse_circle_token(tokens[2])
+
+        if found_sun is not None:
+            item['found_sun'] = found_sun
         else:
             item['found_sun'] = "undefined"
             
-        if tokens[2].startswith('c'):
-            item['found_moon'] = literal_eval(tokens[2][1:])
+        if found_moon is not None:
+            item['found_moon'] = found_moon
         else:
             item['found_moon'] = "undefined"
             
-        if truth_file is not None and img_name in truth_positions:
+        if truth_positions is not None and img_name in truth_positions:
  
             if truth_positions[img_name]['moon'] is not None:
-                if tokens[2].startswith('c'):
-                    moon_center_offset, moon_radius_diff = calc_position_diff(literal_eval(tokens[2][1:]), truth_positions[img_name]['moon'])
+                if found_moon is not None:
+                    moon_center_offset, moon_radius_diff = calc_position_diff(found_moon, truth_positions[img_name]['moon'])
                     item['moon_center_diff'] = moon_center_offset
                     item['moon_rad_diff'] = moon_radius_diff
                 else:
@@ -487,8 +533,8 @@ def read_metadata(original_path, processed_path, original_bucket, processed_buck
                 item['moon_rad_diff'] = "No Moon in ground truth"
 
             if truth_positions[img_name]['sun'] is not None:
-                if tokens[1].startswith('c'):
-                    sun_center_offset, sun_radius_diff = calc_position_diff(literal_eval(tokens[1][1:]), truth_positions[img_name]['sun'])
+                if found_sun is not None:
+                    sun_center_offset, sun_radius_diff = calc_position_diff(found_sun, truth_positions[img_name]['sun'])
                     item['sun_center_diff'] = sun_center_offset
                     item['sun_rad_diff'] = sun_radius_diff
                 else:
@@ -498,7 +544,7 @@ def read_metadata(original_path, processed_path, original_bucket, processed_buck
                 item['sun_center_diff'] = "No Sun in ground truth"
                 item['sun_rad_diff'] = "No Sun in ground truth"
 
-            if tokens[1].startswith('c') and truth_positions[img_name]['sun'] is not None:
+            if found_sun is not None and truth_positions[img_name]['sun'] is not None:
                 sun_center_sum += sun_center_offset
                 sun_radius_sum += abs(sun_radius_diff)
                 sun_count += 1